@@ -8,3 +8,19 @@ ANISO_THRESHOLD = 3  # determines when a sample is considered anisotropic (3 mea
 # resolution axis must be 3x as large as the next largest spacing)
 
 default_n_proc_DA = get_allowed_n_proc_DA()
+
+# store preprocessed cases as chunked, compressed blosc2 arrays (.b2nd) instead of npz + unpacked npy. The data loaders
+# then only read and decompress the chunks that overlap a patch. Requires blosc2 (pip install blosc2)
+use_chunked_storage = os.environ.get('nnUNet_chunked_storage', 'false').lower() in ('true', '1', 't')
+# with chunked storage: delete the npz files of an existing dataset once unpack_dataset has converted (and verified)
+# them, otherwise they are kept next to the .b2nd files
+remove_npz_after_chunking = os.environ.get('nnUNet_chunked_storage_remove_npz', 'false').lower() in ('true', '1', 't')
+
+# data augmentation backend of nnUNetTrainer: 'default' (LimitedLenWrapper), 'shared_memory' (worker processes write
+# into a ring of shared memory batches, see SharedMemoryRingAugmenter) or 'threads' (same with threads)
+data_augmentation_backend = os.environ.get('nnUNet_DA_backend', 'default').lower()
+
+# replace the rotation/scaling SpatialTransform of the training pipeline with BatchedSpatialTransform (torch grid_sample
+# on the whole batch). It runs on the training device if data augmentation runs in the main process or in threads
+# (nnUNet_DA_backend=threads), otherwise in the workers on CPU
+use_batched_spatial_DA = os.environ.get('nnUNet_batched_spatial_DA', 'false').lower() in ('true', '1', 't')
@@ -9,11 +9,20 @@ import numpy as np
 import torch
 from batchgenerators.dataloading.data_loader import DataLoader
 
+from nnunetv2.inference.shared_memory_transport import SharedMemoryBufferPool, unpack_shared_memory_item
 from nnunetv2.preprocessing.preprocessors.default_preprocessor import DefaultPreprocessor
 from nnunetv2.utilities.label_handling.label_handling import convert_labelmap_to_one_hot
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
 
 
+def nonzero_mask_from_seg(seg: np.ndarray) -> torch.Tensor:
+    """
+    crop_to_nonzero marks everything outside the nonzero mask with -1 in seg, also when there is no segmentation to
+    begin with (test cases). Returns a boolean mask that is True inside the nonzero mask
+    """
+    return torch.from_numpy(seg[0] >= 0)
+
+
 def preprocess_fromfiles_save_to_queue(list_of_lists: List[List[str]],
                                        list_of_segs_from_prev_stage_files: Union[None, List[str]],
                                        output_filenames_truncated: Union[None, List[str]],
@@ -23,7 +32,11 @@ def preprocess_fromfiles_save_to_queue(list_of_lists: List[List[str]],
                                        target_queue: Queue,
                                        done_event: Event,
                                        abort_event: Event,
-                                       verbose: bool = False):
+                                       verbose: bool = False,
+                                       return_nonzero_mask: bool = False,
+                                       free_buffer_queue: Queue = None):
+    # if free_buffer_queue is given, tensors are handed over in shared memory (see SharedMemoryBufferPool)
+    buffer_pool = SharedMemoryBufferPool(free_buffer_queue) if free_buffer_queue is not None else None
     try:
         label_manager = plans_manager.get_label_manager(dataset_json)
         preprocessor = configuration_manager.preprocessor_class(verbose=verbose)
@@ -42,6 +55,10 @@ def preprocess_fromfiles_save_to_queue(list_of_lists: List[List[str]],
 
             item = {'data': data, 'data_properites': data_properites,
                     'ofile': output_filenames_truncated[idx] if output_filenames_truncated is not None else None}
+            if return_nonzero_mask:
+                item['nonzero_mask'] = nonzero_mask_from_seg(seg)
+            if buffer_pool is not None:
+                item = buffer_pool.pack(item)
             success = False
             while not success:
                 try:
@@ -55,6 +72,9 @@ def preprocess_fromfiles_save_to_queue(list_of_lists: List[List[str]],
     except Exception as e:
         abort_event.set()
         raise e
+    finally:
+        if buffer_pool is not None:
+            buffer_pool.close()
 
 
 def preprocessing_iterator_fromfiles(list_of_lists: List[List[str]],
@@ -65,7 +85,9 @@ def preprocessing_iterator_fromfiles(list_of_lists: List[List[str]],
                                      configuration_manager: ConfigurationManager,
                                      num_processes: int,
                                      pin_memory: bool = False,
-                                     verbose: bool = False):
+                                     verbose: bool = False,
+                                     return_nonzero_mask: bool = False,
+                                     use_shared_memory: bool = False):
     context = multiprocessing.get_context('spawn')
     manager = Manager()
     num_processes = min(len(list_of_lists), num_processes)
@@ -73,6 +95,7 @@ def preprocessing_iterator_fromfiles(list_of_lists: List[List[str]],
     processes = []
     done_events = []
     target_queues = []
+    free_buffer_queues = [manager.Queue() for _ in range(num_processes)] if use_shared_memory else None
     abort_event = manager.Event()
     for i in range(num_processes):
         event = manager.Event()
@@ -90,7 +113,9 @@ def preprocessing_iterator_fromfiles(list_of_lists: List[List[str]],
                          queue,
                          event,
                          abort_event,
-                         verbose
+                         verbose,
+                         return_nonzero_mask,
+                         free_buffer_queues[i] if use_shared_memory else None
                      ), daemon=True)
         pr.start()
         target_queues.append(queue)
@@ -101,6 +126,8 @@ def preprocessing_iterator_fromfiles(list_of_lists: List[List[str]],
     while (not done_events[worker_ctr].is_set()) or (not target_queues[worker_ctr].empty()):
         if not target_queues[worker_ctr].empty():
             item = target_queues[worker_ctr].get()
+            if use_shared_memory:
+                item = unpack_shared_memory_item(item, free_buffer_queues[worker_ctr], done_events[worker_ctr])
             worker_ctr = (worker_ctr + 1) % num_processes
         else:
             all_ok = all(
@@ -168,8 +195,10 @@ class PreprocessAdapterFromNpy(DataLoader):
                  list_of_image_properties: List[dict],
                  truncated_ofnames: Union[List[str], None],
                  plans_manager: PlansManager, dataset_json: dict, configuration_manager: ConfigurationManager,
-                 num_threads_in_multithreaded: int = 1, verbose: bool = False):
+                 num_threads_in_multithreaded: int = 1, verbose: bool = False,
+                 return_nonzero_mask: bool = False):
         preprocessor = configuration_manager.preprocessor_class(verbose=verbose)
+        self.return_nonzero_mask = return_nonzero_mask
         self.preprocessor, self.plans_manager, self.configuration_manager, self.dataset_json, self.truncated_ofnames = \
             preprocessor, plans_manager, configuration_manager, dataset_json, truncated_ofnames
 
@@ -207,7 +236,10 @@ class PreprocessAdapterFromNpy(DataLoader):
 
         data = torch.from_numpy(data)
 
-        return {'data': data, 'data_properites': props, 'ofile': ofname}
+        item = {'data': data, 'data_properites': props, 'ofile': ofname}
+        if self.return_nonzero_mask:
+            item['nonzero_mask'] = nonzero_mask_from_seg(seg)
+        return item
 
 
 def preprocess_fromnpy_save_to_queue(list_of_images: List[np.ndarray],
@@ -220,7 +252,11 @@ def preprocess_fromnpy_save_to_queue(list_of_images: List[np.ndarray],
                                      target_queue: Queue,
                                      done_event: Event,
                                      abort_event: Event,
-                                     verbose: bool = False):
+                                     verbose: bool = False,
+                                     return_nonzero_mask: bool = False,
+                                     free_buffer_queue: Queue = None):
+    # if free_buffer_queue is given, tensors are handed over in shared memory (see SharedMemoryBufferPool)
+    buffer_pool = SharedMemoryBufferPool(free_buffer_queue) if free_buffer_queue is not None else None
     try:
         label_manager = plans_manager.get_label_manager(dataset_json)
         preprocessor = configuration_manager.preprocessor_class(verbose=verbose)
@@ -240,6 +276,10 @@ def preprocess_fromnpy_save_to_queue(list_of_images: List[np.ndarray],
 
             item = {'data': data, 'data_properites': list_of_image_properties[idx],
                     'ofile': truncated_ofnames[idx] if truncated_ofnames is not None else None}
+            if return_nonzero_mask:
+                item['nonzero_mask'] = nonzero_mask_from_seg(seg)
+            if buffer_pool is not None:
+                item = buffer_pool.pack(item)
             success = False
             while not success:
                 try:
@@ -253,6 +293,9 @@ def preprocess_fromnpy_save_to_queue(list_of_images: List[np.ndarray],
     except Exception as e:
         abort_event.set()
         raise e
+    finally:
+        if buffer_pool is not None:
+            buffer_pool.close()
 
 
 def preprocessing_iterator_fromnpy(list_of_images: List[np.ndarray],
@@ -264,7 +307,9 @@ def preprocessing_iterator_fromnpy(list_of_images: List[np.ndarray],
                                    configuration_manager: ConfigurationManager,
                                    num_processes: int,
                                    pin_memory: bool = False,
-                                   verbose: bool = False):
+                                   verbose: bool = False,
+                                   return_nonzero_mask: bool = False,
+                                   use_shared_memory: bool = False):
     context = multiprocessing.get_context('spawn')
     manager = Manager()
     num_processes = min(len(list_of_images), num_processes)
@@ -272,6 +317,7 @@ def preprocessing_iterator_fromnpy(list_of_images: List[np.ndarray],
     target_queues = []
     processes = []
     done_events = []
+    free_buffer_queues = [manager.Queue() for _ in range(num_processes)] if use_shared_memory else None
     abort_event = manager.Event()
     for i in range(num_processes):
         event = manager.Event()
@@ -289,7 +335,9 @@ def preprocessing_iterator_fromnpy(list_of_images: List[np.ndarray],
                          queue,
                          event,
                          abort_event,
-                         verbose
+                         verbose,
+                         return_nonzero_mask,
+                         free_buffer_queues[i] if use_shared_memory else None
                      ), daemon=True)
         pr.start()
         done_events.append(event)
@@ -300,6 +348,8 @@ def preprocessing_iterator_fromnpy(list_of_images: List[np.ndarray],
     while (not done_events[worker_ctr].is_set()) or (not target_queues[worker_ctr].empty()):
         if not target_queues[worker_ctr].empty():
             item = target_queues[worker_ctr].get()
+            if use_shared_memory:
+                item = unpack_shared_memory_item(item, free_buffer_queues[worker_ctr], done_events[worker_ctr])
             worker_ctr = (worker_ctr + 1) % num_processes
         else:
             all_ok = all(
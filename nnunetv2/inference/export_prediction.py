@@ -1,17 +1,36 @@
 import os
 from copy import deepcopy
-from typing import Union, List
+from typing import Union, List, Tuple
 
 import numpy as np
 import torch
 from acvl_utils.cropping_and_padding.bounding_boxes import bounding_box_to_slice
 from batchgenerators.utilities.file_and_folder_operations import load_json, isfile, save_pickle
 
-from nnunetv2.configuration import default_num_processes
+from nnunetv2.configuration import default_num_processes, ANISO_THRESHOLD
+from nnunetv2.preprocessing.resampling.default_resampling import determine_do_sep_z_and_axis
 from nnunetv2.utilities.label_handling.label_handling import LabelManager
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
 
 
+def revert_cropping_and_transpose_segmentation(segmentation: np.ndarray,
+                                               plans_manager: PlansManager,
+                                               label_manager: LabelManager,
+                                               properties_dict: dict) -> np.ndarray:
+    """
+    segmentation must have shape_after_cropping_and_before_resampling. Puts it back into the bbox it was cropped from
+    and reverts the transpose
+    """
+    # put segmentation in bbox (revert cropping)
+    segmentation_reverted_cropping = np.zeros(properties_dict['shape_before_cropping'],
+                                              dtype=np.uint8 if len(label_manager.foreground_labels) < 255 else np.uint16)
+    slicer = bounding_box_to_slice(properties_dict['bbox_used_for_cropping'])
+    segmentation_reverted_cropping[slicer] = segmentation
+
+    # revert transpose
+    return segmentation_reverted_cropping.transpose(plans_manager.transpose_backward)
+
+
 def convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits: Union[torch.Tensor, np.ndarray],
                                                                 plans_manager: PlansManager,
                                                                 configuration_manager: ConfigurationManager,
@@ -41,15 +60,9 @@ def convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits
     if isinstance(segmentation, torch.Tensor):
         segmentation = segmentation.cpu().numpy()
 
-    # put segmentation in bbox (revert cropping)
-    segmentation_reverted_cropping = np.zeros(properties_dict['shape_before_cropping'],
-                                              dtype=np.uint8 if len(label_manager.foreground_labels) < 255 else np.uint16)
-    slicer = bounding_box_to_slice(properties_dict['bbox_used_for_cropping'])
-    segmentation_reverted_cropping[slicer] = segmentation
+    segmentation_reverted_cropping = revert_cropping_and_transpose_segmentation(segmentation, plans_manager,
+                                                                                label_manager, properties_dict)
     del segmentation
-
-    # revert transpose
-    segmentation_reverted_cropping = segmentation_reverted_cropping.transpose(plans_manager.transpose_backward)
     if return_probabilities:
         # revert cropping
         predicted_probabilities = label_manager.revert_cropping_on_probabilities(predicted_probabilities,
@@ -106,6 +119,147 @@ def export_prediction_from_logits(predicted_array_or_file: Union[np.ndarray, tor
                  properties_dict)
 
 
+def export_segmentation(segmentation: np.ndarray, properties_dict: dict, plans_manager: PlansManager,
+                        dataset_json_dict_or_file: Union[dict, str], output_file_truncated: str):
+    """
+    segmentation must have shape_after_cropping_and_before_resampling (see StreamingSegmentationExporter)
+    """
+    if isinstance(dataset_json_dict_or_file, str):
+        dataset_json_dict_or_file = load_json(dataset_json_dict_or_file)
+
+    label_manager = plans_manager.get_label_manager(dataset_json_dict_or_file)
+    segmentation_final = revert_cropping_and_transpose_segmentation(segmentation, plans_manager, label_manager,
+                                                                    properties_dict)
+    rw = plans_manager.image_reader_writer_class()
+    rw.write_seg(segmentation_final, output_file_truncated + dataset_json_dict_or_file['file_ending'],
+                 properties_dict)
+
+
+class StreamingSegmentationExporter(object):
+    """
+    Low memory alternative to convert_predicted_logits_to_segmentation_with_correct_shape. Receives the predicted
+    logits in network resolution as consecutive chunks along the first spatial axis (see add_chunk) and resamples +
+    converts every chunk to the segmentation as soon as all the logits it depends on are available. Only a few rows of
+    logits are held in memory at any time.
+
+    Resampling is separable linear (order 1) or nearest neighbor (order 0) interpolation per axis with the same
+    coordinate mapping as resample_data_or_seg_to_shape (skimage resize, mode='edge'), so only that resampling
+    function with order <= 1 and order_z <= 1 is supported (see is_supported).
+    """
+    def __init__(self, source_shape: Tuple[int, ...], configuration_manager: ConfigurationManager,
+                 label_manager: LabelManager, properties_dict: dict):
+        self.label_manager = label_manager
+        self.source_shape = tuple(source_shape)
+        self.target_shape = tuple(properties_dict['shape_after_cropping_and_before_resampling'])
+        assert len(self.source_shape) == len(self.target_shape) == 3, 'only (x, y, z) images are supported'
+
+        assert self.is_supported(configuration_manager), \
+            'StreamingSegmentationExporter only supports resample_data_or_seg_to_shape as resampling_fn_probabilities ' \
+            'with orders 0 and 1'
+        kwargs = configuration_manager.configuration['resampling_fn_probabilities_kwargs']
+        order = kwargs.get('order', 3)
+        order_z = kwargs.get('order_z', 0)
+        current_spacing = configuration_manager.spacing if \
+            len(configuration_manager.spacing) == len(self.target_shape) else \
+            [properties_dict['spacing'][0], *configuration_manager.spacing]
+        do_separate_z, axis = determine_do_sep_z_and_axis(kwargs.get('force_separate_z', False), current_spacing,
+                                                          properties_dict['spacing'],
+                                                          kwargs.get('separate_z_anisotropy_threshold', ANISO_THRESHOLD))
+        self.orders = [order] * 3
+        if do_separate_z:
+            self.orders[axis[0]] = order_z
+
+        # source coordinates of all target voxels, per axis
+        self.coordinates = [(np.arange(t) + 0.5) * (s / t) - 0.5 for s, t in zip(self.source_shape, self.target_shape)]
+        # which source rows (first axis) does each target row need?
+        self.lowest_needed_row, self.highest_needed_row = self._source_indices(self.coordinates[0], self.orders[0],
+                                                                               self.source_shape[0])
+
+        self.segmentation = np.zeros(self.target_shape,
+                                     dtype=np.uint8 if len(label_manager.foreground_labels) < 255 else np.uint16)
+        self.buffer = None
+        self.buffer_start = 0
+        self.num_received = 0
+        self.num_emitted = 0
+
+    @staticmethod
+    def is_supported(configuration_manager: ConfigurationManager) -> bool:
+        """whether the resampling of configuration_manager can be done chunk by chunk"""
+        if configuration_manager.configuration['resampling_fn_probabilities'] != 'resample_data_or_seg_to_shape':
+            return False
+        kwargs = configuration_manager.configuration['resampling_fn_probabilities_kwargs']
+        return kwargs.get('order', 3) <= 1 and kwargs.get('order_z', 0) <= 1
+
+    @staticmethod
+    def _source_indices(coordinates: np.ndarray, order: int, size: int) -> Tuple[np.ndarray, np.ndarray]:
+        if order == 0:
+            # map_coordinates rounds halves up (np.round would round them to even)
+            idx = np.clip(np.floor(coordinates + 0.5), 0, size - 1).astype(np.int64)
+            return idx, idx
+        coordinates = np.clip(coordinates, 0, size - 1)
+        lower = np.floor(coordinates).astype(np.int64)
+        return lower, np.minimum(lower + 1, size - 1)
+
+    def _interpolate_axis(self, x: torch.Tensor, dim: int, coordinates: np.ndarray, order: int) -> torch.Tensor:
+        size = x.shape[dim]
+        lower, upper = self._source_indices(coordinates, order, size)
+        lower_values = torch.index_select(x, dim, torch.from_numpy(lower).to(x.device))
+        if order == 0:
+            return lower_values
+        weight_shape = [1] * len(x.shape)
+        weight_shape[dim] = len(coordinates)
+        weights = torch.from_numpy(np.clip(coordinates, 0, size - 1) - lower).to(x.device, x.dtype)
+        weights = weights.view(weight_shape)
+        return lower_values * (1 - weights) + torch.index_select(x, dim, torch.from_numpy(upper).to(x.device)) * weights
+
+    def add_chunk(self, logits: torch.Tensor) -> None:
+        """
+        logits: (c, n, y, z) with the next n rows along the first spatial axis (in network resolution)
+        """
+        assert tuple(logits.shape[2:]) == self.source_shape[1:]
+        logits = logits.float().cpu()
+        num_rows = logits.shape[1]
+        # rows in front of buffer_start are not needed anymore (_emit can drop rows that have not arrived yet when
+        # the first axis is downsampled)
+        skip = min(max(0, self.buffer_start - self.num_received), num_rows)
+        if skip > 0:
+            logits = logits[:, skip:]
+        self.buffer = logits if self.buffer is None else torch.cat((self.buffer, logits), 1)
+        self.num_received += num_rows
+        assert self.num_received <= self.source_shape[0]
+
+        # all target rows whose source rows have been received can be finalized now
+        num_ready = int(np.searchsorted(self.highest_needed_row, self.num_received, side='left'))
+        if num_ready > self.num_emitted:
+            self._emit(num_ready)
+
+    def _emit(self, end: int) -> None:
+        start = self.num_emitted
+        rows = self._interpolate_axis(self.buffer, 1, self.coordinates[0][start:end] - self.buffer_start,
+                                      self.orders[0])
+        rows = self._interpolate_axis(rows, 2, self.coordinates[1], self.orders[1])
+        rows = self._interpolate_axis(rows, 3, self.coordinates[2], self.orders[2])
+        segmentation = self.label_manager.convert_logits_to_segmentation(rows)
+        self.segmentation[start:end] = segmentation.cpu().numpy()
+        self.num_emitted = end
+
+        # drop source rows that no remaining target row needs. Rows beyond the buffer have not been received yet,
+        # add_chunk skips them when they arrive
+        if end < self.target_shape[0]:
+            drop = int(self.lowest_needed_row[end]) - self.buffer_start
+            if drop > 0:
+                self.buffer = self.buffer[:, min(drop, self.buffer.shape[1]):]
+                self.buffer_start += drop
+
+    def get_segmentation(self) -> np.ndarray:
+        """
+        returns the segmentation in shape_after_cropping_and_before_resampling. Use export_segmentation or
+        revert_cropping_and_transpose_segmentation to get the final result
+        """
+        assert self.num_emitted == self.target_shape[0], 'not all logits have been received yet'
+        return self.segmentation
+
+
 def resample_and_save(predicted: Union[torch.Tensor, np.ndarray], target_shape: List[int], output_file: str,
                       plans_manager: PlansManager, configuration_manager: ConfigurationManager, properties_dict: dict,
                       dataset_json_dict_or_file: Union[dict, str], num_threads_torch: int = default_num_processes) \
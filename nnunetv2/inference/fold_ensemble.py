@@ -0,0 +1,38 @@
+from copy import deepcopy
+from typing import List
+
+import torch
+from torch import nn
+from torch._dynamo import OptimizedModule
+
+
+class FoldEnsembleNetwork(nn.Module):
+    """
+    Keeps one instance of the network per fold so that the fold weights stay resident and do not have to be copied
+    into the network again for every case. forward returns the mean of the fold logits.
+
+    Because the gaussian weighted sliding window aggregation is linear, averaging the folds per tile gives the same
+    result as averaging the per fold sliding window predictions.
+    """
+    def __init__(self, network: nn.Module, list_of_parameters: List[dict]):
+        super().__init__()
+        assert len(list_of_parameters) > 0, 'need at least one set of parameters'
+        compiled = isinstance(network, OptimizedModule)
+        base_network = network._orig_mod if compiled else network
+
+        folds = []
+        for params in list_of_parameters:
+            fold_network = deepcopy(base_network)
+            fold_network.load_state_dict(params)
+            if compiled:
+                fold_network = torch.compile(fold_network)
+            folds.append(fold_network)
+        self.folds = nn.ModuleList(folds)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        prediction = self.folds[0](x)
+        for fold_network in self.folds[1:]:
+            prediction += fold_network(x)
+        if len(self.folds) > 1:
+            prediction /= len(self.folds)
+        return prediction
@@ -1,13 +1,17 @@
 import inspect
+import itertools
 import multiprocessing
 import os
 import traceback
+import warnings
+from collections import OrderedDict
 from copy import deepcopy
-from time import sleep
+from time import time
 from typing import Tuple, Union, List, Optional
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 from acvl_utils.cropping_and_padding.padding import pad_nd_image
 from batchgenerators.dataloading.multi_threaded_augmenter import MultiThreadedAugmenter
 from batchgenerators.utilities.file_and_folder_operations import load_json, join, isfile, maybe_mkdir_p, isdir, subdirs, \
@@ -22,10 +26,13 @@ from nnunetv2.configuration import default_num_processes
 from nnunetv2.inference.data_iterators import PreprocessAdapterFromNpy, preprocessing_iterator_fromfiles, \
     preprocessing_iterator_fromnpy
 from nnunetv2.inference.export_prediction import export_prediction_from_logits, \
-    convert_predicted_logits_to_segmentation_with_correct_shape
+    convert_predicted_logits_to_segmentation_with_correct_shape, export_segmentation, \
+    revert_cropping_and_transpose_segmentation, StreamingSegmentationExporter
+from nnunetv2.inference.fold_ensemble import FoldEnsembleNetwork
+from nnunetv2.inference.prediction_pipeline import PipelineStats, BoundedExportQueue, prefetch_iterator
 from nnunetv2.inference.sliding_window_prediction import compute_gaussian, \
     compute_steps_for_sliding_window
-from nnunetv2.utilities.file_path_utilities import get_output_folder, check_workers_alive_and_busy
+from nnunetv2.utilities.file_path_utilities import get_output_folder
 from nnunetv2.utilities.find_class_by_name import recursive_find_python_class
 from nnunetv2.utilities.helpers import empty_cache, dummy_context
 from nnunetv2.utilities.json_export import recursive_fix_for_json_export
@@ -33,6 +40,7 @@ from nnunetv2.utilities.label_handling.label_handling import determine_num_input
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
 from nnunetv2.utilities.utils import create_lists_from_splitted_dataset_folder
 
+from nnunetv2.tuanluc_dev.network_initialization import convert_acsconv_network_to_conv3d
 from nnunetv2.tuanluc_dev.get_network_from_plans import (
     get_network_from_plans_bn, 
     get_network_from_plans_cbam, 
@@ -54,7 +62,19 @@ class nnUNetPredictor(object):
                  verbose: bool = False,
                  verbose_preprocessing: bool = False,
                  allow_tqdm: bool = True,
-                 custom_network_config_path=None,):
+                 custom_network_config_path=None,
+                 tile_batch_size: int = 1,
+                 batched_mirroring: bool = False,
+                 max_mirror_batch_size: int = 8,
+                 keep_folds_resident: bool = False,
+                 skip_background_tiles: bool = False,
+                 coarse_to_fine: bool = False,
+                 coarse_downsampling_factor: float = 2.,
+                 coarse_roi_margin: int = 16,
+                 streaming_export: bool = False,
+                 sliding_window_cache_size: int = 4,
+                 shared_memory_transport: bool = False,
+                 acsconv_to_conv3d: bool = False):
         self.verbose = verbose
         self.verbose_preprocessing = verbose_preprocessing
         self.allow_tqdm = allow_tqdm
@@ -75,6 +95,48 @@ class nnUNetPredictor(object):
         self.device = device
         self.perform_everything_on_gpu = perform_everything_on_gpu
         self.custom_network_config_path = custom_network_config_path
+        assert tile_batch_size >= 1, 'tile_batch_size must be at least 1'
+        # number of sliding window tiles that are stacked into a single forward pass
+        self.tile_batch_size = tile_batch_size
+        # if batched_mirroring is set, all mirrored variants of a tile are predicted together in chunks of at most
+        # max_mirror_batch_size network inputs. The chunk size is reduced automatically if the GPU runs out of memory,
+        # but only for the current sliding window prediction (_case_max_mirror_batch_size)
+        assert max_mirror_batch_size >= 1, 'max_mirror_batch_size must be at least 1'
+        self.batched_mirroring = batched_mirroring
+        self.max_mirror_batch_size = max_mirror_batch_size
+        self._case_max_mirror_batch_size = max_mirror_batch_size
+        # keep_folds_resident holds one network instance per fold instead of calling load_state_dict for every fold
+        # and every case. Costs (num_folds - 1) x the network parameters in memory
+        self.keep_folds_resident = keep_folds_resident
+        self.fold_ensemble = None
+        # skip_background_tiles does not run the network on tiles that lie entirely outside the nonzero mask computed
+        # during preprocessing (crop_to_nonzero). These tiles are filled with background logits instead
+        self.skip_background_tiles = skip_background_tiles
+        # coarse_to_fine first predicts the image downsampled by coarse_downsampling_factor. Only full resolution tiles
+        # that overlap the predicted foreground (dilated by coarse_roi_margin full resolution voxels) are predicted,
+        # all others are filled with background logits just like with skip_background_tiles
+        assert coarse_downsampling_factor >= 1, 'coarse_downsampling_factor must be >= 1'
+        self.coarse_to_fine = coarse_to_fine
+        self.coarse_downsampling_factor = coarse_downsampling_factor
+        self.coarse_roi_margin = coarse_roi_margin
+        # streaming_export never holds the logits of the entire image. Tiles are predicted in the order of their
+        # position along the first axis and every part of the image is resampled and converted to a segmentation as
+        # soon as no remaining tile overlaps it. Not compatible with save_probabilities
+        self.streaming_export = streaming_export
+        # the gaussian, the sliding window slicers and the normalization map (1 / n_predictions) only depend on
+        # (patch_size, padded image shape, tile_step_size, device) and are kept for the sliding_window_cache_size most
+        # recently used image shapes (the normalization map only if results are on the CPU). Set to 0 to disable
+        assert sliding_window_cache_size >= 0, 'sliding_window_cache_size must be >= 0'
+        self.sliding_window_cache_size = sliding_window_cache_size
+        self.sliding_window_cache = OrderedDict()
+        # filled by predict_from_data_iterator
+        self.pipeline_stats = None
+        # preprocessing workers hand over the preprocessed images in shared memory blocks instead of pickling them
+        # through the queue. Make sure /dev/shm is large enough (docker defaults to 64MB!)
+        self.shared_memory_transport = shared_memory_transport
+        # rewrite every ACSConv of a trained network (and the fold weights) into an equivalent nn.Conv3d when
+        # initializing from a model folder. The result is checked against the ACSConv network once
+        self.acsconv_to_conv3d = acsconv_to_conv3d
 
     def initialize_from_trained_model_folder(self, model_training_output_dir: str,
                                              use_folds: Union[Tuple[Union[int, str]], None],
@@ -137,10 +199,14 @@ class nnUNetPredictor(object):
                 network = get_network_from_plans(plans_manager, dataset_json, configuration_manager,
                                                 num_input_channels, deep_supervision=False, 
                                                 custom_network_config_path=self.custom_network_config_path)
+        if self.acsconv_to_conv3d:
+            network, parameters = convert_acsconv_network_to_conv3d(
+                network, parameters, check_input_size=(num_input_channels, *configuration_manager.patch_size))
         self.plans_manager = plans_manager
         self.configuration_manager = configuration_manager
         self.list_of_parameters = parameters
         self.network = network
+        self.fold_ensemble = None
         self.dataset_json = dataset_json
         self.trainer_name = trainer_name
         self.allowed_mirroring_axes = inference_allowed_mirroring_axes
@@ -161,6 +227,7 @@ class nnUNetPredictor(object):
         self.configuration_manager = configuration_manager
         self.list_of_parameters = parameters
         self.network = network
+        self.fold_ensemble = None
         self.dataset_json = dataset_json
         self.trainer_name = trainer_name
         self.allowed_mirroring_axes = inference_allowed_mirroring_axes
@@ -293,7 +360,8 @@ class nnUNetPredictor(object):
         return preprocessing_iterator_fromfiles(input_list_of_lists, seg_from_prev_stage_files,
                                                 output_filenames_truncated, self.plans_manager, self.dataset_json,
                                                 self.configuration_manager, num_processes, self.device.type == 'cuda',
-                                                self.verbose_preprocessing)
+                                                self.verbose_preprocessing, self.skip_background_tiles,
+                                                self.shared_memory_transport)
         # preprocessor = self.configuration_manager.preprocessor_class(verbose=self.verbose_preprocessing)
         # # hijack batchgenerators, yo
         # # we use the multiprocessing of the batchgenerators dataloader to handle all the background worker stuff. This
@@ -342,7 +410,9 @@ class nnUNetPredictor(object):
             self.configuration_manager,
             num_processes,
             self.device.type == 'cuda',
-            self.verbose_preprocessing
+            self.verbose_preprocessing,
+            self.skip_background_tiles,
+            self.shared_memory_transport
         )
 
         return pp
@@ -372,17 +442,18 @@ class nnUNetPredictor(object):
         """
         each element returned by data_iterator must be a dict with 'data', 'ofile' and 'data_properites' keys!
         If 'ofile' is None, the result will be returned instead of written to a file
+
+        Fetching the next case, predicting and exporting run concurrently. The time spent in each stage is printed at
+        the end and stored in self.pipeline_stats (see PipelineStats.summary)
         """
+        stats = PipelineStats()
+        use_streaming_export = self._internal_use_streaming_export(save_probabilities)
         with multiprocessing.get_context("spawn").Pool(num_processes_segmentation_export) as export_pool:
-            worker_list = [i for i in export_pool._pool]
-            r = []
-            for preprocessed in data_iterator:
+            # let's not get into a runaway situation where the GPU predicts so fast that the disk has to b swamped with
+            # npy files. export_queue.acquire_slot blocks while too many exports are pending
+            export_queue = BoundedExportQueue(export_pool, stats, allowed_num_queued=2)
+            for preprocessed in prefetch_iterator(data_iterator, stats, transform=self._internal_load_preprocessed):
                 data = preprocessed['data']
-                if isinstance(data, str):
-                    delfile = data
-                    data = torch.from_numpy(np.load(data))
-                    os.remove(delfile)
-
                 ofile = preprocessed['ofile']
                 if ofile is not None:
                     print(f'\nPredicting {os.path.basename(ofile)}:')
@@ -392,59 +463,73 @@ class nnUNetPredictor(object):
                 print(f'perform_everything_on_gpu: {self.perform_everything_on_gpu}')
 
                 properties = preprocessed['data_properites']
+                nonzero_mask = preprocessed.get('nonzero_mask')
+
+                # wait for a free export slot before predicting, otherwise the result would wait for one in RAM
+                export_queue.acquire_slot()
+                predict_start = time()
+                if use_streaming_export:
+                    segmentation = self.predict_segmentation_streaming(data, properties, nonzero_mask)
+                    stats.add('predict', predict_start, time())
+                    if ofile is not None:
+                        print('sending off segmentation to background worker for export')
+                        export_queue.submit(export_segmentation,
+                                            (segmentation, properties, self.plans_manager, self.dataset_json, ofile))
+                    else:
+                        print('sending off segmentation to background worker for reverting the cropping')
+                        export_queue.submit(revert_cropping_and_transpose_segmentation,
+                                            (segmentation, self.plans_manager, self.label_manager, properties))
+                    print(f'done with {os.path.basename(ofile) if ofile is not None else data.shape}')
+                    continue
 
-                # let's not get into a runaway situation where the GPU predicts so fast that the disk has to b swamped with
-                # npy files
-                proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
-                while not proceed:
-                    # print('sleeping')
-                    sleep(0.1)
-                    proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
-
-                prediction = self.predict_logits_from_preprocessed_data(data).cpu()
+                prediction = self.predict_logits_from_preprocessed_data(data, nonzero_mask).cpu()
+                stats.add('predict', predict_start, time())
 
                 if ofile is not None:
                     # this needs to go into background processes
                     # export_prediction_from_logits(prediction, properties, configuration_manager, plans_manager,
                     #                               dataset_json, ofile, save_probabilities)
                     print('sending off prediction to background worker for resampling and export')
-                    r.append(
-                        export_pool.starmap_async(
-                            export_prediction_from_logits,
-                            ((prediction, properties, self.configuration_manager, self.plans_manager,
-                              self.dataset_json, ofile, save_probabilities),)
-                        )
-                    )
+                    export_queue.submit(export_prediction_from_logits,
+                                        (prediction, properties, self.configuration_manager, self.plans_manager,
+                                         self.dataset_json, ofile, save_probabilities))
                 else:
                     # convert_predicted_logits_to_segmentation_with_correct_shape(prediction, plans_manager,
                     #                                                             configuration_manager, label_manager,
                     #                                                             properties,
                     #                                                             save_probabilities)
                     print('sending off prediction to background worker for resampling')
-                    r.append(
-                        export_pool.starmap_async(
-                            convert_predicted_logits_to_segmentation_with_correct_shape, (
-                                (prediction, self.plans_manager,
-                                 self.configuration_manager, self.label_manager,
-                                 properties,
-                                 save_probabilities),)
-                        )
-                    )
+                    export_queue.submit(convert_predicted_logits_to_segmentation_with_correct_shape,
+                                        (prediction, self.plans_manager, self.configuration_manager,
+                                         self.label_manager, properties, save_probabilities))
                 if ofile is not None:
                     print(f'done with {os.path.basename(ofile)}')
                 else:
                     print(f'\nDone with image of shape {data.shape}:')
-            ret = [i.get()[0] for i in r]
+            ret = export_queue.get_results()
+        stats.stop()
+        self.pipeline_stats = stats.summary(num_processes_segmentation_export)
+        stats.print_summary(num_processes_segmentation_export)
 
         if isinstance(data_iterator, MultiThreadedAugmenter):
             data_iterator._finish()
 
         # clear lru cache
         compute_gaussian.cache_clear()
+        self.sliding_window_cache.clear()
         # clear device cache
         empty_cache(self.device)
         return ret
 
+    @staticmethod
+    def _internal_load_preprocessed(preprocessed: dict) -> dict:
+        # the data iterators may hand over large cases as path to a temporary npy file
+        if isinstance(preprocessed['data'], str):
+            delfile = preprocessed['data']
+            preprocessed['data'] = torch.from_numpy(np.load(delfile))
+            os.remove(delfile)
+        return preprocessed
+
     def predict_single_npy_array(self, input_image: np.ndarray, image_properties: dict,
                                  segmentation_previous_stage: np.ndarray = None,
                                  output_file_truncated: str = None,
@@ -455,14 +540,24 @@ class nnUNetPredictor(object):
         ppa = PreprocessAdapterFromNpy([input_image], [segmentation_previous_stage], [image_properties],
                                        [output_file_truncated],
                                        self.plans_manager, self.dataset_json, self.configuration_manager,
-                                       num_threads_in_multithreaded=1, verbose=self.verbose)
+                                       num_threads_in_multithreaded=1, verbose=self.verbose,
+                                       return_nonzero_mask=self.skip_background_tiles)
         if self.verbose:
             print('preprocessing')
         dct = next(ppa)
 
         if self.verbose:
             print('predicting')
-        predicted_logits = self.predict_logits_from_preprocessed_data(dct['data']).cpu()
+        if self._internal_use_streaming_export(save_or_return_probabilities):
+            segmentation = self.predict_segmentation_streaming(dct['data'], dct['data_properites'],
+                                                               dct.get('nonzero_mask'))
+            if output_file_truncated is not None:
+                export_segmentation(segmentation, dct['data_properites'], self.plans_manager, self.dataset_json,
+                                    output_file_truncated)
+                return
+            return revert_cropping_and_transpose_segmentation(segmentation, self.plans_manager, self.label_manager,
+                                                              dct['data_properites'])
+        predicted_logits = self.predict_logits_from_preprocessed_data(dct['data'], dct.get('nonzero_mask')).cpu()
 
         if self.verbose:
             print('resampling to original shape')
@@ -482,15 +577,18 @@ class nnUNetPredictor(object):
             else:
                 return ret
 
-    def predict_logits_from_preprocessed_data(self, data: torch.Tensor) -> torch.Tensor:
+    def predict_logits_from_preprocessed_data(self, data: torch.Tensor,
+                                              nonzero_mask: Optional[torch.Tensor] = None) -> torch.Tensor:
         """
         IMPORTANT! IF YOU ARE RUNNING THE CASCADE, THE SEGMENTATION FROM THE PREVIOUS STAGE MUST ALREADY BE STACKED ON
         TOP OF THE IMAGE AS ONE-HOT REPRESENTATION! SEE PreprocessAdapter ON HOW THIS SHOULD BE DONE!
 
         RETURNED LOGITS HAVE THE SHAPE OF THE INPUT. THEY MUST BE CONVERTED BACK TO THE ORIGINAL IMAGE SIZE.
         SEE convert_predicted_logits_to_segmentation_with_correct_shape
+
+        nonzero_mask (optional, shape of data without the channel axis) is only used if skip_background_tiles is set
         """
-        # we have some code duplication here but this allows us to run with perform_everything_on_gpu=True as
+        # trying perform_everything_on_gpu=True first and repeating with False if that fails allows us to run with it as
         # default and not have the entire program crash in case of GPU out of memory. Neat. That should make
         # things a lot faster for some datasets.
         original_perform_everything_on_gpu = self.perform_everything_on_gpu
@@ -498,21 +596,7 @@ class nnUNetPredictor(object):
             prediction = None
             if self.perform_everything_on_gpu:
                 try:
-                    for params in self.list_of_parameters:
-
-                        # messing with state dict names...
-                        if not isinstance(self.network, OptimizedModule):
-                            self.network.load_state_dict(params)
-                        else:
-                            self.network._orig_mod.load_state_dict(params)
-
-                        if prediction is None:
-                            prediction = self.predict_sliding_window_return_logits(data)
-                        else:
-                            prediction += self.predict_sliding_window_return_logits(data)
-
-                    if len(self.list_of_parameters) > 1:
-                        prediction /= len(self.list_of_parameters)
+                    prediction = self._internal_predict_all_folds(data, nonzero_mask)
 
                 except RuntimeError:
                     print('Prediction with perform_everything_on_gpu=True failed due to insufficient GPU memory. '
@@ -523,25 +607,109 @@ class nnUNetPredictor(object):
                     self.perform_everything_on_gpu = False
 
             if prediction is None:
-                for params in self.list_of_parameters:
-                    # messing with state dict names...
-                    if not isinstance(self.network, OptimizedModule):
-                        self.network.load_state_dict(params)
-                    else:
-                        self.network._orig_mod.load_state_dict(params)
-
-                    if prediction is None:
-                        prediction = self.predict_sliding_window_return_logits(data)
-                    else:
-                        prediction += self.predict_sliding_window_return_logits(data)
-                if len(self.list_of_parameters) > 1:
-                    prediction /= len(self.list_of_parameters)
+                prediction = self._internal_predict_all_folds(data, nonzero_mask)
 
             print('Prediction done, transferring to CPU if needed')
             prediction = prediction.to('cpu')
             self.perform_everything_on_gpu = original_perform_everything_on_gpu
         return prediction
 
+    def _internal_get_fold_ensemble(self) -> FoldEnsembleNetwork:
+        if self.fold_ensemble is None:
+            self.fold_ensemble = FoldEnsembleNetwork(self.network, self.list_of_parameters)
+        return self.fold_ensemble
+
+    def _internal_predict_all_folds(self, data: torch.Tensor,
+                                    nonzero_mask: Optional[torch.Tensor] = None) -> torch.Tensor:
+        if self.keep_folds_resident:
+            # predict_sliding_window_return_logits works on self.network, so we swap in the ensemble
+            network = self.network
+            self.network = self._internal_get_fold_ensemble()
+            try:
+                return self.predict_sliding_window_return_logits(data, nonzero_mask)
+            finally:
+                self.network = network
+
+        prediction = None
+        for params in self.list_of_parameters:
+            # messing with state dict names...
+            if not isinstance(self.network, OptimizedModule):
+                self.network.load_state_dict(params)
+            else:
+                self.network._orig_mod.load_state_dict(params)
+
+            if prediction is None:
+                prediction = self.predict_sliding_window_return_logits(data, nonzero_mask)
+            else:
+                prediction += self.predict_sliding_window_return_logits(data, nonzero_mask)
+        if len(self.list_of_parameters) > 1:
+            prediction /= len(self.list_of_parameters)
+        return prediction
+
+    def _internal_use_streaming_export(self, save_probabilities: bool) -> bool:
+        """streaming_export unless probabilities are needed or the configuration's resampling cannot be streamed"""
+        if not self.streaming_export or save_probabilities:
+            return False
+        if not StreamingSegmentationExporter.is_supported(self.configuration_manager):
+            warnings.warn('streaming_export only supports resample_data_or_seg_to_shape with resampling orders 0 and '
+                          '1 as resampling_fn_probabilities. Falling back to the regular sliding window prediction '
+                          'and export')
+            return False
+        return True
+
+    def predict_segmentation_streaming(self, data: torch.Tensor, properties: dict,
+                                       nonzero_mask: Optional[torch.Tensor] = None) -> np.ndarray:
+        """
+        Low memory alternative to predict_logits_from_preprocessed_data followed by
+        convert_predicted_logits_to_segmentation_with_correct_shape. See StreamingSegmentationExporter.
+
+        RETURNS THE SEGMENTATION IN shape_after_cropping_and_before_resampling. USE export_segmentation OR
+        revert_cropping_and_transpose_segmentation TO GET THE FINAL RESULT.
+
+        Multiple folds are always ensembled per tile (as with keep_folds_resident) because the logits of the entire
+        image are never available.
+        """
+        # same GPU out of memory fallback as in predict_logits_from_preprocessed_data
+        original_perform_everything_on_gpu = self.perform_everything_on_gpu
+        segmentation = None
+        if self.perform_everything_on_gpu:
+            try:
+                segmentation = self._internal_predict_segmentation_streaming(data, properties, nonzero_mask)
+            except torch.cuda.OutOfMemoryError:
+                print('Streaming prediction with perform_everything_on_gpu=True failed due to insufficient GPU '
+                      'memory. Falling back to perform_everything_on_gpu=False. Not a big deal, just slower...')
+                print('Error:')
+                traceback.print_exc()
+                segmentation = None
+                self.perform_everything_on_gpu = False
+                empty_cache(self.device)
+        try:
+            if segmentation is None:
+                segmentation = self._internal_predict_segmentation_streaming(data, properties, nonzero_mask)
+        finally:
+            self.perform_everything_on_gpu = original_perform_everything_on_gpu
+        return segmentation
+
+    def _internal_predict_segmentation_streaming(self, data: torch.Tensor, properties: dict,
+                                                 nonzero_mask: Optional[torch.Tensor] = None) -> np.ndarray:
+        exporter = StreamingSegmentationExporter(data.shape[1:], self.configuration_manager, self.label_manager,
+                                                 properties)
+        with torch.no_grad():
+            if len(self.list_of_parameters) > 1 or self.keep_folds_resident:
+                network = self.network
+                self.network = self._internal_get_fold_ensemble()
+                try:
+                    self._internal_predict_sliding_window_streaming(data, exporter, nonzero_mask)
+                finally:
+                    self.network = network
+            else:
+                if not isinstance(self.network, OptimizedModule):
+                    self.network.load_state_dict(self.list_of_parameters[0])
+                else:
+                    self.network._orig_mod.load_state_dict(self.list_of_parameters[0])
+                self._internal_predict_sliding_window_streaming(data, exporter, nonzero_mask)
+        return exporter.get_segmentation()
+
     def _internal_get_sliding_window_slicers(self, image_size: Tuple[int, ...]):
         slicers = []
         if len(self.configuration_manager.patch_size) < len(image_size):
@@ -576,8 +744,136 @@ class nnUNetPredictor(object):
                                                   zip((sx, sy, sz), self.configuration_manager.patch_size)]]))
         return slicers
 
+    def _internal_get_sliding_window_setup(self, padded_shape: Tuple[int, ...], results_device: torch.device,
+                                           with_normalization: bool = True) -> dict:
+        """
+        returns a dict with the sliding window 'slicers', the 'gaussian' (None if use_gaussian is False) and, if
+        with_normalization, 'n_predictions_reciprocal' (float32, padded_shape, on results_device). Entries are cached
+        for the sliding_window_cache_size most recently used shapes.
+
+        The normalization map does not depend on which tiles are skipped, because background tiles are weighted just
+        like predicted tiles. It is as large as the image, so it is only cached for results on the CPU. On the GPU it
+        is rebuilt for every image (cheap there) and does not hold on to GPU memory between cases.
+        """
+        key = (tuple(self.configuration_manager.patch_size), tuple(padded_shape), self.tile_step_size,
+               self.use_gaussian, results_device)
+        if key in self.sliding_window_cache:
+            self.sliding_window_cache.move_to_end(key)
+            setup = self.sliding_window_cache[key]
+        else:
+            setup = {
+                'slicers': self._internal_get_sliding_window_slicers(padded_shape),
+                'gaussian': compute_gaussian(tuple(self.configuration_manager.patch_size), sigma_scale=1. / 8,
+                                             value_scaling_factor=1000, device=results_device)
+                if self.use_gaussian else None,
+                'n_predictions_reciprocal': None
+            }
+            if self.sliding_window_cache_size > 0:
+                self.sliding_window_cache[key] = setup
+                while len(self.sliding_window_cache) > self.sliding_window_cache_size:
+                    self.sliding_window_cache.popitem(last=False)
+
+        if with_normalization and setup['n_predictions_reciprocal'] is None:
+            n_predictions = torch.zeros(padded_shape, dtype=torch.half, device=results_device)
+            for sl in setup['slicers']:
+                n_predictions[sl[1:]] += (setup['gaussian'] if self.use_gaussian else 1)
+            n_predictions_reciprocal = 1 / n_predictions.float()
+            del n_predictions
+            if results_device.type == 'cpu':
+                setup['n_predictions_reciprocal'] = n_predictions_reciprocal
+            else:
+                setup = {**setup, 'n_predictions_reciprocal': n_predictions_reciprocal}
+        return setup
+
+    def _internal_get_foreground_and_background_slicers(self, input_image: torch.Tensor, slicers: List[Tuple],
+                                                        padded_shape: Tuple[int, ...], slicer_revert_padding: Tuple,
+                                                        nonzero_mask: Optional[torch.Tensor] = None) \
+            -> Tuple[List[Tuple], List[Tuple]]:
+        """
+        returns (slicers of the tiles that need to be predicted, slicers of the tiles that are filled with background).
+        The latter is only populated with skip_background_tiles or coarse_to_fine
+        """
+        background_slicers = []
+        tile_mask = None
+        if self.skip_background_tiles and nonzero_mask is not None:
+            assert nonzero_mask.shape == input_image.shape[1:], 'nonzero_mask must have the shape of ' \
+                                                                'input_image without the channel axis'
+            tile_mask = nonzero_mask.to(device='cpu', dtype=torch.bool)
+        if self.coarse_to_fine:
+            roi = self._internal_get_coarse_roi(input_image).cpu()
+            tile_mask = roi if tile_mask is None else (tile_mask & roi)
+        if tile_mask is not None:
+            slicers, background_slicers = self._internal_split_background_slicers(
+                slicers, tile_mask, padded_shape, slicer_revert_padding)
+            if self.verbose: print(f'skipping {len(background_slicers)} out of '
+                                   f'{len(slicers) + len(background_slicers)} tiles without foreground')
+        return slicers, background_slicers
+
+    @staticmethod
+    def _internal_split_background_slicers(slicers: List[Tuple], mask: torch.Tensor,
+                                           padded_shape: Tuple[int, ...], slicer_revert_padding: Tuple) \
+            -> Tuple[List[Tuple], List[Tuple]]:
+        """
+        returns (slicers of tiles that contain at least one voxel of mask, all other slicers)
+        """
+        # mask has the shape of the unpadded image. Everything that was padded is background
+        padded_mask = torch.zeros(padded_shape, dtype=torch.bool)
+        padded_mask[tuple(slicer_revert_padding[1:])] = mask.to(device='cpu', dtype=torch.bool)
+        foreground_slicers, background_slicers = [], []
+        for sl in slicers:
+            if padded_mask[sl[1:]].any():
+                foreground_slicers.append(sl)
+            else:
+                background_slicers.append(sl)
+        return foreground_slicers, background_slicers
+
+    def _internal_get_coarse_roi(self, input_image: torch.Tensor) -> torch.Tensor:
+        """
+        Predicts input_image (c, x, y, z) downsampled by coarse_downsampling_factor (without mirroring) and returns a
+        boolean mask (x, y, z) of the predicted foreground, dilated by coarse_roi_margin voxels and upsampled to the
+        shape of input_image. For 2d configurations the first spatial axis is not downsampled.
+        """
+        num_patch_dims = len(self.configuration_manager.patch_size)
+        full_shape = input_image.shape[1:]
+        coarse_shape = [*full_shape[:len(full_shape) - num_patch_dims],
+                        *[max(1, int(round(i / self.coarse_downsampling_factor)))
+                          for i in full_shape[len(full_shape) - num_patch_dims:]]]
+        coarse_image = F.interpolate(input_image[None].float(), size=coarse_shape, mode='trilinear')[0]
+
+        # predict_sliding_window_return_logits does all the padding, tiling and gaussian weighting for us
+        use_mirroring, coarse_to_fine = self.use_mirroring, self.coarse_to_fine
+        self.use_mirroring, self.coarse_to_fine = False, False
+        try:
+            coarse_logits = self.predict_sliding_window_return_logits(coarse_image)
+        finally:
+            self.use_mirroring, self.coarse_to_fine = use_mirroring, coarse_to_fine
+
+        roi = (self.label_manager.convert_logits_to_segmentation(coarse_logits.float()) > 0).float()
+        margin = int(np.ceil(self.coarse_roi_margin / self.coarse_downsampling_factor))
+        if margin > 0:
+            roi = F.max_pool3d(roi[None, None], kernel_size=2 * margin + 1, stride=1, padding=margin)[0, 0]
+        roi = F.interpolate(roi[None, None], size=list(full_shape), mode='nearest')[0, 0] > 0
+        if self.verbose: print(f'coarse roi covers {roi.float().mean().item() * 100:.1f}% of the image')
+        return roi
+
+    def _internal_get_background_logits(self, device: torch.device) -> torch.Tensor:
+        """
+        Logits that are written into tiles that are not predicted because they contain no foreground input. For
+        regions all heads are negative (sigmoid -> 0), otherwise the background class (label 0) wins the argmax
+        """
+        background_logit = 10
+        logits = torch.full((self.label_manager.num_segmentation_heads,
+                             *[1] * len(self.configuration_manager.patch_size)), -background_logit,
+                            dtype=torch.half, device=device)
+        if not self.label_manager.has_regions:
+            logits[0] = background_logit
+        return logits
+
     def _internal_maybe_mirror_and_predict(self, x: torch.Tensor) -> torch.Tensor:
         mirror_axes = self.allowed_mirroring_axes if self.use_mirroring else None
+        if mirror_axes is not None and self.batched_mirroring:
+            return self._internal_batched_mirror_and_predict(x, mirror_axes)
+
         prediction = self.network(x)
 
         if mirror_axes is not None:
@@ -603,11 +899,58 @@ class nnUNetPredictor(object):
             prediction /= num_predictons
         return prediction
 
-    def predict_sliding_window_return_logits(self, input_image: torch.Tensor) \
+    def _internal_batched_mirror_and_predict(self, x: torch.Tensor, mirror_axes: Tuple[int, ...]) -> torch.Tensor:
+        """
+        Same result as _internal_maybe_mirror_and_predict, but the mirrored variants of x are concatenated along the
+        batch dimension and predicted with as few network calls as max_mirror_batch_size allows. Outputs are
+        un-flipped and summed in the same order as in the sequential implementation.
+        """
+        assert max(mirror_axes) <= len(x.shape) - 3, 'mirror_axes does not match the dimension of the input!'
+
+        # () is the unflipped input. The remaining order matches the sequential implementation
+        flip_dims = [()] + [tuple(i + 2 for i in c) for n in range(1, len(mirror_axes) + 1)
+                            for c in itertools.combinations(sorted(mirror_axes), n)]
+        num_samples = x.shape[0]
+
+        prediction = None
+        start = 0
+        while start < len(flip_dims):
+            variants_per_chunk = max(1, self._case_max_mirror_batch_size // num_samples)
+            chunk = flip_dims[start:start + variants_per_chunk]
+            try:
+                chunk_prediction = self.network(torch.cat([torch.flip(x, d) if len(d) > 0 else x for d in chunk]))
+            except torch.cuda.OutOfMemoryError:
+                if len(chunk) == 1:
+                    raise
+                # the remaining tiles of this image use the smaller chunks, the next image starts again from
+                # max_mirror_batch_size
+                self._case_max_mirror_batch_size = max(1, (len(chunk) * num_samples) // 2)
+                print(f'Batched mirroring ran out of memory, reducing the mirror batch size to '
+                      f'{self._case_max_mirror_batch_size} for this image')
+                empty_cache(self.device)
+                continue
+
+            for i, d in enumerate(chunk):
+                p = chunk_prediction[i * num_samples:(i + 1) * num_samples]
+                if len(d) > 0:
+                    p = torch.flip(p, d)
+                if prediction is None:
+                    prediction = p.clone()
+                else:
+                    prediction += p
+            del chunk_prediction
+            start += len(chunk)
+
+        prediction /= len(flip_dims)
+        return prediction
+
+    def predict_sliding_window_return_logits(self, input_image: torch.Tensor,
+                                             nonzero_mask: Optional[torch.Tensor] = None) \
             -> Union[np.ndarray, torch.Tensor]:
         assert isinstance(input_image, torch.Tensor)
         self.network = self.network.to(self.device)
         self.network.eval()
+        self._case_max_mirror_batch_size = self.max_mirror_batch_size
 
         empty_cache(self.device)
 
@@ -630,9 +973,7 @@ class nnUNetPredictor(object):
                                                            'constant', {'value': 0}, True,
                                                            None)
 
-                slicers = self._internal_get_sliding_window_slicers(data.shape[1:])
-
-                # preallocate results and num_predictions
+                # preallocate results. gaussian, slicers and the normalization map come from the cache
                 results_device = self.device if self.perform_everything_on_gpu else torch.device('cpu')
                 if self.verbose: print('preallocating arrays')
                 try:
@@ -640,12 +981,7 @@ class nnUNetPredictor(object):
                     predicted_logits = torch.zeros((self.label_manager.num_segmentation_heads, *data.shape[1:]),
                                                    dtype=torch.half,
                                                    device=results_device)
-                    n_predictions = torch.zeros(data.shape[1:], dtype=torch.half,
-                                                device=results_device)
-                    if self.use_gaussian:
-                        gaussian = compute_gaussian(tuple(self.configuration_manager.patch_size), sigma_scale=1. / 8,
-                                                    value_scaling_factor=1000,
-                                                    device=results_device)
+                    setup = self._internal_get_sliding_window_setup(data.shape[1:], results_device)
                 except RuntimeError:
                     # sometimes the stuff is too large for GPUs. In that case fall back to CPU
                     results_device = torch.device('cpu')
@@ -653,29 +989,131 @@ class nnUNetPredictor(object):
                     predicted_logits = torch.zeros((self.label_manager.num_segmentation_heads, *data.shape[1:]),
                                                    dtype=torch.half,
                                                    device=results_device)
-                    n_predictions = torch.zeros(data.shape[1:], dtype=torch.half,
-                                                device=results_device)
-                    if self.use_gaussian:
-                        gaussian = compute_gaussian(tuple(self.configuration_manager.patch_size), sigma_scale=1. / 8,
-                                                    value_scaling_factor=1000,
-                                                    device=results_device)
+                    setup = self._internal_get_sliding_window_setup(data.shape[1:], results_device)
                 finally:
                     empty_cache(self.device)
+                gaussian = setup['gaussian']
+
+                slicers, background_slicers = self._internal_get_foreground_and_background_slicers(
+                    input_image, setup['slicers'], data.shape[1:], slicer_revert_padding, nonzero_mask)
+
+                if self.verbose: print(f'running prediction with tile_batch_size {self.tile_batch_size}')
+                with tqdm(total=len(slicers), disable=not self.allow_tqdm) as pbar:
+                    for start in range(0, len(slicers), self.tile_batch_size):
+                        batch_slicers = slicers[start:start + self.tile_batch_size]
+                        workon = torch.stack([data[sl] for sl in batch_slicers])
+                        workon = workon.to(self.device, non_blocking=False)
 
-                if self.verbose: print('running prediction')
-                for sl in tqdm(slicers, disable=not self.allow_tqdm):
-                    workon = data[sl][None]
-                    workon = workon.to(self.device, non_blocking=False)
+                        prediction = self._internal_maybe_mirror_and_predict(workon).to(results_device)
 
-                    prediction = self._internal_maybe_mirror_and_predict(workon)[0].to(results_device)
+                        # accumulate tile by tile in the original order so that the result is identical to
+                        # tile_batch_size=1
+                        for b, sl in enumerate(batch_slicers):
+                            predicted_logits[sl] += (prediction[b] * gaussian if self.use_gaussian else prediction[b])
+                        pbar.update(len(batch_slicers))
 
-                    predicted_logits[sl] += (prediction * gaussian if self.use_gaussian else prediction)
-                    n_predictions[sl[1:]] += (gaussian if self.use_gaussian else 1)
+                if len(background_slicers) > 0:
+                    background_logits = self._internal_get_background_logits(results_device)
+                    if self.use_gaussian:
+                        background_logits = background_logits * gaussian
+                    for sl in background_slicers:
+                        predicted_logits[sl] += background_logits
 
-                predicted_logits /= n_predictions
+                predicted_logits *= setup['n_predictions_reciprocal']
         empty_cache(self.device)
         return predicted_logits[tuple([slice(None), *slicer_revert_padding[1:]])]
 
+    def _internal_predict_sliding_window_streaming(self, input_image: torch.Tensor,
+                                                   exporter: StreamingSegmentationExporter,
+                                                   nonzero_mask: Optional[torch.Tensor] = None) -> None:
+        """
+        Same as predict_sliding_window_return_logits, but logits are only accumulated in a buffer that spans one tile
+        along the first axis. Tiles are processed in the order of their position along that axis, so everything in
+        front of the current tile is final and is handed to the exporter.
+        """
+        assert isinstance(input_image, torch.Tensor)
+        self.network = self.network.to(self.device)
+        self.network.eval()
+        self._case_max_mirror_batch_size = self.max_mirror_batch_size
+
+        empty_cache(self.device)
+
+        with torch.no_grad():
+            with torch.autocast(self.device.type, enabled=True) if self.device.type == 'cuda' else dummy_context():
+                assert len(input_image.shape) == 4, 'input_image must be a 4D np.ndarray or torch.Tensor (c, x, y, z)'
+
+                data, slicer_revert_padding = pad_nd_image(input_image, self.configuration_manager.patch_size,
+                                                           'constant', {'value': 0}, True,
+                                                           None)
+                results_device = self.device if self.perform_everything_on_gpu else torch.device('cpu')
+                # the normalization map would be as large as the image, so n_predictions is accumulated in the buffer
+                setup = self._internal_get_sliding_window_setup(data.shape[1:], results_device,
+                                                                with_normalization=False)
+                gaussian = setup['gaussian']
+                slicers, background_slicers = self._internal_get_foreground_and_background_slicers(
+                    input_image, setup['slicers'], data.shape[1:], slicer_revert_padding, nonzero_mask)
+
+                # for 2d configurations the slicers index the first axis with an int (one slice per tile)
+                is_2d = len(self.configuration_manager.patch_size) < len(data.shape[1:])
+                tile_extent = 1 if is_2d else self.configuration_manager.patch_size[0]
+                first_axis_start = lambda sl: sl[1] if is_2d else sl[1].start
+                # sorting is stable, so tiles with the same start keep their original order
+                tiles = sorted([(sl, False) for sl in slicers] + [(sl, True) for sl in background_slicers],
+                               key=lambda t: first_axis_start(t[0]))
+
+                data = data.to(self.device)
+                buffer_shape = (tile_extent, *data.shape[2:])
+                predicted_logits = torch.zeros((self.label_manager.num_segmentation_heads, *buffer_shape),
+                                               dtype=torch.half, device=results_device)
+                n_predictions = torch.zeros(buffer_shape, dtype=torch.half, device=results_device)
+                if len(background_slicers) > 0:
+                    background_logits = self._internal_get_background_logits(results_device)
+                    if self.use_gaussian:
+                        background_logits = background_logits * gaussian
+
+                valid_first_axis = slicer_revert_padding[1]
+                buffer_start = 0
+
+                def flush(until: int):
+                    # rows [buffer_start, until) of the padded image are final
+                    nonlocal buffer_start
+                    n = until - buffer_start
+                    if n <= 0:
+                        return
+                    lower, upper = max(buffer_start, valid_first_axis.start), min(until, valid_first_axis.stop)
+                    if upper > lower:
+                        rows = predicted_logits[:, lower - buffer_start:upper - buffer_start] / \
+                               n_predictions[lower - buffer_start:upper - buffer_start]
+                        exporter.add_chunk(rows[tuple([slice(None), slice(None), *slicer_revert_padding[2:]])])
+                    predicted_logits[:, :tile_extent - n] = predicted_logits[:, n:].clone()
+                    predicted_logits[:, tile_extent - n:] = 0
+                    n_predictions[:tile_extent - n] = n_predictions[n:].clone()
+                    n_predictions[tile_extent - n:] = 0
+                    buffer_start = until
+
+                if self.verbose: print(f'running streaming prediction with tile_batch_size {self.tile_batch_size}')
+                for start in tqdm(range(0, len(tiles), self.tile_batch_size), disable=not self.allow_tqdm):
+                    batch = tiles[start:start + self.tile_batch_size]
+                    foreground = [sl for sl, is_background in batch if not is_background]
+                    if len(foreground) > 0:
+                        workon = torch.stack([data[sl] for sl in foreground]).to(self.device, non_blocking=False)
+                        prediction = self._internal_maybe_mirror_and_predict(workon).to(results_device)
+                    foreground_ctr = 0
+                    for sl, is_background in batch:
+                        flush(first_axis_start(sl))
+                        offset = first_axis_start(sl) - buffer_start
+                        local_sl = tuple([slice(None),
+                                          offset if is_2d else slice(offset, offset + tile_extent), *sl[2:]])
+                        if is_background:
+                            predicted_logits[local_sl] += background_logits
+                        else:
+                            p = prediction[foreground_ctr]
+                            foreground_ctr += 1
+                            predicted_logits[local_sl] += (p * gaussian if self.use_gaussian else p)
+                        n_predictions[local_sl[1:]] += (gaussian if self.use_gaussian else 1)
+                flush(data.shape[1])
+        empty_cache(self.device)
+
 
 def predict_entry_point_modelfolder():
     import argparse
@@ -698,9 +1136,44 @@ def predict_entry_point_modelfolder():
     parser.add_argument('-step_size', type=float, required=False, default=0.5,
                         help='Step size for sliding window prediction. The larger it is the faster but less accurate '
                              'the prediction. Default: 0.5. Cannot be larger than 1. We recommend the default.')
+    parser.add_argument('-tile_batch_size', type=int, required=False, default=1,
+                        help='Number of sliding window tiles that are predicted together in one forward pass. Larger '
+                             'values keep the device busier but need more memory. Default: 1')
     parser.add_argument('--disable_tta', action='store_true', required=False, default=False,
                         help='Set this flag to disable test time data augmentation in the form of mirroring. Faster, '
                              'but less accurate inference. Not recommended.')
+    parser.add_argument('--batched_tta', action='store_true', required=False, default=False,
+                        help='Set this flag to predict all mirrored test time augmentation variants of a tile in one '
+                             'forward pass instead of one after the other. Faster, but needs more memory.')
+    parser.add_argument('-max_tta_batch_size', type=int, required=False, default=8,
+                        help='Only used with --batched_tta. Maximum number of network inputs (tiles x mirrored '
+                             'variants) per forward pass. Reduced automatically if memory runs out. Default: 8')
+    parser.add_argument('--keep_folds_resident', action='store_true', required=False, default=False,
+                        help='Set this flag to keep one network instance per fold in memory instead of reloading the '
+                             'fold weights for every case. Faster for multi-fold ensembles, but needs more memory.')
+    parser.add_argument('--skip_background_tiles', action='store_true', required=False, default=False,
+                        help='Set this flag to skip sliding window tiles that lie entirely outside of the nonzero mask '
+                             '(for example outside the brain in skull stripped MRI). These are filled with background.')
+    parser.add_argument('--coarse_to_fine', action='store_true', required=False, default=False,
+                        help='Set this flag to first predict a downsampled version of each image and then only predict '
+                             'the full resolution tiles that overlap the (dilated) coarse foreground. Much faster if '
+                             'the structures of interest are small, but anything missed by the coarse pass is lost.')
+    parser.add_argument('-coarse_factor', type=float, required=False, default=2.,
+                        help='Only used with --coarse_to_fine. Downsampling factor of the coarse pass. Default: 2')
+    parser.add_argument('-coarse_margin', type=int, required=False, default=16,
+                        help='Only used with --coarse_to_fine. The coarse foreground is dilated by this many (full '
+                             'resolution) voxels before selecting tiles. Default: 16')
+    parser.add_argument('--streaming_export', action='store_true', required=False, default=False,
+                        help='Set this flag to never hold the logits of an entire image in memory. Parts of the image '
+                             'are resampled and converted to the segmentation as soon as they are final. Use this if '
+                             'you run out of RAM with large images. Ignored with --save_probabilities.')
+    parser.add_argument('--shared_memory_transport', action='store_true', required=False, default=False,
+                        help='Set this flag to hand preprocessed images from the preprocessing workers to the '
+                             'predictor in shared memory instead of pickling them. Requires a sufficiently large '
+                             '/dev/shm.')
+    parser.add_argument('--acsconv_to_conv3d', action='store_true', required=False, default=False,
+                        help='Set this flag to replace the ACSConv layers of the trained network with equivalent '
+                             'Conv3d layers before predicting. Faster, the result is checked once at startup.')
     parser.add_argument('--verbose', action='store_true', help="Set this if you like being talked to. You will have "
                                                                "to be a good listener/reader.")
     parser.add_argument('--save_probabilities', action='store_true',
@@ -756,7 +1229,18 @@ def predict_entry_point_modelfolder():
                                 use_mirroring=not args.disable_tta,
                                 perform_everything_on_gpu=True,
                                 device=device,
-                                verbose=args.verbose)
+                                verbose=args.verbose,
+                                tile_batch_size=args.tile_batch_size,
+                                batched_mirroring=args.batched_tta,
+                                max_mirror_batch_size=args.max_tta_batch_size,
+                                keep_folds_resident=args.keep_folds_resident,
+                                skip_background_tiles=args.skip_background_tiles,
+                                coarse_to_fine=args.coarse_to_fine,
+                                coarse_downsampling_factor=args.coarse_factor,
+                                coarse_roi_margin=args.coarse_margin,
+                                streaming_export=args.streaming_export,
+                                shared_memory_transport=args.shared_memory_transport,
+                                acsconv_to_conv3d=args.acsconv_to_conv3d)
     predictor.initialize_from_trained_model_folder(args.m, args.f, args.chk)
     predictor.predict_from_files(args.i, args.o, save_probabilities=args.save_probabilities,
                                  overwrite=not args.continue_prediction,
@@ -794,9 +1278,44 @@ def predict_entry_point():
     parser.add_argument('-step_size', type=float, required=False, default=0.5,
                         help='Step size for sliding window prediction. The larger it is the faster but less accurate '
                              'the prediction. Default: 0.5. Cannot be larger than 1. We recommend the default.')
+    parser.add_argument('-tile_batch_size', type=int, required=False, default=1,
+                        help='Number of sliding window tiles that are predicted together in one forward pass. Larger '
+                             'values keep the device busier but need more memory. Default: 1')
     parser.add_argument('--disable_tta', action='store_true', required=False, default=False,
                         help='Set this flag to disable test time data augmentation in the form of mirroring. Faster, '
                              'but less accurate inference. Not recommended.')
+    parser.add_argument('--batched_tta', action='store_true', required=False, default=False,
+                        help='Set this flag to predict all mirrored test time augmentation variants of a tile in one '
+                             'forward pass instead of one after the other. Faster, but needs more memory.')
+    parser.add_argument('-max_tta_batch_size', type=int, required=False, default=8,
+                        help='Only used with --batched_tta. Maximum number of network inputs (tiles x mirrored '
+                             'variants) per forward pass. Reduced automatically if memory runs out. Default: 8')
+    parser.add_argument('--keep_folds_resident', action='store_true', required=False, default=False,
+                        help='Set this flag to keep one network instance per fold in memory instead of reloading the '
+                             'fold weights for every case. Faster for multi-fold ensembles, but needs more memory.')
+    parser.add_argument('--skip_background_tiles', action='store_true', required=False, default=False,
+                        help='Set this flag to skip sliding window tiles that lie entirely outside of the nonzero mask '
+                             '(for example outside the brain in skull stripped MRI). These are filled with background.')
+    parser.add_argument('--coarse_to_fine', action='store_true', required=False, default=False,
+                        help='Set this flag to first predict a downsampled version of each image and then only predict '
+                             'the full resolution tiles that overlap the (dilated) coarse foreground. Much faster if '
+                             'the structures of interest are small, but anything missed by the coarse pass is lost.')
+    parser.add_argument('-coarse_factor', type=float, required=False, default=2.,
+                        help='Only used with --coarse_to_fine. Downsampling factor of the coarse pass. Default: 2')
+    parser.add_argument('-coarse_margin', type=int, required=False, default=16,
+                        help='Only used with --coarse_to_fine. The coarse foreground is dilated by this many (full '
+                             'resolution) voxels before selecting tiles. Default: 16')
+    parser.add_argument('--streaming_export', action='store_true', required=False, default=False,
+                        help='Set this flag to never hold the logits of an entire image in memory. Parts of the image '
+                             'are resampled and converted to the segmentation as soon as they are final. Use this if '
+                             'you run out of RAM with large images. Ignored with --save_probabilities.')
+    parser.add_argument('--shared_memory_transport', action='store_true', required=False, default=False,
+                        help='Set this flag to hand preprocessed images from the preprocessing workers to the '
+                             'predictor in shared memory instead of pickling them. Requires a sufficiently large '
+                             '/dev/shm.')
+    parser.add_argument('--acsconv_to_conv3d', action='store_true', required=False, default=False,
+                        help='Set this flag to replace the ACSConv layers of the trained network with equivalent '
+                             'Conv3d layers before predicting. Faster, the result is checked once at startup.')
     parser.add_argument('--verbose', action='store_true', help="Set this if you like being talked to. You will have "
                                                                "to be a good listener/reader.")
     parser.add_argument('--save_probabilities', action='store_true',
@@ -868,7 +1387,18 @@ def predict_entry_point():
                                 device=device,
                                 verbose=args.verbose,
                                 verbose_preprocessing=False,
-                                custom_network_config_path=args.custom_cfg_path)
+                                custom_network_config_path=args.custom_cfg_path,
+                                tile_batch_size=args.tile_batch_size,
+                                batched_mirroring=args.batched_tta,
+                                max_mirror_batch_size=args.max_tta_batch_size,
+                                keep_folds_resident=args.keep_folds_resident,
+                                skip_background_tiles=args.skip_background_tiles,
+                                coarse_to_fine=args.coarse_to_fine,
+                                coarse_downsampling_factor=args.coarse_factor,
+                                coarse_roi_margin=args.coarse_margin,
+                                streaming_export=args.streaming_export,
+                                shared_memory_transport=args.shared_memory_transport,
+                                acsconv_to_conv3d=args.acsconv_to_conv3d)
     predictor.initialize_from_trained_model_folder(
         model_folder,
         args.f,
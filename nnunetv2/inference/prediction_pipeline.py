@@ -0,0 +1,184 @@
+import queue
+import threading
+from multiprocessing.pool import Pool
+from time import time
+from typing import Callable, Iterable, List, Tuple
+
+
+def timed_call(func: Callable, *args):
+    """
+    Runs func(*args) and returns (result, start, end). Used by the export workers so that the main process knows when
+    they were busy
+    """
+    start = time()
+    result = func(*args)
+    return result, start, time()
+
+
+def _merge_intervals(intervals: List[Tuple[float, float]]) -> List[Tuple[float, float]]:
+    merged = []
+    for start, end in sorted(intervals):
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _intersection_length(a: List[Tuple[float, float]], b: List[Tuple[float, float]]) -> float:
+    # a and b must be merged (sorted, non overlapping)
+    total, i, j = 0., 0, 0
+    while i < len(a) and j < len(b):
+        total += max(0., min(a[i][1], b[j][1]) - max(a[i][0], b[j][0]))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return total
+
+
+class PipelineStats(object):
+    """
+    Collects the time intervals in which each stage of the prediction pipeline was busy (or stalled). Stages used by
+    nnUNetPredictor.predict_from_data_iterator:
+    - 'wait_for_data': the network had nothing to do because preprocessing was not done yet
+    - 'predict': the network was running
+    - 'wait_for_export': the network had nothing to do because too many exports were queued (backpressure)
+    - 'export': resampling and export in the background workers (intervals may overlap, one per worker)
+    """
+    def __init__(self):
+        self.intervals = {}
+        self._lock = threading.Lock()
+        self.start_time = time()
+        self.end_time = None
+
+    def add(self, stage: str, start: float, end: float):
+        with self._lock:
+            self.intervals.setdefault(stage, []).append((start, end))
+
+    def stop(self):
+        self.end_time = time()
+
+    def summary(self, num_export_workers: int = 1) -> dict:
+        with self._lock:
+            intervals = {k: list(v) for k, v in self.intervals.items()}
+        wall = max(1e-8, (self.end_time if self.end_time is not None else time()) - self.start_time)
+        busy = {k: sum([e - s for s, e in v]) for k, v in intervals.items()}
+        export = _merge_intervals(intervals.get('export', []))
+        predict = _merge_intervals(intervals.get('predict', []))
+        export_active = sum([e - s for s, e in export])
+        return {
+            'wall_time': wall,
+            'busy_time': busy,
+            'num_items': {k: len(v) for k, v in intervals.items()},
+            'predict_utilization': busy.get('predict', 0.) / wall,
+            'export_utilization': busy.get('export', 0.) / (wall * max(1, num_export_workers)),
+            # fraction of the time in which an export was running that the network was running at the same time
+            'overlap_ratio': _intersection_length(export, predict) / export_active if export_active > 0 else 0.,
+        }
+
+    def print_summary(self, num_export_workers: int = 1):
+        s = self.summary(num_export_workers)
+        busy = s['busy_time']
+        print(f"Pipeline summary: wall time {s['wall_time']:.1f} s, "
+              f"predict {busy.get('predict', 0.):.1f} s ({s['predict_utilization'] * 100:.1f}%), "
+              f"waiting for preprocessing {busy.get('wait_for_data', 0.):.1f} s, "
+              f"waiting for export {busy.get('wait_for_export', 0.):.1f} s, "
+              f"export {busy.get('export', 0.):.1f} s ({s['export_utilization'] * 100:.1f}% of "
+              f"{num_export_workers} workers), overlap ratio {s['overlap_ratio']:.2f}")
+
+
+def prefetch_iterator(iterator: Iterable, stats: PipelineStats, max_queue_size: int = 1,
+                      transform: Callable = None):
+    """
+    Pulls items from iterator (and applies transform to them) in a background thread so that fetching the next
+    preprocessed case overlaps with the prediction of the current one. At most max_queue_size items are kept ready.
+    The time the consumer spends waiting for an item is recorded as 'wait_for_data' in stats.
+    Exceptions raised in the background thread are re-raised in the consumer.
+    """
+    q = queue.Queue(maxsize=max_queue_size)
+    end = object()
+    abort_event = threading.Event()
+
+    def producer():
+        try:
+            for item in iterator:
+                if transform is not None:
+                    item = transform(item)
+                while not abort_event.is_set():
+                    try:
+                        q.put(item, timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+                if abort_event.is_set():
+                    return
+            q.put(end)
+        except BaseException as e:
+            q.put(e)
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            start = time()
+            item = q.get()
+            stats.add('wait_for_data', start, time())
+            if item is end:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        abort_event.set()
+
+
+class BoundedExportQueue(object):
+    """
+    Submits export jobs to a multiprocessing pool. At most num_workers + allowed_num_queued jobs are unfinished, which
+    keeps the predictor from swamping the RAM with logits when exporting is slower than predicting. Call acquire_slot
+    before predicting a case and submit its result afterwards: acquire_slot blocks (without polling) until a slot is
+    free, so no prediction is computed that would have to wait in RAM for one. submit without acquire_slot takes the
+    slot itself. The time spent blocking is recorded as 'wait_for_export', the time the workers spend on a job as
+    'export'.
+    """
+    def __init__(self, export_pool: Pool, stats: PipelineStats, allowed_num_queued: int = 2,
+                 watchdog_interval: float = 5.):
+        self.export_pool = export_pool
+        self.worker_list = [i for i in export_pool._pool]
+        self.stats = stats
+        self.watchdog_interval = watchdog_interval
+        self._slots = threading.Semaphore(len(self.worker_list) + allowed_num_queued)
+        self._num_acquired = 0
+        self._results = []
+        self._errors = []
+
+    def _on_done(self, result):
+        _, start, end = result[0]
+        self.stats.add('export', start, end)
+        self._slots.release()
+
+    def _on_error(self, e):
+        self._errors.append(e)
+        self._slots.release()
+
+    def acquire_slot(self):
+        start = time()
+        while not self._slots.acquire(timeout=self.watchdog_interval):
+            # a job whose worker died would never release its slot
+            if not all([i.is_alive() for i in self.worker_list]):
+                raise RuntimeError('Some background workers are no longer alive')
+        self.stats.add('wait_for_export', start, time())
+        self._num_acquired += 1
+        if len(self._errors) > 0:
+            raise self._errors[0]
+
+    def submit(self, func: Callable, args: tuple):
+        if self._num_acquired == 0:
+            self.acquire_slot()
+        self._num_acquired -= 1
+        self._results.append(self.export_pool.starmap_async(timed_call, ((func, *args),),
+                                                            callback=self._on_done, error_callback=self._on_error))
+
+    def get_results(self) -> list:
+        return [i.get()[0][0] for i in self._results]
@@ -0,0 +1,247 @@
+import io
+import json
+import traceback
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from time import time
+from typing import List, Union
+from urllib.request import Request, urlopen
+
+import numpy as np
+import torch
+
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.utilities.file_path_utilities import get_output_folder
+
+TIMING_HEADER = 'X-nnUNet-Timing'
+SPACING_HEADER = 'X-nnUNet-Spacing'
+
+
+class nnUNetPredictionServer(HTTPServer):
+    """
+    Keeps an initialized nnUNetPredictor (network, fold weights, plans) resident so that requests do not pay for
+    importing torch, finding the trainer class and loading checkpoints. Requests are handled one after the other.
+
+    Endpoints (localhost only by default):
+    GET  /health       -> json with the model folder and folds
+    POST /predict      json {"input_files": [...], "output_file_truncated": optional, "seg_from_prev_stage_file":
+                       optional}. With output_file_truncated the segmentation is written there (file ending is added)
+                       and the response is json {"output_file": ..., "timing": {...}}. Otherwise the response is the
+                       segmentation as npy and the timing is in the X-nnUNet-Timing header
+    POST /predict_npy  body is an image (c, x, y, z) in npy format, the spacing goes into the X-nnUNet-Spacing header
+                       as json list. Response is the segmentation as npy, timing in the X-nnUNet-Timing header
+
+    Timing (seconds) is split into 'read' (decoding the request, reading the images), 'predict' (preprocessing,
+    prediction and resampling), 'write' and 'total'.
+    """
+    def __init__(self, predictor: nnUNetPredictor, model_folder: str, folds, host: str = '127.0.0.1',
+                 port: int = 8765):
+        self.predictor = predictor
+        self.model_folder = model_folder
+        self.folds = folds
+        self.rw = predictor.plans_manager.image_reader_writer_class()
+        super().__init__((host, port), PredictionRequestHandler)
+
+    def predict_files(self, input_files: List[str], output_file_truncated: str = None,
+                      seg_from_prev_stage_file: str = None):
+        timing = {}
+        start = time()
+        image, properties = self.rw.read_images(input_files)
+        seg_prev_stage = self.rw.read_seg(seg_from_prev_stage_file)[0] if seg_from_prev_stage_file is not None \
+            else None
+        timing['read'] = time() - start
+
+        t = time()
+        segmentation = self.predictor.predict_single_npy_array(image, properties, seg_prev_stage, None, False)
+        timing['predict'] = time() - t
+
+        t = time()
+        output_file = None
+        if output_file_truncated is not None:
+            output_file = output_file_truncated + self.predictor.dataset_json['file_ending']
+            self.rw.write_seg(segmentation, output_file, properties)
+            segmentation = None
+        timing['write'] = time() - t
+        timing['total'] = time() - start
+        return segmentation, output_file, timing
+
+    def predict_npy(self, image: np.ndarray, spacing: List[float]):
+        start = time()
+        segmentation = self.predictor.predict_single_npy_array(image, {'spacing': spacing}, None, None, False)
+        return segmentation, {'predict': time() - start}
+
+
+class PredictionRequestHandler(BaseHTTPRequestHandler):
+    server: nnUNetPredictionServer
+
+    def _send(self, code: int, body: bytes, content_type: str, timing: dict = None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if timing is not None:
+            self.send_header(TIMING_HEADER, json.dumps(timing))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, code: int, content: dict):
+        self._send(code, json.dumps(content).encode(), 'application/json')
+
+    def _send_npy(self, array: np.ndarray, timing: dict):
+        buffer = io.BytesIO()
+        np.save(buffer, array)
+        self._send(200, buffer.getvalue(), 'application/octet-stream', timing)
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send_json(200, {'status': 'ok', 'model_folder': self.server.model_folder,
+                                  'folds': list(self.server.folds)})
+        else:
+            self._send_json(404, {'error': f'unknown endpoint {self.path}'})
+
+    def do_POST(self):
+        start = time()
+        try:
+            if self.path == '/predict':
+                request = json.loads(self._read_body())
+                segmentation, output_file, timing = self.server.predict_files(
+                    request['input_files'], request.get('output_file_truncated'),
+                    request.get('seg_from_prev_stage_file'))
+                if output_file is not None:
+                    self._send_json(200, {'output_file': output_file, 'timing': timing})
+                else:
+                    self._send_npy(segmentation, timing)
+            elif self.path == '/predict_npy':
+                image = np.load(io.BytesIO(self._read_body()), allow_pickle=False)
+                spacing = json.loads(self.headers[SPACING_HEADER])
+                read_time = time() - start
+                segmentation, timing = self.server.predict_npy(image, spacing)
+                timing['read'] = read_time
+                timing['total'] = time() - start
+                self._send_npy(segmentation, timing)
+            else:
+                self._send_json(404, {'error': f'unknown endpoint {self.path}'})
+                return
+        except (KeyError, TypeError, ValueError) as e:
+            self._send_json(400, {'error': f'bad request: {repr(e)}'})
+            return
+        except Exception as e:
+            traceback.print_exc()
+            self._send_json(500, {'error': repr(e)})
+            return
+        print(f'{self.path} done in {time() - start:.2f} s')
+
+
+def predict_with_server(input_files_or_image: Union[List[str], np.ndarray], output_file_truncated: str = None,
+                        spacing: List[float] = None, host: str = '127.0.0.1', port: int = 8765):
+    """
+    Client for nnUNetPredictionServer. Pass a list of image files (one per channel) or a (c, x, y, z) numpy array
+    (spacing is required then). Returns (segmentation or output file, timing)
+    """
+    url = f'http://{host}:{port}'
+    if isinstance(input_files_or_image, np.ndarray):
+        assert spacing is not None, 'spacing is required when predicting a numpy array'
+        buffer = io.BytesIO()
+        np.save(buffer, input_files_or_image)
+        request = Request(url + '/predict_npy', data=buffer.getvalue(),
+                          headers={SPACING_HEADER: json.dumps(list(spacing)),
+                                   'Content-Type': 'application/octet-stream'})
+    else:
+        request = Request(url + '/predict', data=json.dumps({'input_files': list(input_files_or_image),
+                                                             'output_file_truncated': output_file_truncated}).encode(),
+                          headers={'Content-Type': 'application/json'})
+    with urlopen(request) as response:
+        body = response.read()
+        if response.headers.get_content_type() == 'application/json':
+            content = json.loads(body)
+            return content['output_file'], content['timing']
+        return np.load(io.BytesIO(body), allow_pickle=False), json.loads(response.headers[TIMING_HEADER])
+
+
+def predict_server_entry_point():
+    import argparse
+    parser = argparse.ArgumentParser(description='Starts a local server that keeps a trained nnU-Net model in memory '
+                                                 'and predicts cases on request. See nnUNetPredictionServer for the '
+                                                 'endpoints.')
+    parser.add_argument('-d', type=str, required=False, default=None,
+                        help='Dataset with which you would like to predict. You can specify either dataset name or id')
+    parser.add_argument('-p', type=str, required=False, default='nnUNetPlans',
+                        help='Plans identifier. Default: nnUNetPlans')
+    parser.add_argument('-tr', type=str, required=False, default='nnUNetTrainer',
+                        help='What nnU-Net trainer class was used for training? Default: nnUNetTrainer')
+    parser.add_argument('-c', type=str, required=False, default=None,
+                        help='nnU-Net configuration that should be used for prediction')
+    parser.add_argument('-m', type=str, required=False, default=None,
+                        help='Alternatively to -d, -p, -tr and -c: folder in which the trained model is')
+    parser.add_argument('-f', nargs='+', type=str, required=False, default=(0, 1, 2, 3, 4),
+                        help='Specify the folds of the trained model that should be used for prediction. '
+                             'Default: (0, 1, 2, 3, 4)')
+    parser.add_argument('-chk', type=str, required=False, default='checkpoint_final.pth',
+                        help='Name of the checkpoint you want to use. Default: checkpoint_final.pth')
+    parser.add_argument('-step_size', type=float, required=False, default=0.5,
+                        help='Step size for sliding window prediction. Default: 0.5')
+    parser.add_argument('-tile_batch_size', type=int, required=False, default=1,
+                        help='Number of sliding window tiles that are predicted together in one forward pass. '
+                             'Default: 1')
+    parser.add_argument('--disable_tta', action='store_true', required=False, default=False,
+                        help='Set this flag to disable test time data augmentation in the form of mirroring.')
+    parser.add_argument('--batched_tta', action='store_true', required=False, default=False,
+                        help='Set this flag to predict all mirrored test time augmentation variants of a tile in one '
+                             'forward pass.')
+    parser.add_argument('--reload_folds', action='store_true', required=False, default=False,
+                        help='By default one network instance per fold is kept on the device. Set this flag to load '
+                             'the fold weights into a single network for every case instead (less memory, slower).')
+    parser.add_argument('-host', type=str, required=False, default='127.0.0.1',
+                        help='Address the server listens on. Default: 127.0.0.1 (only reachable from this machine)')
+    parser.add_argument('-port', type=int, required=False, default=8765,
+                        help='Port the server listens on. Default: 8765')
+    parser.add_argument('-device', type=str, default='cuda', required=False,
+                        help="Use this to set the device the inference should run with. Available options are 'cuda' "
+                             "(GPU), 'cpu' (CPU) and 'mps' (Apple M1/M2).")
+    parser.add_argument('-custom_cfg_path', type=str, default=None, required=False,
+                        help='[OPTIONAL] Custom network configuration YAML file path.')
+    parser.add_argument('--verbose', action='store_true', help="Set this if you like being talked to.")
+    args = parser.parse_args()
+
+    args.f = [i if i == 'all' else int(i) for i in args.f]
+    if args.m is not None:
+        model_folder = args.m
+    else:
+        assert args.d is not None and args.c is not None, 'either -m or -d and -c are required'
+        model_folder = get_output_folder(args.d, args.tr, args.p, args.c)
+
+    assert args.device in ['cpu', 'cuda', 'mps'], \
+        f'-device must be either cpu, mps or cuda. Other devices are not tested/supported. Got: {args.device}.'
+    if args.device == 'cpu':
+        import multiprocessing
+        torch.set_num_threads(multiprocessing.cpu_count())
+        device = torch.device('cpu')
+    elif args.device == 'cuda':
+        torch.set_num_threads(1)
+        torch.set_num_interop_threads(1)
+        device = torch.device('cuda')
+    else:
+        device = torch.device('mps')
+
+    predictor = nnUNetPredictor(tile_step_size=args.step_size,
+                                use_gaussian=True,
+                                use_mirroring=not args.disable_tta,
+                                perform_everything_on_gpu=True,
+                                device=device,
+                                verbose=args.verbose,
+                                allow_tqdm=False,
+                                custom_network_config_path=args.custom_cfg_path,
+                                tile_batch_size=args.tile_batch_size,
+                                batched_mirroring=args.batched_tta,
+                                keep_folds_resident=not args.reload_folds)
+    predictor.initialize_from_trained_model_folder(model_folder, args.f, checkpoint_name=args.chk)
+
+    server = nnUNetPredictionServer(predictor, model_folder, args.f, args.host, args.port)
+    print(f'nnU-Net prediction server for {model_folder} listening on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,121 @@
+import queue
+import weakref
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import torch
+
+# offsets of the individual tensors within a block are aligned to this many bytes
+_ALIGNMENT = 64
+
+
+class SharedMemoryBufferPool(object):
+    """
+    Used by the preprocessing workers. pack copies all tensors of an item into a shared memory block and replaces them
+    with a small handle, so that only the handle is pickled when the item is put into the queue. Blocks that the
+    consumer is done with come back through free_queue (see unpack_shared_memory_item) and are reused for the next
+    items. At most max_cached_buffers unused blocks are kept around.
+
+    Blocks that are still in use when the worker finishes are unlinked by the consumer.
+    """
+    def __init__(self, free_queue, max_cached_buffers: int = 2):
+        self.free_queue = free_queue
+        self.max_cached_buffers = max_cached_buffers
+        self.blocks = {}
+        self.free = []
+
+    def _collect_free_blocks(self):
+        while True:
+            try:
+                self.free.append(self.free_queue.get_nowait())
+            except queue.Empty:
+                break
+
+    def _unlink(self, name: str):
+        shm = self.blocks.pop(name)
+        shm.close()
+        shm.unlink()
+
+    def _get_block(self, nbytes: int) -> SharedMemory:
+        self._collect_free_blocks()
+        candidates = sorted([n for n in self.free if self.blocks[n].size >= nbytes], key=lambda n: self.blocks[n].size)
+        if len(candidates) > 0:
+            name = candidates[0]
+            self.free.remove(name)
+        else:
+            shm = SharedMemory(create=True, size=max(1, nbytes))
+            name = shm.name
+            self.blocks[name] = shm
+        # blocks that are too small for what we currently get or that exceed the cache size are not worth keeping
+        while len(self.free) > self.max_cached_buffers:
+            self._unlink(self.free.pop(0))
+        return self.blocks[name]
+
+    def pack(self, item: dict) -> dict:
+        keys = [k for k, v in item.items() if isinstance(v, torch.Tensor)]
+        arrays = [item[k].numpy() for k in keys]
+        offsets = []
+        nbytes = 0
+        for a in arrays:
+            offsets.append(nbytes)
+            nbytes += int(np.ceil(a.nbytes / _ALIGNMENT)) * _ALIGNMENT
+        shm = self._get_block(nbytes)
+        for a, o in zip(arrays, offsets):
+            target = np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf, offset=o)
+            target[:] = a
+            del target
+
+        packed = {k: v for k, v in item.items() if k not in keys}
+        packed['shared_memory_handle'] = {
+            'name': shm.name,
+            'tensors': [(k, a.dtype.str, a.shape, o) for k, a, o in zip(keys, arrays, offsets)]
+        }
+        return packed
+
+    def close(self):
+        """
+        unlinks all blocks that are not in use by the consumer
+        """
+        self._collect_free_blocks()
+        for name in self.free:
+            self._unlink(name)
+        self.free = []
+        # the consumer unlinks the remaining blocks once it is done with them. We only unmap them here
+        for shm in self.blocks.values():
+            shm.close()
+        self.blocks = {}
+
+
+def _release_block(shm: SharedMemory, free_queue, done_event):
+    shm.close()
+    try:
+        if done_event.is_set():
+            # the worker is gone and cannot reuse the block anymore
+            shm.unlink()
+        else:
+            free_queue.put(shm.name)
+    except (OSError, EOFError, BrokenPipeError):
+        # the manager may already be shut down. The resource tracker cleans up leftover blocks at exit
+        pass
+
+
+def unpack_shared_memory_item(item: dict, free_queue, done_event) -> dict:
+    """
+    Counterpart to SharedMemoryBufferPool.pack. The returned tensors are views of the shared memory block (no copy).
+    The block is handed back to the worker as soon as all of these tensors have been garbage collected
+    """
+    if 'shared_memory_handle' not in item.keys():
+        return item
+    item = dict(item)
+    handle = item.pop('shared_memory_handle')
+    shm = SharedMemory(name=handle['name'])
+    base = np.ndarray((shm.size,), dtype=np.uint8, buffer=shm.buf)
+    for k, dtype, shape, offset in handle['tensors']:
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        item[k] = torch.from_numpy(base[offset:offset + nbytes].view(dtype).reshape(shape))
+    finalizer = weakref.finalize(base, _release_block, shm, free_queue, done_event)
+    # leftover blocks at interpreter shutdown are handled by the resource tracker, the manager may be gone by then
+    finalizer.atexit = False
+    return item
+
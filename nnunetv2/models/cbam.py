@@ -23,6 +23,27 @@ class Flatten(nn.Module):
     def forward(self, x):
         return x.view(x.size(0), -1)
 
+def global_pool_3d(x, pool_types):
+    """
+    Global pooling descriptors (B, len(pool_types), C) of x (B, C, D, H, W). Each descriptor is a single reduction
+    over the spatial dims, which works on any memory layout (channels_last_3d included) without copying x
+    """
+    dims = (2, 3, 4)
+    descriptors = []
+    for pool_type in pool_types:
+        if pool_type == 'avg':
+            descriptors.append(x.mean(dim=dims))
+        elif pool_type == 'max':
+            descriptors.append(x.amax(dim=dims))
+        elif pool_type == 'lp':
+            # F.lp_pool3d with norm 2 over the whole volume
+            descriptors.append(x.square().sum(dim=dims).sqrt())
+        elif pool_type == 'lse':
+            descriptors.append(torch.logsumexp(x, dim=dims))
+        else:
+            raise ValueError(f"unknown pool type {pool_type}")
+    return torch.stack(descriptors, dim=1)
+
 class ChannelGate(nn.Module):
     def __init__(self, gate_channels, reduction_ratio=2, pool_types=['avg', 'max']):
         super(ChannelGate, self).__init__()
@@ -38,41 +59,22 @@ class ChannelGate(nn.Module):
         self.pool_types = pool_types
 
     def forward(self, x):
-        channel_att_sum = None
-        for pool_type in self.pool_types:
-            if pool_type == 'avg':
-                # avg_pool = F.avg_pool3d(x, (x.size(2), x.size(3), x.size(4)), stride=(x.size(2), x.size(3), x.size(4)))
-                avg_pool = F.adaptive_avg_pool3d(x, (1, 1, 1))
-                channel_att_raw = self.mlp(avg_pool)
-            elif pool_type == 'max':
-                max_pool = F.max_pool3d(x, (x.size(2), x.size(3), x.size(4)), stride=(x.size(2), x.size(3), x.size(4)))
-                channel_att_raw = self.mlp(max_pool)
-            elif pool_type == 'lp':
-                lp_pool = F.lp_pool3d(x, 2, (x.size(2), x.size(3), x.size(4)), stride=(x.size(2), x.size(3), x.size(4)))
-                channel_att_raw = self.mlp(lp_pool)
-            elif pool_type == 'lse':
-                # LSE pool only
-                lse_pool = logsumexp_3d(x)
-                channel_att_raw = self.mlp(lse_pool)
-
-            if channel_att_sum is None:
-                channel_att_sum = channel_att_raw
-            else:
-                channel_att_sum = channel_att_sum + channel_att_raw
+        # all descriptors go through the MLP as one batch, the sum over pool types is the same as running it per pool
+        descriptors = global_pool_3d(x, self.pool_types)
+        b, p, c = descriptors.shape
+        channel_att_sum = self.mlp(descriptors.reshape(b * p, c)).view(b, p, c).sum(dim=1)
 
-        scale = F.sigmoid(channel_att_sum)
-        scale = scale.unsqueeze(-1).unsqueeze(-1).unsqueeze(-1).expand_as(x)
+        scale = torch.sigmoid(channel_att_sum).view(b, c, 1, 1, 1)
+        # broadcasting keeps the memory format of x
         return x * scale
 
 def logsumexp_3d(tensor):
-    tensor_flatten = tensor.view(tensor.size(0), tensor.size(1), -1)
-    s, _ = torch.max(tensor_flatten, dim=2, keepdim=True)
-    outputs = s + (tensor_flatten - s).exp().sum(dim=2, keepdim=True).log()
-    return outputs
+    return torch.logsumexp(tensor, dim=(2, 3, 4)).view(tensor.size(0), tensor.size(1), 1)
 
 class ChannelPool(nn.Module):
     def forward(self, x):
-        return torch.cat((torch.max(x, 1)[0].unsqueeze(1), torch.mean(x, 1).unsqueeze(1)), dim=1)
+        # amax does not compute the argmax like torch.max(x, 1)
+        return torch.cat((x.amax(dim=1, keepdim=True), x.mean(dim=1, keepdim=True)), dim=1)
 
 class SpatialGate(nn.Module):
     def __init__(self):
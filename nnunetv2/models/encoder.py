@@ -3,7 +3,7 @@ import torch
 import torch.nn as nn
 from nnunetv2.tuanluc_dev.utils import *
 from nnunetv2.run.run_training import get_trainer_from_args
-from nnunetv2.tuanluc_dev.get_network_from_plans import load_acsconv_dict, replace_conv3d_and_load_weight_from_acsconv, read_custom_network_config
+from nnunetv2.tuanluc_dev.get_network_from_plans import replace_conv3d_and_load_weight_from_acsconv_cached, read_custom_network_config
 
 
 class HGGLGGClassifier(nn.Module):
@@ -36,8 +36,7 @@ class HGGLGGClassifier(nn.Module):
             
             # Replace the conv3d with acsconv and load the weights if needed
             if custom_network_config["acsconv"]:
-                acsconv_dict = load_acsconv_dict(custom_network_config)
-                replace_conv3d_and_load_weight_from_acsconv(self.encoder, custom_network_config, acsconv_dict)
+                replace_conv3d_and_load_weight_from_acsconv_cached(self.encoder, custom_network_config)
         
         # Add a classifier head
         self.classifier = nn.Sequential(
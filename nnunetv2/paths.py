@@ -21,6 +21,9 @@ PLEASE READ paths.md FOR INFORMATION TO HOW TO SET THIS UP
 nnUNet_raw = os.environ.get('nnUNet_raw')
 nnUNet_preprocessed = os.environ.get('nnUNet_preprocessed')
 nnUNet_results = os.environ.get('nnUNet_results')
+# converted pretrained ACSConv weights, see nnunetv2.tuanluc_dev.network_initialization.get_acs_weight_cache_key
+nnUNet_acs_weights_cache = os.environ.get('nnUNet_acs_weights_cache',
+                                          os.path.join(os.path.expanduser('~'), '.cache', 'nnunetv2', 'acs_weights'))
 
 if nnUNet_raw is None:
     print("nnUNet_raw is not defined and nnU-Net can only be used on data for which preprocessed files "
@@ -19,9 +19,12 @@ from typing import Union, Tuple
 import nnunetv2
 import numpy as np
 from batchgenerators.utilities.file_and_folder_operations import *
+from nnunetv2.configuration import use_chunked_storage
 from nnunetv2.paths import nnUNet_preprocessed, nnUNet_raw
 from nnunetv2.preprocessing.cropping.cropping import crop_to_nonzero
 from nnunetv2.preprocessing.resampling.default_resampling import compute_new_shape
+from nnunetv2.training.dataloading.class_locations_index import build_class_locations_index
+from nnunetv2.training.dataloading.utils import save_chunked
 from nnunetv2.utilities.dataset_name_id_conversion import maybe_convert_to_dataset_name
 from nnunetv2.utilities.find_class_by_name import recursive_find_python_class
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
@@ -31,8 +34,10 @@ from tqdm import tqdm
 
 
 class DefaultPreprocessor(object):
-    def __init__(self, verbose: bool = True):
+    def __init__(self, verbose: bool = True, chunked_storage: bool = use_chunked_storage):
         self.verbose = verbose
+        # write chunked .b2nd files instead of npz, see nnunetv2.configuration.use_chunked_storage
+        self.chunked_storage = chunked_storage
         """
         Everything we need is in the plans. Those are given when run() is called
         """
@@ -145,7 +150,11 @@ class DefaultPreprocessor(object):
                       dataset_json: Union[dict, str]):
         data, seg, properties = self.run_case(image_files, seg_file, plans_manager, configuration_manager, dataset_json)
         # print('dtypes', data.dtype, seg.dtype)
-        np.savez_compressed(output_filename_truncated + '.npz', data=data, seg=seg)
+        if self.chunked_storage:
+            save_chunked(data, output_filename_truncated + '.b2nd', configuration_manager.patch_size)
+            save_chunked(seg, output_filename_truncated + '_seg.b2nd', configuration_manager.patch_size)
+        else:
+            np.savez_compressed(output_filename_truncated + '.npz', data=data, seg=seg)
         write_pickle(properties, output_filename_truncated + '.pkl')
 
     @staticmethod
@@ -256,6 +265,9 @@ class DefaultPreprocessor(object):
                     remaining = [i for i in remaining if i not in done]
                     sleep(0.1)
 
+        # foreground locations of all cases in one memory mappable file for the data loaders
+        build_class_locations_index(output_directory, num_processes=num_processes)
+
     def modify_seg_fn(self, seg: np.ndarray, plans_manager: PlansManager, dataset_json: dict,
                       configuration_manager: ConfigurationManager) -> np.ndarray:
         # this function will be called at the end of self.run_case. Can be used to change the segmentation
@@ -0,0 +1,105 @@
+import itertools
+
+import pytest
+import torch
+
+from nnunetv2.tuanluc_dev.acsconv.operators import ACSConv
+
+# kernel_size, padding, stride, dilation, depthwise, acs_kernel_split. acs_conv_f only supports depthwise
+# convolutions with 'same' padding
+CONFIGS = [(k, p, s, d, dw, split) for k, p, s, d, dw, split in itertools.product(
+    (1, 3), (0, 1, 2), (1, 2), (1, 2), (False, True), (None, (6, 0, 0), (0, 3, 3)))
+    if p <= k // 2 * d + 1 and (not dw or p == k // 2 * d)]
+SHAPES = [(8, 8, 8), (9, 7, 10), (5, 12, 6)]
+
+
+def _make_pair(kernel_size, padding, stride, dilation, depthwise, acs_kernel_split, **kwargs):
+    torch.manual_seed(0)
+    channels = 6
+    reference = ACSConv(channels, channels, kernel_size, stride, padding, dilation, channels if depthwise else 1,
+                        acs_kernel_split)
+    other = ACSConv(channels, channels, kernel_size, stride, padding, dilation, channels if depthwise else 1,
+                    acs_kernel_split, **kwargs)
+    other.load_state_dict(reference.state_dict())
+    return reference, other
+
+
+def _reference_output(reference, x):
+    """acs_conv_f output, None if acs_conv_f cannot compute it"""
+    out_shape = [reference.conv3D_output_shape_f(i, x.shape[2:], reference.kernel_size, reference.dilation,
+                                                 reference.padding, reference.stride) for i in range(3)]
+    if min(out_shape) < 1:
+        return None
+    for o, i, s in zip(out_shape, x.shape[2:], reference.stride):
+        shortcut = o == i or 2 * o == i
+        # acs_conv_f assumes 'same' padding if the output is as large as (or half of) the input and otherwise pads
+        # all channels of x instead of the depthwise channel split, both fail in the other cases
+        if (shortcut and (i - 1) // s + 1 != o) or (not shortcut and reference.groups > 1):
+            return None
+    return reference(x)
+
+
+@pytest.mark.parametrize('config', CONFIGS)
+def test_fused_matches_acs_conv(config):
+    reference, fused = _make_pair(*config, fused=True)
+    compared = 0
+    for shape in SHAPES:
+        x = torch.randn(2, 6, *shape)
+        expected = _reference_output(reference, x)
+        if expected is None:
+            continue
+        torch.testing.assert_close(fused(x), expected, atol=1e-5, rtol=1e-5)
+        if fused.fused_is_always_equivalent():
+            assert fused.fused_is_equivalent(shape)
+        compared += 1
+    assert compared > 0
+
+
+def test_fused_weight_cache_follows_weight_updates():
+    reference, fused = _make_pair(3, 1, 1, 1, False, None, fused=True)
+    x = torch.randn(1, 6, 8, 8, 8)
+    with torch.no_grad():
+        fused(x)
+        for conv in (reference, fused):
+            conv.weight.mul_(2)
+        torch.testing.assert_close(fused(x), reference(x), atol=1e-5, rtol=1e-5)
+
+
+@pytest.mark.parametrize('config', CONFIGS)
+def test_memory_efficient_matches_acs_conv(config):
+    reference, memory_efficient = _make_pair(*config, memory_efficient=True)
+    compared = 0
+    for shape in SHAPES:
+        x = torch.randn(2, 6, *shape)
+        x_ref = x.clone().requires_grad_(True)
+        x_me = x.clone().requires_grad_(True)
+        expected = _reference_output(reference, x_ref)
+        if expected is None:
+            continue
+        out = memory_efficient(x_me)
+        torch.testing.assert_close(out, expected, atol=0, rtol=0)
+        grad = torch.randn_like(expected)
+        reference.zero_grad()
+        memory_efficient.zero_grad()
+        expected.backward(grad)
+        out.backward(grad)
+        torch.testing.assert_close(x_me.grad, x_ref.grad, atol=1e-5, rtol=1e-5)
+        torch.testing.assert_close(memory_efficient.weight.grad, reference.weight.grad, atol=1e-4, rtol=1e-5)
+        compared += 1
+    assert compared > 0
+
+
+@pytest.mark.parametrize('memory_efficient', (False, True))
+def test_checkpoint_matches_acs_conv(memory_efficient):
+    reference, checkpointed = _make_pair(3, 1, 2, 1, False, None, memory_efficient=memory_efficient,
+                                         checkpoint=True)
+    x_ref = torch.randn(2, 6, 9, 7, 10, requires_grad=True)
+    x_cp = x_ref.detach().clone().requires_grad_(True)
+    expected = reference(x_ref)
+    out = checkpointed(x_cp)
+    torch.testing.assert_close(out, expected, atol=1e-6, rtol=1e-6)
+    expected.sum().backward()
+    out.sum().backward()
+    torch.testing.assert_close(x_cp.grad, x_ref.grad, atol=1e-5, rtol=1e-5)
+    torch.testing.assert_close(checkpointed.weight.grad, reference.weight.grad, atol=1e-4, rtol=1e-5)
+    torch.testing.assert_close(checkpointed.bias.grad, reference.bias.grad, atol=1e-4, rtol=1e-5)
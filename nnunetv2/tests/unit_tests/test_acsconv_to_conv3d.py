@@ -0,0 +1,59 @@
+import torch
+from dynamic_network_architectures.architectures.unet import PlainConvUNet
+from torch import nn
+
+from nnunetv2.tuanluc_dev.acsconv.operators import ACSConv
+from nnunetv2.tuanluc_dev.network_initialization import convert_acsconv_network_to_conv3d, \
+    replace_nnunet_conv3d_with_acsconv_random
+
+
+def _acs_unet():
+    torch.manual_seed(0)
+    network = PlainConvUNet(4, 4, [8, 16, 32, 32], nn.Conv3d, 3, [1, 2, 2, 2], 2, 3, [2, 2, 2], True,
+                            nn.InstanceNorm3d, {'eps': 1e-5, 'affine': True}, None, None, nn.LeakyReLU,
+                            {'inplace': True})
+    replace_nnunet_conv3d_with_acsconv_random(network, nn.Conv3d)
+    return network
+
+
+def _num_acsconvs(network):
+    return sum(isinstance(m, ACSConv) for m in network.modules())
+
+
+def test_converted_network_matches_acsconv_network():
+    network = _acs_unet()
+    assert _num_acsconvs(network) > 0
+    parameters = [network.state_dict(),
+                  {k: v + 0.01 * torch.randn_like(v) if v.is_floating_point() else v
+                   for k, v in network.state_dict().items()}]
+    converted_network, converted_parameters = convert_acsconv_network_to_conv3d(network, parameters,
+                                                                                check_input_size=(4, 32, 40, 24))
+    assert _num_acsconvs(converted_network) == 0
+    # the input network is not modified
+    assert _num_acsconvs(network) > 0
+
+    network.eval()
+    converted_network.eval()
+    for p, converted_p in zip(parameters, converted_parameters):
+        network.load_state_dict(p)
+        converted_network.load_state_dict(converted_p)
+        # the check above used another shape
+        for shape in ((48, 24, 40), (16, 56, 32)):
+            x = torch.randn(1, 4, *shape)
+            with torch.no_grad():
+                torch.testing.assert_close(converted_network(x), network(x), atol=1e-4, rtol=1e-4)
+
+
+def test_non_equivalent_acsconvs_are_kept():
+    torch.manual_seed(0)
+    network = nn.Sequential(ACSConv(2, 4, 3, padding=1), nn.LeakyReLU(), ACSConv(4, 4, 3, padding=0),
+                            nn.LeakyReLU(), ACSConv(4, 2, 3, padding=2, dilation=2))
+    converted_network, (converted_p,) = convert_acsconv_network_to_conv3d(network, [network.state_dict()],
+                                                                          check_input_size=(2, 11, 10, 9))
+    assert isinstance(converted_network[0], nn.Conv3d)
+    assert isinstance(converted_network[2], ACSConv)
+    assert isinstance(converted_network[4], ACSConv)
+    assert converted_p['2.weight'].shape == network[2].weight.shape
+    x = torch.randn(1, 2, 11, 10, 9)
+    with torch.no_grad():
+        torch.testing.assert_close(converted_network(x), network(x), atol=1e-5, rtol=1e-5)
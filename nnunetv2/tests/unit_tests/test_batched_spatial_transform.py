@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from batchgenerators.transforms.spatial_transforms import SpatialTransform
+
+from nnunetv2.training.data_augmentation.custom_transforms.batched_spatial_transform import BatchedSpatialTransform
+
+
+def _batch(input_shape, batch_size=6, seed=0):
+    rng = np.random.RandomState(seed)
+    data = rng.randn(batch_size, 2, *input_shape).astype(np.float32)
+    # blocks of labels that reach the border of the image
+    seg = np.zeros((batch_size, 1, *input_shape), dtype=np.float32)
+    seg[(slice(None), slice(None)) + tuple(slice(0, i // 2) for i in input_shape)] = 1
+    seg[(slice(None), slice(None)) + tuple(slice(i // 3, i) for i in input_shape)] = 2
+    return data, seg
+
+
+def _spatial_transform(patch_size, **kwargs):
+    return SpatialTransform(patch_size, patch_center_dist_from_border=None, do_elastic_deform=False, alpha=(0, 0),
+                            sigma=(0, 0), do_rotation=True, do_scale=True, border_mode_data='constant',
+                            border_mode_seg='constant', border_cval_seg=-1, order_seg=1, random_crop=False,
+                            p_el_per_sample=0, independent_scale_for_each_axis=False, **kwargs)
+
+
+@pytest.mark.parametrize('patch_size,input_shape,angle', [
+    ((20, 24, 28), (29, 35, 38), np.pi / 6),
+    ((48, 40), (65, 55), np.pi),
+])
+def test_matches_spatial_transform(patch_size, input_shape, angle):
+    kwargs = dict(angle_x=(-angle, angle), angle_y=(-angle, angle), angle_z=(-angle, angle), p_rot_per_axis=1,
+                  scale=(0.7, 1.4), border_cval_data=0, order_data=1, p_scale_per_sample=0.7, p_rot_per_sample=0.7)
+    reference_transform = _spatial_transform(patch_size, **kwargs)
+    batched_transform = BatchedSpatialTransform.from_spatial_transform(reference_transform)
+
+    for seed in range(3):
+        data, seg = _batch(input_shape, seed=seed)
+        np.random.seed(seed)
+        reference = reference_transform(data=data.copy(), seg=seg.copy())
+        np.random.seed(seed)
+        batched = batched_transform(data=data.copy(), seg=seg.copy())
+
+        assert batched['data'].shape == reference['data'].shape and batched['data'].dtype == np.float32
+        np.testing.assert_allclose(batched['data'], reference['data'], atol=1e-4)
+        np.testing.assert_array_equal(batched['seg'], reference['seg'])
+        # the scaling up to 1.4 must have reached outside of the input for this to test the border
+        assert np.any(reference['seg'] == -1)
+
+
+def test_unaugmented_samples_are_center_cropped():
+    data, seg = _batch((30, 31, 32), batch_size=2)
+    transform = BatchedSpatialTransform((20, 20, 20), p_rot_per_sample=0, p_scale_per_sample=0)
+    out = transform(data=data.copy(), seg=seg.copy())
+    np.testing.assert_array_equal(out['data'], data[:, :, 5:25, 5:25, 6:26])
+    np.testing.assert_array_equal(out['seg'], seg[:, :, 5:25, 5:25, 6:26])
@@ -0,0 +1,77 @@
+import os
+
+import numpy as np
+import pytest
+from batchgenerators.utilities.file_and_folder_operations import join, save_pickle
+
+pytest.importorskip('blosc2')
+
+from nnunetv2.training.dataloading.base_data_loader import nnUNetDataLoaderBase
+from nnunetv2.training.dataloading.nnunet_dataset import nnUNetDataset
+from nnunetv2.training.dataloading.utils import get_case_identifiers, get_chunk_shape, load_chunked, save_chunked, \
+    unpack_dataset
+
+
+def _random_case(rng, shape=(2, 13, 17, 11)):
+    data = rng.normal(size=shape).astype(np.float32)
+    seg = rng.integers(-1, 3, size=(1, *shape[1:])).astype(np.int8)
+    return data, seg
+
+
+def _write_npz_dataset(folder, rng, num_cases=3):
+    cases = {}
+    for i in range(num_cases):
+        case = f'case_{i}'
+        cases[case] = _random_case(rng)
+        np.savez_compressed(join(folder, case + '.npz'), data=cases[case][0], seg=cases[case][1])
+        save_pickle({'class_locations': {}}, join(folder, case + '.pkl'))
+    return cases
+
+
+def test_save_and_load_chunked(tmp_path):
+    rng = np.random.default_rng(0)
+    data, _ = _random_case(rng)
+    file = str(tmp_path / 'case.b2nd')
+    save_chunked(data, file, patch_size=(8, 8, 8))
+    loaded = load_chunked(file)
+    assert loaded.shape == data.shape and loaded.dtype == data.dtype
+    assert tuple(loaded.chunks) == get_chunk_shape(data.shape, (8, 8, 8)) == (1, 4, 4, 4)
+    np.testing.assert_array_equal(loaded[:], data)
+    np.testing.assert_array_equal(loaded[:, 3:9, 0:17, 5:6], data[:, 3:9, 0:17, 5:6])
+
+    # 2d patch sizes get chunks of a single slice
+    assert get_chunk_shape(data.shape, (8, 8)) == (1, 1, 4, 4)
+
+
+def test_chunked_dataset_matches_npz(tmp_path):
+    rng = np.random.default_rng(1)
+    folder = str(tmp_path)
+    cases = _write_npz_dataset(folder, rng)
+    unpack_dataset(folder, num_processes=1, chunked=True, patch_size=(8, 8, 8), remove_npz=True)
+
+    # the npz files were verified and removed, the cases are found through the .b2nd files
+    assert not any(i.endswith('.npz') for i in os.listdir(folder))
+    assert sorted(get_case_identifiers(folder)) == sorted(cases.keys())
+
+    dataset = nnUNetDataset(folder)
+    for case, (data, seg) in cases.items():
+        chunked_data, chunked_seg, _ = dataset.load_case(case)
+        np.testing.assert_array_equal(chunked_data[:], data)
+        np.testing.assert_array_equal(chunked_seg[:], seg)
+        # data loader crops read from the chunked arrays directly
+        target = np.empty((2, 8, 8, 8), dtype=np.float32)
+        nnUNetDataLoaderBase.crop_and_pad_into(target, chunked_data, [-3, 10, 4], [5, 18, 12], 0)
+        reference = np.zeros_like(target)
+        reference[:, 3:, :7, :7] = data[:, :5, 10:, 4:]
+        np.testing.assert_array_equal(target, reference)
+
+
+def test_npz_is_kept_without_remove_npz(tmp_path):
+    rng = np.random.default_rng(2)
+    folder = str(tmp_path)
+    cases = _write_npz_dataset(folder, rng, num_cases=1)
+    unpack_dataset(folder, num_processes=1, chunked=True, patch_size=(8, 8, 8))
+    assert sorted(os.listdir(folder)) == ['case_0.b2nd', 'case_0.npz', 'case_0.pkl', 'case_0_seg.b2nd']
+    data, seg, _ = nnUNetDataset(folder).load_case('case_0')
+    np.testing.assert_array_equal(data[:], cases['case_0'][0])
+    np.testing.assert_array_equal(seg[:], cases['case_0'][1])
@@ -0,0 +1,70 @@
+import pickle
+
+import numpy as np
+import pytest
+from batchgenerators.utilities.file_and_folder_operations import join, load_pickle, save_pickle
+
+from nnunetv2.training.dataloading.class_locations_index import ClassLocationsIndex, build_class_locations_index, \
+    maybe_build_class_locations_index
+
+
+def _write_cases(folder, class_locations):
+    for case, locs in class_locations.items():
+        np.savez_compressed(join(folder, case + '.npz'), data=np.zeros((1, 1, 1, 1), dtype=np.float32))
+        save_pickle({'spacing': (1, 1, 1), 'class_locations': locs}, join(folder, case + '.pkl'))
+
+
+def _random_locations(rng, classes, max_coord=100):
+    locs = {}
+    for k in classes:
+        n = int(rng.integers(0, 20))
+        locs[k] = rng.integers(0, max_coord, size=(n, 4)) if n > 0 else []
+    return locs
+
+
+def _assert_same_locations(from_index, from_pkl):
+    for k, locs in from_pkl.items():
+        assert len(from_index[k]) == len(locs)
+        if len(locs) > 0:
+            np.testing.assert_array_equal(from_index[k], locs)
+    # classes missing in this case come back empty
+    for k in set(from_index.keys()) - set(from_pkl.keys()):
+        assert len(from_index[k]) == 0
+
+
+@pytest.mark.parametrize('classes, max_coord', (([1, 2, 3], 100), ([(1, 2, 3), (2, 3), (3,)], 70000)))
+def test_index_matches_properties(tmp_path, classes, max_coord):
+    rng = np.random.default_rng(0)
+    folder = str(tmp_path)
+    class_locations = {f'case_{i}': _random_locations(rng, classes, max_coord) for i in range(6)}
+    # a case without one of the classes
+    del class_locations['case_3'][classes[1]]
+    _write_cases(folder, class_locations)
+
+    build_class_locations_index(folder, num_processes=1)
+    index = ClassLocationsIndex(folder)
+    assert index.coords.dtype == (np.uint16 if max_coord <= 65536 else np.uint32)
+    for case in class_locations:
+        assert case in index
+        _assert_same_locations(index.get(case), load_pickle(join(folder, case + '.pkl'))['class_locations'])
+
+    # data augmentation workers get a pickled copy that opens its own memmap
+    unpickled = pickle.loads(pickle.dumps(index))
+    assert unpickled._coords is None
+    _assert_same_locations(unpickled.get('case_0'), class_locations['case_0'])
+
+
+def test_maybe_build_rebuilds_for_new_cases(tmp_path):
+    rng = np.random.default_rng(1)
+    folder = str(tmp_path)
+    class_locations = {f'case_{i}': _random_locations(rng, [1, 2]) for i in range(3)}
+    _write_cases(folder, class_locations)
+    maybe_build_class_locations_index(folder, num_processes=1)
+    assert 'case_3' not in ClassLocationsIndex(folder)
+
+    class_locations['case_3'] = _random_locations(rng, [1, 2])
+    _write_cases(folder, {'case_3': class_locations['case_3']})
+    maybe_build_class_locations_index(folder, num_processes=1)
+    index = ClassLocationsIndex(folder)
+    for case in class_locations:
+        _assert_same_locations(index.get(case), class_locations[case])
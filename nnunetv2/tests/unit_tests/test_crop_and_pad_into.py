@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from nnunetv2.training.dataloading.base_data_loader import nnUNetDataLoaderBase
+
+
+def _crop_and_np_pad(source, bbox_lbs, bbox_ubs, pad_value):
+    # what the data loaders did before crop_and_pad_into
+    shape = source.shape[1:]
+    dim = len(shape)
+    valid_bbox_lbs = [max(0, bbox_lbs[i]) for i in range(dim)]
+    valid_bbox_ubs = [min(shape[i], bbox_ubs[i]) for i in range(dim)]
+    this_slice = tuple([slice(0, source.shape[0])] + [slice(i, j) for i, j in zip(valid_bbox_lbs, valid_bbox_ubs)])
+    cropped = source[this_slice]
+    padding = [(-min(0, bbox_lbs[i]), max(bbox_ubs[i] - shape[i], 0)) for i in range(dim)]
+    return np.pad(cropped, ((0, 0), *padding), 'constant', constant_values=pad_value)
+
+
+def _random_bbox(rng, shape, patch_size):
+    # bboxes as produced by get_bbox always overlap the image
+    lbs = [int(rng.integers(-p + 1, s)) for s, p in zip(shape, patch_size)]
+    return lbs, [lb + p for lb, p in zip(lbs, patch_size)]
+
+
+@pytest.mark.parametrize('dim', (2, 3))
+def test_crop_and_pad_into_matches_np_pad(dim):
+    rng = np.random.default_rng(0)
+    for _ in range(300):
+        shape = tuple(int(i) for i in rng.integers(1, 12, dim))
+        patch_size = tuple(int(i) for i in rng.integers(1, 16, dim))
+        source = rng.normal(size=(int(rng.integers(1, 4)), *shape)).astype(np.float32)
+        bbox_lbs, bbox_ubs = _random_bbox(rng, shape, patch_size)
+        pad_value = float(rng.choice([0, -1, 3.5]))
+        # garbage in target, everything must be overwritten
+        target = np.full((source.shape[0], *patch_size), np.nan, dtype=np.float32)
+        nnUNetDataLoaderBase.crop_and_pad_into(target, source, bbox_lbs, bbox_ubs, pad_value)
+        np.testing.assert_array_equal(target, _crop_and_np_pad(source, bbox_lbs, bbox_ubs, pad_value))
+
+
+def test_crop_and_pad_into_with_source_index():
+    rng = np.random.default_rng(1)
+    for _ in range(300):
+        shape = tuple(int(i) for i in rng.integers(1, 12, 3))
+        patch_size = tuple(int(i) for i in rng.integers(1, 16, 2))
+        source = rng.integers(-1, 4, size=(2, *shape)).astype(np.int16)
+        selected_slice = int(rng.integers(0, shape[0]))
+        bbox_lbs, bbox_ubs = _random_bbox(rng, shape[1:], patch_size)
+        target = np.full((2, *patch_size), 99, dtype=np.int16)
+        nnUNetDataLoaderBase.crop_and_pad_into(target, source, bbox_lbs, bbox_ubs, -1, (selected_slice,))
+        np.testing.assert_array_equal(target, _crop_and_np_pad(source[:, selected_slice], bbox_lbs, bbox_ubs, -1))
+
+
+def test_crop_and_pad_into_memmap(tmp_path):
+    rng = np.random.default_rng(2)
+    source = np.lib.format.open_memmap(tmp_path / 'data.npy', mode='w+', dtype=np.float32, shape=(2, 9, 10, 11))
+    source[:] = rng.normal(size=source.shape)
+    for bbox_lbs in ([-3, 2, 5], [0, 0, 0], [4, -6, 9]):
+        bbox_ubs = [lb + 8 for lb in bbox_lbs]
+        target = np.empty((2, 8, 8, 8), dtype=np.float32)
+        nnUNetDataLoaderBase.crop_and_pad_into(target, source, bbox_lbs, bbox_ubs, 0)
+        np.testing.assert_array_equal(target, _crop_and_np_pad(np.asarray(source), bbox_lbs, bbox_ubs, 0))
@@ -0,0 +1,75 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+
+from nnunetv2.inference.export_prediction import StreamingSegmentationExporter, \
+    convert_predicted_logits_to_segmentation_with_correct_shape
+from nnunetv2.utilities.label_handling.label_handling import LabelManager
+from nnunetv2.utilities.plans_handling.plans_handler import ConfigurationManager
+
+
+def _setup(network_spacing, original_spacing, source_shape, order=1, order_z=0, force_separate_z=None):
+    configuration_manager = ConfigurationManager({
+        'spacing': list(network_spacing),
+        'patch_size': [16, 16, 16],
+        'resampling_fn_probabilities': 'resample_data_or_seg_to_shape',
+        'resampling_fn_probabilities_kwargs': {'is_seg': False, 'order': order, 'order_z': order_z,
+                                               'force_separate_z': force_separate_z}})
+    label_manager = LabelManager({'background': 0, 'a': 1, 'b': 2}, regions_class_order=None)
+    plans_manager = SimpleNamespace(transpose_backward=[0, 1, 2])
+    target_shape = [int(round(s * n / o)) for s, n, o in zip(source_shape, network_spacing, original_spacing)]
+    properties = {'shape_after_cropping_and_before_resampling': target_shape, 'spacing': list(original_spacing),
+                  'shape_before_cropping': target_shape, 'bbox_used_for_cropping': [[0, i] for i in target_shape]}
+    return configuration_manager, label_manager, plans_manager, properties
+
+
+def _stream(logits, configuration_manager, label_manager, properties, chunk_sizes):
+    exporter = StreamingSegmentationExporter(logits.shape[1:], configuration_manager, label_manager, properties)
+    start = 0
+    for n in chunk_sizes:
+        exporter.add_chunk(logits[:, start:start + n])
+        start += n
+    assert start == logits.shape[1]
+    return exporter.get_segmentation()
+
+
+def _random_chunk_sizes(total, rng, max_size=4):
+    sizes = []
+    while sum(sizes) < total:
+        sizes.append(int(min(rng.randint(1, max_size + 1), total - sum(sizes))))
+    return sizes
+
+
+@pytest.mark.parametrize('network_spacing,original_spacing,source_shape,force_separate_z', [
+    # anisotropic, first axis downsampled with order_z (the case that lost rows)
+    ((3, 1, 1), (5, 0.8, 0.8), (40, 24, 20), None),
+    # first axis upsampled
+    ((1, 1, 1), (0.6, 1.3, 0.9), (23, 20, 18), None),
+    # isotropic downsampling of all axes
+    ((1, 1, 1), (2.3, 1.7, 1.2), (37, 21, 19), None),
+    # exact 2x down- and upsampling along z with order_z=0, source coordinates land on .5
+    ((2.5, 1, 1), (5, 1, 1), (40, 16, 12), True),
+    ((5, 1, 1), (2.5, 1, 1), (17, 16, 12), True),
+])
+def test_streaming_export_matches_regular_export(network_spacing, original_spacing, source_shape, force_separate_z):
+    configuration_manager, label_manager, plans_manager, properties = _setup(network_spacing, original_spacing,
+                                                                             source_shape,
+                                                                             force_separate_z=force_separate_z)
+    torch.manual_seed(0)
+    logits = torch.randn(3, *source_shape)
+    reference = convert_predicted_logits_to_segmentation_with_correct_shape(
+        logits.clone(), plans_manager, configuration_manager, label_manager, properties, num_threads_torch=1)
+
+    rng = np.random.RandomState(1)
+    for chunk_sizes in ([source_shape[0]], [1] * source_shape[0], _random_chunk_sizes(source_shape[0], rng),
+                        _random_chunk_sizes(source_shape[0], rng, 7)):
+        segmentation = _stream(logits, configuration_manager, label_manager, properties, chunk_sizes)
+        np.testing.assert_array_equal(segmentation, reference)
+
+
+def test_is_supported():
+    configuration_manager = _setup((1, 1, 1), (1, 1, 1), (8, 8, 8))[0]
+    assert StreamingSegmentationExporter.is_supported(configuration_manager)
+    assert not StreamingSegmentationExporter.is_supported(_setup((1, 1, 1), (1, 1, 1), (8, 8, 8), order=3)[0])
@@ -0,0 +1,190 @@
+from typing import Tuple, Union
+
+import numpy as np
+import torch
+from batchgenerators.augmentations.utils import create_matrix_rotation_2d, create_matrix_rotation_x_3d, \
+    create_matrix_rotation_y_3d, create_matrix_rotation_z_3d
+from batchgenerators.transforms.abstract_transforms import AbstractTransform, Compose
+from batchgenerators.transforms.spatial_transforms import SpatialTransform
+from torch.nn import functional as F
+
+
+class BatchedSpatialTransform(AbstractTransform):
+    def __init__(self, patch_size: Union[Tuple[int, ...], np.ndarray],
+                 angle_x: Tuple[float, float] = (0, 2 * np.pi),
+                 angle_y: Tuple[float, float] = (0, 2 * np.pi),
+                 angle_z: Tuple[float, float] = (0, 2 * np.pi),
+                 p_rot_per_axis: float = 1,
+                 scale: Tuple[float, float] = (0.75, 1.25),
+                 border_cval_data: float = 0,
+                 border_cval_seg: int = -1,
+                 order_data: int = 3,
+                 p_scale_per_sample: float = 1,
+                 p_rot_per_sample: float = 1,
+                 device: Union[str, torch.device] = 'cpu',
+                 data_key: str = "data", label_key: str = "seg"):
+        """
+        Rotation and scaling like batchgenerators' SpatialTransform (same parameters and sampling, no elastic
+        deformation, center crop, constant border), but the samples of a batch that are rotated/scaled are resampled
+        together: one affine grid per sample and a single torch grid_sample call for data and one for seg. Samples
+        that are neither rotated nor scaled are center cropped as in SpatialTransform.
+
+        Runs in the data augmentation workers (device='cpu') or on the training device (only possible if the
+        transform is called from the main process or from threads, see nnUNet_DA_backend). Input and output are
+        numpy arrays so that the remaining batchgenerators transforms work as before.
+
+        Like map_coordinates with mode='constant', positions that sample outside of the input get border_cval_data /
+        border_cval_seg. With order_data=1 the result matches SpatialTransform up to float32 rounding.
+        Differences to SpatialTransform: grid_sample has no cubic interpolation for 3D, so order_data=3 is cubic
+        convolution (not a spline) for 2D and linear for 3D. The segmentation is resampled with linear interpolation
+        of the one hot encoding and argmax (order_seg=1 in SpatialTransform), exact ties are not settled by the
+        nearest neighbour.
+        """
+        self.patch_size = tuple(int(i) for i in patch_size)
+        self.angle_x = angle_x
+        self.angle_y = angle_y
+        self.angle_z = angle_z
+        self.p_rot_per_axis = p_rot_per_axis
+        self.scale = scale
+        self.border_cval_data = border_cval_data
+        self.border_cval_seg = border_cval_seg
+        self.order_data = order_data
+        self.p_scale_per_sample = p_scale_per_sample
+        self.p_rot_per_sample = p_rot_per_sample
+        self.device = torch.device(device)
+        self.data_key = data_key
+        self.label_key = label_key
+
+    @staticmethod
+    def can_replace(transform: SpatialTransform) -> bool:
+        """only rotation/scaling with constant border, no elastic deformation and no random crop"""
+        return isinstance(transform, SpatialTransform) and transform.patch_size is not None and \
+            not (transform.do_elastic_deform and transform.p_el_per_sample > 0) and not transform.random_crop and \
+            not transform.independent_scale_for_each_axis and transform.border_mode_data == 'constant' and \
+            transform.border_mode_seg == 'constant'
+
+    @classmethod
+    def from_spatial_transform(cls, transform: SpatialTransform, device: Union[str, torch.device] = 'cpu'):
+        """takes over the rotation/scaling parameters of a SpatialTransform (see can_replace)"""
+        return cls(transform.patch_size,
+                   transform.angle_x if transform.do_rotation else (0, 0),
+                   transform.angle_y if transform.do_rotation else (0, 0),
+                   transform.angle_z if transform.do_rotation else (0, 0),
+                   transform.p_rot_per_axis, transform.scale, transform.border_cval_data, transform.border_cval_seg,
+                   transform.order_data, transform.p_scale_per_sample if transform.do_scale else 0,
+                   transform.p_rot_per_sample if transform.do_rotation else 0, device,
+                   transform.data_key, transform.label_key)
+
+    def _sample_matrix(self, dim: int) -> Union[np.ndarray, None]:
+        """random rotation/scaling matrix of one sample (same draws as augment_spatial), None if not augmented"""
+        matrix = None
+        if np.random.uniform() < self.p_rot_per_sample:
+            a_x = np.random.uniform(*self.angle_x) if np.random.uniform() <= self.p_rot_per_axis else 0
+            if dim == 3:
+                a_y = np.random.uniform(*self.angle_y) if np.random.uniform() <= self.p_rot_per_axis else 0
+                a_z = np.random.uniform(*self.angle_z) if np.random.uniform() <= self.p_rot_per_axis else 0
+                matrix = create_matrix_rotation_z_3d(a_z, create_matrix_rotation_y_3d(
+                    a_y, create_matrix_rotation_x_3d(a_x, np.identity(3))))
+            else:
+                matrix = create_matrix_rotation_2d(a_x)
+        if np.random.uniform() < self.p_scale_per_sample:
+            if np.random.random() < 0.5 and self.scale[0] < 1:
+                sc = np.random.uniform(self.scale[0], 1)
+            else:
+                sc = np.random.uniform(max(self.scale[0], 1), self.scale[1])
+            matrix = (matrix if matrix is not None else np.identity(dim)) * sc
+        return matrix
+
+    def _affine_grid(self, matrices: np.ndarray, input_shape: Tuple[int, ...]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        returns the sampling grid (float32) and a mask (b, *patch_size) of the positions that lie outside of the input
+        """
+        # augment_spatial samples the input at x @ matrix + (input_shape - 1) / 2 where x are the zero centered
+        # output coordinates. With align_corners=True that is theta = D_in @ matrix.T @ D_out in normalized
+        # coordinates, with axes reversed because grid_sample's grids are (x, y, z) = (W, H, D)
+        dim = len(input_shape)
+        d_out = np.diag((np.array(self.patch_size) - 1) / 2.)
+        d_in = np.diag(2. / np.maximum(np.array(input_shape) - 1, 1))
+        theta = d_in[None] @ np.transpose(matrices, (0, 2, 1)) @ d_out[None]
+        theta = theta[:, ::-1, ::-1]
+        theta = np.concatenate((theta, np.zeros((len(matrices), dim, 1))), axis=2)
+        theta = torch.from_numpy(np.ascontiguousarray(theta)).to(self.device)
+        # float64 so that positions on the border of the input are not pushed outside by rounding errors
+        grid = F.affine_grid(theta, [len(matrices), 1, *self.patch_size], align_corners=True)
+        # map_coordinates (mode='constant') returns cval for coordinates outside [0, s - 1], grid_sample would blend
+        # with the zero padding there. These are masked after sampling
+        outside = (grid.abs() > 1).any(-1)
+        return grid.float(), outside
+
+    def _resample_data(self, data: torch.Tensor, grid: torch.Tensor, outside: torch.Tensor) -> torch.Tensor:
+        mode = 'bicubic' if self.order_data == 3 and data.ndim == 4 else \
+            ('nearest' if self.order_data == 0 else 'bilinear')
+        # grid_sample pads with zeros, shifting by cval gives a constant border of cval
+        if self.border_cval_data != 0:
+            data = data - self.border_cval_data
+        data = F.grid_sample(data, grid, mode=mode, padding_mode='zeros', align_corners=True)
+        if self.border_cval_data != 0:
+            data += self.border_cval_data
+        data.masked_fill_(outside[:, None], self.border_cval_data)
+        return data
+
+    def _resample_seg(self, seg: torch.Tensor, grid: torch.Tensor, outside: torch.Tensor) -> torch.Tensor:
+        b, c = seg.shape[:2]
+        labels = torch.unique(seg)
+        # (b, c * num_labels, ...) one hot, interpolated in one go
+        one_hot = (seg[:, :, None] == labels.view(1, 1, -1, *([1] * (seg.ndim - 2)))).float()
+        one_hot = one_hot.view(b, c * len(labels), *seg.shape[2:])
+        scores = F.grid_sample(one_hot, grid, mode='bilinear', padding_mode='zeros', align_corners=True)
+        scores = scores.view(b, c, len(labels), *self.patch_size)
+        best, idx = scores.max(2)
+        result = labels[idx]
+        # outside of the image no label scores
+        result[best <= 0] = self.border_cval_seg
+        result.masked_fill_(outside[:, None], self.border_cval_seg)
+        return result
+
+    def __call__(self, **data_dict):
+        data = data_dict.get(self.data_key)
+        seg = data_dict.get(self.label_key)
+        dim = len(self.patch_size)
+        input_shape = data.shape[2:]
+        b = data.shape[0]
+
+        data_result = np.zeros((b, data.shape[1], *self.patch_size), dtype=np.float32)
+        seg_result = np.zeros((b, seg.shape[1], *self.patch_size), dtype=np.float32) if seg is not None else None
+
+        matrices = [self._sample_matrix(dim) for _ in range(b)]
+        can_crop = all(i >= j for i, j in zip(input_shape, self.patch_size))
+        resample = [i for i in range(b) if matrices[i] is not None or not can_crop]
+        if can_crop:
+            # same as center_crop_aug
+            lbs = [(i - j) // 2 for i, j in zip(input_shape, self.patch_size)]
+            slicer = tuple(slice(lb, lb + p) for lb, p in zip(lbs, self.patch_size))
+            for i in range(b):
+                if matrices[i] is None:
+                    data_result[i] = data[(i, slice(None)) + slicer]
+                    if seg is not None:
+                        seg_result[i] = seg[(i, slice(None)) + slicer]
+
+        if len(resample) > 0:
+            grid, outside = self._affine_grid(np.stack([matrices[i] if matrices[i] is not None else np.identity(dim)
+                                                        for i in resample]), input_shape)
+            with torch.no_grad():
+                d = torch.from_numpy(np.ascontiguousarray(data[resample])).to(self.device, torch.float32)
+                data_result[resample] = self._resample_data(d, grid, outside).cpu().numpy()
+                if seg is not None:
+                    s = torch.from_numpy(np.ascontiguousarray(seg[resample])).to(self.device)
+                    seg_result[resample] = self._resample_seg(s, grid, outside).cpu().numpy()
+
+        data_dict[self.data_key] = data_result
+        if seg is not None:
+            data_dict[self.label_key] = seg_result
+        return data_dict
+
+
+def replace_spatial_transforms(transforms: Compose, device: Union[str, torch.device] = 'cpu') -> Compose:
+    """replaces the SpatialTransforms in transforms.transforms that BatchedSpatialTransform can do (in place)"""
+    for i, t in enumerate(transforms.transforms):
+        if BatchedSpatialTransform.can_replace(t):
+            transforms.transforms[i] = BatchedSpatialTransform.from_spatial_transform(t, device)
+    return transforms
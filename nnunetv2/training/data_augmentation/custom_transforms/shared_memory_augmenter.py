@@ -0,0 +1,301 @@
+import queue
+import threading
+import traceback
+from copy import copy
+from time import time
+from typing import Union
+
+import numpy as np
+import torch
+from torch import multiprocessing as mp
+from batchgenerators.dataloading.data_loader import DataLoader
+from threadpoolctl import threadpool_limits
+
+# per worker counters in the shared stats array
+_NUM_BATCHES, _PRODUCE_TIME, _WAIT_FOR_SLOT_TIME = range(3)
+
+
+def _is_array(v) -> bool:
+    # numeric arrays/tensors only, e.g. 'keys' is an array of strings
+    return isinstance(v, torch.Tensor) or (isinstance(v, np.ndarray) and v.dtype.kind in 'biufc')
+
+
+def _split_batch(item: dict):
+    """
+    splits a batch into its arrays/tensors (keyed by (key, index in list or None)) and everything else (meta, sent
+    through the queue)
+    """
+    leaves, meta = {}, {}
+    for k, v in item.items():
+        if _is_array(v):
+            leaves[(k, None)] = v
+        elif isinstance(v, (list, tuple)) and len(v) > 0 and all(_is_array(i) for i in v):
+            for i, vv in enumerate(v):
+                leaves[(k, i)] = vv
+        else:
+            meta[k] = v
+    return leaves, meta
+
+
+def _ring_producer(data_loader, transform, worker_id: int, slots, free_slots, ready_slots, abort_event, stats,
+                   seed: Union[int, None], wait_time: float):
+    torch.set_num_threads(1)
+    if seed is not None:
+        torch.manual_seed(seed)
+    np.random.seed(seed)
+
+    with threadpool_limits(1, None):
+        data_loader.set_thread_id(worker_id)
+        try:
+            while not abort_event.is_set():
+                start = time()
+                item = next(data_loader)
+                if transform is not None:
+                    item = transform(**item)
+                leaves, meta = _split_batch(item)
+                produced = time()
+
+                slot = None
+                while slot is None:
+                    if abort_event.is_set():
+                        return
+                    try:
+                        slot = free_slots.get(timeout=wait_time)
+                    except queue.Empty:
+                        pass
+                got_slot = time()
+
+                for k, v in leaves.items():
+                    if isinstance(v, np.ndarray):
+                        v = torch.from_numpy(v)
+                    slots[slot][k].copy_(v)
+                ready_slots.put((slot, worker_id, meta))
+
+                stats[worker_id * 3 + _NUM_BATCHES] += 1
+                stats[worker_id * 3 + _PRODUCE_TIME] += produced - start + time() - got_slot
+                stats[worker_id * 3 + _WAIT_FOR_SLOT_TIME] += got_slot - produced
+        except KeyboardInterrupt:
+            abort_event.set()
+        except Exception as e:
+            print("Exception in background worker %d:\n" % worker_id, e)
+            traceback.print_exc()
+            abort_event.set()
+
+
+def _pin_shared_tensor(t: torch.Tensor) -> bool:
+    # page-locks the shared memory in place (tensor.pin_memory() would make a copy that is not shared)
+    try:
+        return torch.cuda.cudart().cudaHostRegister(t.data_ptr(), t.numel() * t.element_size(), 0) == 0
+    except Exception:
+        return False
+
+
+class SharedMemoryRingAugmenter(object):
+    """
+    Alternative to LimitedLenWrapper (NonDetMultiThreadedAugmenter). Workers (processes, or threads with
+    use_threads=True) run data loader + transforms and write the augmented batches into a ring of num_cached
+    preallocated batches in shared memory (page-locked when CUDA is available) instead of pickling them through a
+    multiprocessing queue. Only the slot index and the small non array entries (keys, properties) go through the
+    queue. The shapes are taken from one batch that is generated in the main process when starting.
+
+    The tensors returned by next() are views into the ring: they stay valid until the following call to next(),
+    then the slot is handed back to the workers. nnU-Net's train/validation steps are done with a batch by then.
+
+    get_stats() reports batches, throughput and time waiting for a free slot per worker as well as how long the
+    consumer waited for batches and how many batches were ready on average (queue depth). Consumer waits >> 0 with an
+    empty queue mean data augmentation is the bottleneck, workers waiting for slots mean the GPU is.
+    Like NonDetMultiThreadedAugmenter, batch order is not deterministic.
+    """
+    def __init__(self, my_imaginary_length: int, data_loader, transform, num_processes: int, num_cached: int = 6,
+                 seeds=None, pin_memory: bool = False, wait_time: float = 0.02, use_threads: bool = False):
+        if isinstance(data_loader, DataLoader):
+            assert data_loader.infinite, "Only use DataLoader instances that have infinite=True"
+        assert num_cached >= 2, 'need at least two slots, one is held by the consumer'
+        self.len = my_imaginary_length
+        self.generator = data_loader
+        self.transform = transform
+        self.num_processes = num_processes
+        self.num_cached = num_cached
+        self.seeds = seeds if seeds is not None else [None] * num_processes
+        assert len(self.seeds) == num_processes
+        self.pin_memory = pin_memory
+        self.wait_time = wait_time
+        self.use_threads = use_threads
+
+        self.initialized = False
+        self._workers = []
+        self._slots = None
+        self._leaf_is_numpy = None
+        self._current_slot = None
+        self.pinned = False
+        self.reset_stats()
+
+    def __len__(self):
+        return self.len
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self.__next__()
+
+    def _start(self):
+        if self.initialized:
+            return
+        # one batch in the main process tells us what to allocate
+        item = next(self.generator)
+        if self.transform is not None:
+            item = self.transform(**item)
+        leaves, _ = _split_batch(item)
+        self._leaf_is_numpy = {k: isinstance(v, np.ndarray) for k, v in leaves.items()}
+        self._slots = []
+        for _ in range(self.num_cached):
+            slot = {}
+            for k, v in leaves.items():
+                v = torch.from_numpy(v) if isinstance(v, np.ndarray) else v
+                slot[k] = torch.empty(v.shape, dtype=v.dtype) if self.use_threads else \
+                    torch.empty(v.shape, dtype=v.dtype).share_memory_()
+            self._slots.append(slot)
+        if self.pin_memory and torch.cuda.is_available():
+            self.pinned = all(_pin_shared_tensor(t) for slot in self._slots for t in slot.values())
+
+        ctx = None if self.use_threads else mp.get_context('fork')
+        self._free_slots = queue.Queue() if self.use_threads else ctx.Queue()
+        self._ready_slots = queue.Queue() if self.use_threads else ctx.Queue()
+        for i in range(self.num_cached):
+            self._free_slots.put(i)
+        self._abort_event = threading.Event() if self.use_threads else ctx.Event()
+        self._stats = [0.] * (3 * self.num_processes) if self.use_threads else \
+            ctx.Array('d', 3 * self.num_processes, lock=False)
+        if isinstance(self.generator, DataLoader):
+            self.generator.was_initialized = False
+
+        worker_class = threading.Thread if self.use_threads else ctx.Process
+        self._workers = [worker_class(target=_ring_producer, args=(
+            self._get_worker_data_loader(), self.transform, i, self._slots, self._free_slots, self._ready_slots, self._abort_event,
+            self._stats, self.seeds[i], self.wait_time), daemon=True) for i in range(self.num_processes)]
+        for w in self._workers:
+            w.start()
+        self.reset_stats()
+        self.initialized = True
+
+    def _get_worker_data_loader(self):
+        if not self.use_threads:
+            # forked processes have their own copy anyway
+            return self.generator
+        # threads need their own loader object (thread id, reused batch arrays). Shallow, the dataset is shared
+        data_loader = copy(self.generator)
+        if hasattr(data_loader, '_batch_buffers'):
+            data_loader._batch_buffers = None
+        return data_loader
+
+    def reset_stats(self):
+        if len(self._workers) > 0:
+            for i in range(len(self._stats)):
+                self._stats[i] = 0
+        self._stats_start = time()
+        self._num_consumed = 0
+        self._consumer_wait_time = 0.
+        self._queue_depth_sum = 0
+
+    def get_stats(self) -> dict:
+        if not self.initialized:
+            return {}
+        elapsed = max(time() - self._stats_start, 1e-8)
+        workers = []
+        for i in range(self.num_processes):
+            n = self._stats[i * 3 + _NUM_BATCHES]
+            workers.append({'batches': int(n),
+                            'batches_per_s': n / elapsed,
+                            'produce_time_per_batch': self._stats[i * 3 + _PRODUCE_TIME] / max(n, 1),
+                            'wait_for_slot_time': self._stats[i * 3 + _WAIT_FOR_SLOT_TIME]})
+        return {'elapsed': elapsed,
+                'consumed_batches': self._num_consumed,
+                'consumer_wait_time': self._consumer_wait_time,
+                'mean_queue_depth': self._queue_depth_sum / max(self._num_consumed, 1),
+                'pinned': self.pinned,
+                'workers': workers}
+
+    def format_stats(self) -> str:
+        s = self.get_stats()
+        if len(s) == 0:
+            return 'not started'
+        total = sum(w['batches_per_s'] for w in s['workers'])
+        per_worker = ', '.join(f"{w['batches_per_s']:.2f} ({w['produce_time_per_batch']:.2f} s/batch, "
+                               f"{w['wait_for_slot_time']:.1f} s waiting for a slot)" for w in s['workers'])
+        return f"{total:.2f} batches/s from {self.num_processes} workers [{per_worker}], " \
+               f"consumer waited {s['consumer_wait_time']:.1f} s for {s['consumed_batches']} batches, mean queue " \
+               f"depth {s['mean_queue_depth']:.2f}/{self.num_cached}"
+
+    def __next__(self):
+        if not self.initialized:
+            self._start()
+        # the previous batch is done, its slot can be filled again
+        if self._current_slot is not None:
+            self._free_slots.put(self._current_slot)
+            self._current_slot = None
+
+        start = time()
+        try:
+            self._queue_depth_sum += self._ready_slots.qsize()
+        except NotImplementedError:
+            # qsize is not available on macOS
+            pass
+        while True:
+            if self._abort_event.is_set() or not all(w.is_alive() for w in self._workers):
+                self._finish()
+                raise RuntimeError("One or more background workers are no longer alive. Exiting. Please check the "
+                                   "print statements above for the actual error message")
+            try:
+                slot, worker_id, meta = self._ready_slots.get(timeout=self.wait_time)
+                break
+            except queue.Empty:
+                continue
+        self._consumer_wait_time += time() - start
+        self._num_consumed += 1
+        self._current_slot = slot
+
+        item = dict(meta)
+        for (k, i), t in self._slots[slot].items():
+            v = t.numpy() if self._leaf_is_numpy[(k, i)] else t
+            if i is None:
+                item[k] = v
+            else:
+                if k not in item:
+                    item[k] = []
+                item[k].append(v)
+        return item
+
+    def _finish(self, timeout: float = 10):
+        if not self.initialized and len(self._workers) == 0:
+            return
+        self._abort_event.set()
+        deadline = time() + timeout
+        for w in self._workers:
+            w.join(timeout=max(0., deadline - time()))
+        if not self.use_threads:
+            for w in self._workers:
+                if w.is_alive():
+                    w.terminate()
+                w.join(timeout=1.0)
+            # only slot indices are queued, nothing worth draining (a terminated worker may also have left a
+            # partial message in the pipe)
+            for q in (self._free_slots, self._ready_slots):
+                q.cancel_join_thread()
+                q.close()
+        if self.pinned:
+            for slot in self._slots:
+                for t in slot.values():
+                    torch.cuda.cudart().cudaHostUnregister(t.data_ptr())
+            self.pinned = False
+        self._workers = []
+        self._slots = None
+        self._current_slot = None
+        self.initialized = False
+
+    def restart(self):
+        self._finish()
+        self._start()
+
+    def __del__(self):
+        self._finish(timeout=2)
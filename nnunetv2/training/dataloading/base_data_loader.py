@@ -41,6 +41,11 @@ class nnUNetDataLoaderBase(DataLoader):
         self.has_ignore = label_manager.has_ignore_label
         self.get_do_oversample = self._oversample_last_XX_percent if not probabilistic_oversampling \
             else self._probabilistic_oversampling
+        # generate_train_batch writes into the same data/seg arrays in every iteration. Only safe if the batch is
+        # copied before the next one is generated, e.g. by a SpatialTransform (the trainer sets this, see
+        # nnUNetTrainer.get_dataloaders). Otherwise every batch gets new arrays
+        self.reuse_batch_buffers = False
+        self._batch_buffers = None
 
     def _oversample_last_XX_percent(self, sample_idx: int) -> bool:
         """
@@ -54,13 +59,47 @@ class nnUNetDataLoaderBase(DataLoader):
 
     def determine_shapes(self):
         # load one case
-        data, seg, properties = self._data.load_case(self.indices[0])
+        data, seg, properties = self._data.load_case(self.indices[0], class_locations_only=True)
         num_color_channels = data.shape[0]
 
         data_shape = (self.batch_size, num_color_channels, *self.patch_size)
         seg_shape = (self.batch_size, seg.shape[0], *self.patch_size)
         return data_shape, seg_shape
 
+    def get_batch_buffers(self):
+        """
+        returns data_all and seg_all for the next batch. Not initialized, every sample slot is completely overwritten
+        by crop_and_pad_into
+        """
+        if self.reuse_batch_buffers and self._batch_buffers is not None:
+            return self._batch_buffers
+        buffers = np.empty(self.data_shape, dtype=np.float32), np.empty(self.seg_shape, dtype=np.int16)
+        if self.reuse_batch_buffers:
+            self._batch_buffers = buffers
+        return buffers
+
+    @staticmethod
+    def crop_and_pad_into(target: np.ndarray, source, bbox_lbs: List[int], bbox_ubs: List[int],
+                          pad_value: Union[int, float], source_index: Tuple[int, ...] = ()) -> None:
+        """
+        writes source[:, bbox] into target (c, *patch_size). Parts of the bbox outside of source are filled with
+        pad_value. Same result as cropping to the valid part of the bbox and np.pad, but only the valid region is
+        read from source (memmap or chunked array) and nothing else is allocated.
+        source_index selects along the first spatial axes of source before the bbox is applied to the remaining ones,
+        e.g. (slice_idx,) reads source[:, slice_idx][:, bbox] in one go (2d data loader)
+        """
+        shape = source.shape[1 + len(source_index):]
+        dim = len(shape)
+        valid_bbox_lbs = [max(0, bbox_lbs[i]) for i in range(dim)]
+        valid_bbox_ubs = [max(valid_bbox_lbs[i], min(shape[i], bbox_ubs[i])) for i in range(dim)]
+        if any(valid_bbox_lbs[i] != bbox_lbs[i] or valid_bbox_ubs[i] != bbox_ubs[i] for i in range(dim)):
+            target.fill(pad_value)
+        target_slice = tuple([slice(0, source.shape[0])] + [slice(valid_bbox_lbs[i] - bbox_lbs[i],
+                                                                  valid_bbox_ubs[i] - bbox_lbs[i]) for i in range(dim)])
+        source_slice = tuple([slice(0, source.shape[0]), *source_index] +
+                             [slice(i, j) for i, j in zip(valid_bbox_lbs, valid_bbox_ubs)])
+        target[target_slice] = source[source_slice]
+
     def get_bbox(self, data_shape: np.ndarray, force_fg: bool, class_locations: Union[dict, None],
                  overwrite_class: Union[int, Tuple[int, ...]] = None, verbose: bool = False):
         # in dataloader 2d we need to select the slice prior to this and also modify the class_locations to only have
@@ -129,7 +168,8 @@ class nnUNetDataLoaderBase(DataLoader):
                 # selected voxel is center voxel. Subtract half the patch size to get lower bbox voxel.
                 # Make sure it is within the bounds of lb and ub
                 # i + 1 because we have first dimension 0!
-                bbox_lbs = [max(lbs[i], selected_voxel[i + 1] - self.patch_size[i] // 2) for i in range(dim)]
+                # int() because the class locations index stores unsigned coordinates
+                bbox_lbs = [max(lbs[i], int(selected_voxel[i + 1]) - self.patch_size[i] // 2) for i in range(dim)]
             else:
                 # If the image does not contain any foreground classes, we fall back to random cropping
                 bbox_lbs = [np.random.randint(lbs[i], ubs[i] + 1) for i in range(dim)]
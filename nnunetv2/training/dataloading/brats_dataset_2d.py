@@ -4,25 +4,93 @@ import numpy as np
 from torch.utils.data import Dataset
 import json
 from pathlib import Path
-from glob import glob
+import multiprocessing
 import nibabel as nib
 
+from nnunetv2.configuration import default_num_processes
+
+
+def find_seg_file(subject_dir):
+    """first *seg.nii.gz in the subject folder (what glob(f"{root_dir}/**/{subject}/*seg.nii.gz")[0] found)"""
+    return sorted(i.path for i in os.scandir(subject_dir) if i.name.endswith('seg.nii.gz'))[0]
+
+
+def count_tumour_voxels(mask_path):
+    """returns the number of ET (label 4) and NCR/NET (label 1) voxels of a BraTS segmentation"""
+    # the labels are stored as integers, reading the raw data avoids get_fdata's float64 copy
+    seg = np.asanyarray(nib.load(mask_path).dataobj)
+    return int(np.count_nonzero(seg == 4)), int(np.count_nonzero(seg == 1))
+
+
+def list_subjects(root_dir):
+    """returns subjects, is_hgg and subject folders of root_dir/{LGG,HGG}/<subject>"""
+    subjects, is_hgg, subject_dirs = [], [], []
+    for label in sorted(Path(root_dir).iterdir()):
+        if label.stem not in ['LGG', 'HGG']:
+            continue
+        for subject in sorted(label.iterdir()):
+            subjects.append(subject.stem)
+            is_hgg.append(0 if label.stem == 'LGG' else 1)
+            subject_dirs.append(str(subject))
+    return subjects, is_hgg, subject_dirs
+
+
+def build_tumour_composition_table(root_dir, output_file, num_processes=default_num_processes):
+    """
+    Scans root_dir/{LGG,HGG}/<subject> once and writes an npz with one row per subject: subject, is_hgg, mask_path
+    and the ET/NCR-NET voxel counts and ratios (over the tumour core ET + NCR/NET) that BRATSDataset.cal_perc computes.
+    The segmentations are read in parallel. root_dir is stored as well (see tumour_composition_table_is_current)
+    """
+    subjects, is_hgg, subject_dirs = list_subjects(root_dir)
+
+    with multiprocessing.get_context("spawn").Pool(num_processes) as pool:
+        mask_paths = pool.map(find_seg_file, subject_dirs)
+        counts = np.array(pool.map(count_tumour_voxels, mask_paths), dtype=np.int64).reshape(-1, 2)
+
+    tumour_core = counts.sum(1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = counts / tumour_core[:, None]
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    # through a file handle, np.savez would append .npz to other file names
+    with open(output_file, 'wb') as f:
+        np.savez(f, root_dir=np.array(os.path.abspath(root_dir)), subject=np.array(subjects),
+                 is_hgg=np.array(is_hgg, dtype=np.uint8), mask_path=np.array(mask_paths), ET_count=counts[:, 0],
+                 NCRNET_count=counts[:, 1], ET=ratios[:, 0], NCRNET=ratios[:, 1])
+    return output_file
+
+
+def tumour_composition_table_is_current(table_file, root_dir):
+    """whether table_file was built from root_dir and lists the subjects (and LGG/HGG labels) root_dir has now"""
+    if not os.path.isfile(table_file):
+        return False
+    table = np.load(table_file)
+    if 'root_dir' not in table.files or str(table['root_dir']) != os.path.abspath(root_dir):
+        return False
+    subjects, is_hgg, _ = list_subjects(root_dir)
+    return table['subject'].tolist() == subjects and table['is_hgg'].tolist() == is_hgg
+
+
 class BRATSDataset(Dataset):
     def __init__(self, root_dir,
                        train, 
                        train_transform=None, 
                        val_transform=None, 
                        fold=0, 
-                       preprocessed_data_dir="/tmp/htluc/nnunet/nnUNet_preprocessed/Dataset032_BraTS2018"):
+                       preprocessed_data_dir="/tmp/htluc/nnunet/nnUNet_preprocessed/Dataset032_BraTS2018",
+                       composition_table=None):
+        """
+        composition_table: npz written by build_tumour_composition_table (labels, mask paths and ET, NCR/NET
+        ratios of every subject). Defaults to preprocessed_data_dir/tumour_composition.npz and is (re)built there if it
+        does not exist yet or was built from another root_dir or subject list
+        """
 
         self.root_dir = root_dir
         self.preprocessed_data_path = os.path.join(preprocessed_data_dir,"nnUNetPlans_3d_fullres")
         
-        self.label_dict = {}
-        mask_dict = {}
         self.paths = []
         self.labels = []
         self.masks_name = []
+        self.percents = []
         
         self.train = train
         self.train_transform = train_transform
@@ -31,48 +99,35 @@ class BRATSDataset(Dataset):
         with open(f"{preprocessed_data_dir}/splits_final.json", "r") as f:
             self.dataset_json = json.load(f)[0]
             
-        for label in Path(root_dir).iterdir():
-            if label.stem not in ['LGG', 'HGG']:
-                continue
-            for subject in label.iterdir():
-                self.label_dict[subject.stem] = 0 if label.stem == 'LGG' else 1
-                mask_dict[subject.stem]  = glob(f"{self.root_dir}/**/{subject.stem}/*seg.nii.gz")[0]
-                
+        if composition_table is None:
+            composition_table = os.path.join(preprocessed_data_dir, "tumour_composition.npz")
+        if not tumour_composition_table_is_current(composition_table, root_dir):
+            print(f"Building tumour composition table {composition_table}")
+            build_tumour_composition_table(root_dir, composition_table)
+        table = np.load(composition_table)
+        row = {subject: i for i, subject in enumerate(table['subject'])}
+        self.label_dict = {subject: int(table['is_hgg'][i]) for subject, i in row.items()}
 
-        
-        if self.train:
-            for filename in self.dataset_json["train"]:
-                self.paths.append(self.preprocessed_data_path + "/" + filename + ".npy")
-                self.labels.append(self.label_dict[filename])
-                self.masks_name.append(mask_dict[filename])
-            print("Train LGG: ", len(np.array(self.labels)[np.array(self.labels) == 0]))
-        else:
-            for filename in self.dataset_json["val"]:
-                self.paths.append(self.preprocessed_data_path + "/" + filename + ".npy")
-                self.labels.append(self.label_dict[filename])
-                self.masks_name.append(mask_dict[filename])
-            print("Val LGG: ", len(np.array(self.labels)[np.array(self.labels) == 0]))
+        for filename in self.dataset_json["train" if self.train else "val"]:
+            i = row[filename]
+            self.paths.append(self.preprocessed_data_path + "/" + filename + ".npy")
+            self.labels.append(self.label_dict[filename])
+            self.masks_name.append(str(table['mask_path'][i]))
+            self.percents.append((float(table['ET'][i]), float(table['NCRNET'][i])))
+        print("Train LGG: " if self.train else "Val LGG: ", len(np.array(self.labels)[np.array(self.labels) == 0]))
         
     def __len__(self):
         return len(self.paths)
     
     def cal_perc(self, path):
-        data = nib.load(path)
-        data = data.get_fdata()
-        ET = 0
-        NCRNET = 0
-        for slice in data:
-            ET += (slice==4).sum()
-            NCRNET += (slice==1).sum()
+        ET, NCRNET = count_tumour_voxels(path)
         TC = ET+NCRNET
-        return float(ET/TC), float(NCRNET/TC)
+        return float(np.divide(ET, TC)), float(np.divide(NCRNET, TC))
 
     def __getitem__(self, idx):
         path = self.paths[idx]
         label = self.labels[idx]
-        mask_path = self.masks_name[idx]
-
-        percent_ET, percent_NCRNET = self.cal_perc(mask_path)
+        percent_ET, percent_NCRNET = self.percents[idx]
         data = np.load(path)
         if self.train and self.train_transform:
             data = self.train_transform(data)
@@ -0,0 +1,109 @@
+import multiprocessing
+from typing import List
+
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import join, load_pickle, load_json, save_json, isfile
+
+from nnunetv2.configuration import default_num_processes
+from nnunetv2.training.dataloading.utils import get_case_identifiers
+
+CLASS_LOCATIONS_INDEX_FILE = 'class_locations_index.json'
+
+
+def _load_class_locations(properties_file: str) -> dict:
+    return load_pickle(properties_file)['class_locations']
+
+
+def build_class_locations_index(folder: str, case_identifiers: List[str] = None,
+                                num_processes: int = default_num_processes) -> str:
+    """
+    Collects properties['class_locations'] (the foreground voxels sampled by
+    DefaultPreprocessor._sample_foreground_locations) of all cases in folder into a single memory mappable file.
+    Coordinates are stored as uint16 (uint32 if a case is larger than that) in class_locations_coords.npy, the rows
+    belonging to case i and class j are offsets[i, j, 0]:offsets[i, j, 1] in class_locations_offsets.npy.
+    Case identifiers and class keys go into class_locations_index.json, which is written last.
+    """
+    if case_identifiers is None:
+        case_identifiers = get_case_identifiers(folder)
+    case_identifiers = sorted(case_identifiers)
+    with multiprocessing.get_context("spawn").Pool(num_processes) as p:
+        class_locations = p.map(_load_class_locations, [join(folder, i + '.pkl') for i in case_identifiers])
+
+    classes = []
+    for c in class_locations:
+        classes += [k for k in c.keys() if k not in classes]
+
+    offsets = np.zeros((len(case_identifiers), len(classes), 2), dtype=np.int64)
+    num_coords, max_coord, num_columns = 0, 0, None
+    for i, c in enumerate(class_locations):
+        for j, k in enumerate(classes):
+            locs = c.get(k, [])
+            offsets[i, j] = num_coords, num_coords + len(locs)
+            num_coords += len(locs)
+            if len(locs) > 0:
+                max_coord = max(max_coord, int(np.max(locs)))
+                num_columns = locs.shape[1]
+
+    dtype = np.uint16 if max_coord <= np.iinfo(np.uint16).max else np.uint32
+    coords = np.lib.format.open_memmap(join(folder, 'class_locations_coords.npy'), mode='w+', dtype=dtype,
+                                       shape=(num_coords, num_columns if num_columns is not None else 4))
+    for i, c in enumerate(class_locations):
+        for j, k in enumerate(classes):
+            if offsets[i, j, 1] > offsets[i, j, 0]:
+                coords[offsets[i, j, 0]:offsets[i, j, 1]] = c[k]
+    coords.flush()
+    del coords
+    np.save(join(folder, 'class_locations_offsets.npy'), offsets)
+    save_json({'cases': case_identifiers, 'classes': [list(k) if isinstance(k, tuple) else k for k in classes]},
+              join(folder, CLASS_LOCATIONS_INDEX_FILE))
+    return join(folder, CLASS_LOCATIONS_INDEX_FILE)
+
+
+def maybe_build_class_locations_index(folder: str, case_identifiers: List[str] = None,
+                                      num_processes: int = default_num_processes) -> str:
+    """builds the index unless there is one that covers all cases"""
+    if case_identifiers is None:
+        case_identifiers = get_case_identifiers(folder)
+    index_file = join(folder, CLASS_LOCATIONS_INDEX_FILE)
+    if isfile(index_file) and set(case_identifiers).issubset(load_json(index_file)['cases']):
+        return index_file
+    return build_class_locations_index(folder, case_identifiers, num_processes)
+
+
+class ClassLocationsIndex(object):
+    """
+    Read side of build_class_locations_index. index.get(case) returns a class_locations dict like the one in the
+    case's properties pkl, but the arrays are (read only) views into the memory mapped coordinate file. Nothing is
+    read before a location is sampled, so RAM stays flat no matter how large the dataset is.
+    """
+    def __init__(self, folder: str):
+        self.folder = folder
+        index = load_json(join(folder, CLASS_LOCATIONS_INDEX_FILE))
+        self.case_to_row = {c: i for i, c in enumerate(index['cases'])}
+        self.classes = [tuple(k) if isinstance(k, list) else k for k in index['classes']]
+        self.offsets = np.load(join(folder, 'class_locations_offsets.npy'))
+        self._coords = None
+
+    @staticmethod
+    def exists(folder: str) -> bool:
+        return isfile(join(folder, CLASS_LOCATIONS_INDEX_FILE))
+
+    @property
+    def coords(self) -> np.ndarray:
+        # opened lazily so that every data augmentation worker has its own memmap
+        if self._coords is None:
+            self._coords = np.load(join(self.folder, 'class_locations_coords.npy'), mmap_mode='r')
+        return self._coords
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_coords'] = None
+        return state
+
+    def __contains__(self, case: str) -> bool:
+        return case in self.case_to_row
+
+    def get(self, case: str) -> dict:
+        row = self.offsets[self.case_to_row[case]]
+        return {k: self.coords[row[j, 0]:row[j, 1]] if row[j, 1] > row[j, 0] else [] for j, k in
+                enumerate(self.classes)}
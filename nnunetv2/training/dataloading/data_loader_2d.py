@@ -12,16 +12,15 @@ from nnunetv2.training.dataloading.brats_dataset_2d import BRATSDataset
 class nnUNetDataLoader2D(nnUNetDataLoaderBase):
     def generate_train_batch(self):
         selected_keys = self.get_indices()
-        # preallocate memory for data and seg
-        data_all = np.zeros(self.data_shape, dtype=np.float32)
-        seg_all = np.zeros(self.seg_shape, dtype=np.int16)
+        # preallocated (or reused, see reuse_batch_buffers) memory for data and seg
+        data_all, seg_all = self.get_batch_buffers()
         case_properties = []
 
         for j, current_key in enumerate(selected_keys):
             # oversampling foreground will improve stability of model training, especially if many patches are empty
             # (Lung for example)
             force_fg = self.get_do_oversample(j)
-            data, seg, properties = self._data.load_case(current_key)
+            data, seg, properties = self._data.load_case(current_key, class_locations_only=True)
             case_properties.append(properties)
 
             # select a class/region first, then a slice where this class is present, then crop to that area
@@ -47,10 +46,7 @@ class nnUNetDataLoader2D(nnUNetDataLoaderBase):
             if selected_class_or_region is not None:
                 selected_slice = np.random.choice(properties['class_locations'][selected_class_or_region][:, 1])
             else:
-                selected_slice = np.random.choice(len(data[0]))
-
-            data = data[:, selected_slice]
-            seg = seg[:, selected_slice]
+                selected_slice = np.random.choice(data.shape[1])
 
             # the line of death lol
             # this needs to be a separate variable because we could otherwise permanently overwrite
@@ -64,31 +60,15 @@ class nnUNetDataLoader2D(nnUNetDataLoaderBase):
             } if (selected_class_or_region is not None) else None
 
             # print(properties)
-            shape = data.shape[1:]
-            dim = len(shape)
+            shape = data.shape[2:]
             bbox_lbs, bbox_ubs = self.get_bbox(shape, force_fg if selected_class_or_region is not None else None,
                                                class_locations, overwrite_class=selected_class_or_region)
 
-            # whoever wrote this knew what he was doing (hint: it was me). We first crop the data to the region of the
-            # bbox that actually lies within the data. This will result in a smaller array which is then faster to pad.
-            # valid_bbox is just the coord that lied within the data cube. It will be padded to match the patch size
-            # later
-            valid_bbox_lbs = [max(0, bbox_lbs[i]) for i in range(dim)]
-            valid_bbox_ubs = [min(shape[i], bbox_ubs[i]) for i in range(dim)]
-
-            # At this point you might ask yourself why we would treat seg differently from seg_from_previous_stage.
-            # Why not just concatenate them here and forget about the if statements? Well that's because segneeds to
-            # be padded with -1 constant whereas seg_from_previous_stage needs to be padded with 0s (we could also
-            # remove label -1 in the data augmentation but this way it is less error prone)
-            this_slice = tuple([slice(0, data.shape[0])] + [slice(i, j) for i, j in zip(valid_bbox_lbs, valid_bbox_ubs)])
-            data = data[this_slice]
-
-            this_slice = tuple([slice(0, seg.shape[0])] + [slice(i, j) for i, j in zip(valid_bbox_lbs, valid_bbox_ubs)])
-            seg = seg[this_slice]
-
-            padding = [(-min(0, bbox_lbs[i]), max(bbox_ubs[i] - shape[i], 0)) for i in range(dim)]
-            data_all[j] = np.pad(data, ((0, 0), *padding), 'constant', constant_values=0)
-            seg_all[j] = np.pad(seg, ((0, 0), *padding), 'constant', constant_values=-1)
+            # only the part of the bbox that lies within the selected slice is read (for chunked storage only the
+            # chunks overlapping it are decompressed), it is written straight into the batch. The rest of the slot is
+            # filled with the padding value (0 for data, -1 for seg)
+            self.crop_and_pad_into(data_all[j], data, bbox_lbs, bbox_ubs, 0, (selected_slice,))
+            self.crop_and_pad_into(seg_all[j], seg, bbox_lbs, bbox_ubs, -1, (selected_slice,))
 
         return {'data': data_all, 'seg': seg_all, 'properties': case_properties, 'keys': selected_keys}
 
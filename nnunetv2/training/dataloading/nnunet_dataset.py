@@ -5,7 +5,8 @@ import numpy as np
 import shutil
 
 from batchgenerators.utilities.file_and_folder_operations import join, load_pickle, isfile
-from nnunetv2.training.dataloading.utils import get_case_identifiers
+from nnunetv2.training.dataloading.class_locations_index import ClassLocationsIndex
+from nnunetv2.training.dataloading.utils import get_case_identifiers, load_chunked
 
 
 class nnUNetDataset(object):
@@ -29,6 +30,10 @@ class nnUNetDataset(object):
         If properties are loaded into the RAM, the info dicts each will have an additional entry:
         - dataset[case_identifier]['properties'] -> pkl file content
 
+        If the folder has a class locations index (see build_class_locations_index) covering all cases, the data
+        loaders get the class_locations from there (load_case(key, class_locations_only=True)) and no pkl file is
+        read during training.
+
         IMPORTANT! THIS CLASS ITSELF IS READ-ONLY. YOU CANNOT ADD KEY:VALUE PAIRS WITH nnUNetDataset[key] = value
         USE THIS INSTEAD:
         nnUNetDataset.dataset[key] = value
@@ -48,6 +53,12 @@ class nnUNetDataset(object):
             if folder_with_segs_from_previous_stage is not None:
                 self.dataset[c]['seg_from_prev_stage_file'] = join(folder_with_segs_from_previous_stage, "%s.npz" % c)
 
+        self.class_locations_index = None
+        if ClassLocationsIndex.exists(folder):
+            index = ClassLocationsIndex(folder)
+            if all(c in index for c in case_identifiers):
+                self.class_locations_index = index
+
         if len(case_identifiers) <= num_images_properties_loading_threshold:
             for i in self.dataset.keys():
                 self.dataset[i]['properties'] = load_pickle(self.dataset[i]['properties_file'])
@@ -77,8 +88,21 @@ class nnUNetDataset(object):
     def values(self):
         return self.dataset.values()
 
-    def load_case(self, key):
-        entry = self[key]
+    def load_case(self, key, class_locations_only: bool = False):
+        """
+        data and seg are memmaps if the dataset was unpacked, blosc2 arrays if it is stored chunked (.b2nd, slicing
+        them only decompresses what is needed) and numpy arrays when read from the npz
+
+        class_locations_only: the returned properties only need to contain 'class_locations' (what the data loaders
+        use). They are then taken from the class locations index if there is one, without reading the pkl file
+        """
+        if class_locations_only and self.class_locations_index is not None and \
+                'properties' not in self.dataset[key].keys():
+            entry = self.dataset[key]
+            properties = {'class_locations': self.class_locations_index.get(key)}
+        else:
+            entry = self[key]
+            properties = entry['properties']
         if 'open_data_file' in entry.keys():
             data = entry['open_data_file']
             # print('using open data file')
@@ -87,6 +111,10 @@ class nnUNetDataset(object):
             if self.keep_files_open:
                 self.dataset[key]['open_data_file'] = data
                 # print('saving open data file')
+        elif isfile(entry['data_file'][:-4] + ".b2nd"):
+            data = load_chunked(entry['data_file'][:-4] + ".b2nd")
+            if self.keep_files_open:
+                self.dataset[key]['open_data_file'] = data
         else:
             data = np.load(entry['data_file'])['data']
 
@@ -98,6 +126,10 @@ class nnUNetDataset(object):
             if self.keep_files_open:
                 self.dataset[key]['open_seg_file'] = seg
                 # print('saving open seg file')
+        elif isfile(entry['data_file'][:-4] + "_seg.b2nd"):
+            seg = load_chunked(entry['data_file'][:-4] + "_seg.b2nd")
+            if self.keep_files_open:
+                self.dataset[key]['open_seg_file'] = seg
         else:
             seg = np.load(entry['data_file'])['seg']
 
@@ -106,9 +138,9 @@ class nnUNetDataset(object):
                 seg_prev = np.load(entry['seg_from_prev_stage_file'][:-4] + ".npy", 'r')
             else:
                 seg_prev = np.load(entry['seg_from_prev_stage_file'])['seg']
-            seg = np.vstack((seg, seg_prev[None]))
+            seg = np.vstack((seg[:], seg_prev[None]))
 
-        return data, seg, entry['properties']
+        return data, seg, properties
 
 
 if __name__ == '__main__':
@@ -1,11 +1,71 @@
 import multiprocessing
 import os
 from multiprocessing import Pool
-from typing import List
+from typing import List, Tuple, Union
 
 import numpy as np
 from batchgenerators.utilities.file_and_folder_operations import isfile, subfiles
 from nnunetv2.configuration import default_num_processes
+try:
+    import blosc2
+except ImportError:
+    blosc2 = None
+
+
+def get_chunk_shape(shape: Tuple[int, ...], patch_size: Union[Tuple[int, ...], List[int]] = None) -> Tuple[int, ...]:
+    """
+    chunk shape for a (c, x, y, z) array: one channel per chunk and half the patch size spatially, so that a patch
+    overlaps few, small chunks. 2d patch sizes get chunks of a single slice. Without patch size: 64 per axis
+    """
+    if patch_size is None:
+        spatial = [64] * (len(shape) - 1)
+    else:
+        spatial = [max(1, i // 2) for i in patch_size]
+        spatial = [1] * (len(shape) - 1 - len(spatial)) + spatial
+    return (1, *[min(i, j) for i, j in zip(shape[1:], spatial)])
+
+
+def save_chunked(array: np.ndarray, output_file: str, patch_size: Union[Tuple[int, ...], List[int]] = None) -> None:
+    if blosc2 is None:
+        raise RuntimeError('Chunked storage requires blosc2 to be installed, install with "pip install blosc2"')
+    blosc2.asarray(np.ascontiguousarray(array), urlpath=output_file, mode='w',
+                   chunks=get_chunk_shape(array.shape, patch_size),
+                   cparams={'codec': blosc2.Codec.ZSTD, 'clevel': 8})
+
+
+def load_chunked(file: str):
+    """
+    opens a .b2nd file without reading it. Slicing the returned array reads and decompresses only the chunks that
+    overlap the slice and returns a numpy array
+    """
+    if blosc2 is None:
+        raise RuntimeError('Chunked storage requires blosc2 to be installed, install with "pip install blosc2"')
+    # one thread, we are usually running in one of many data augmentation workers
+    return blosc2.open(file, mode='r', mmap_mode='r', dparams={'nthreads': 1})
+
+
+def _convert_to_chunked(npz_file: str, unpack_segmentation: bool = True, overwrite_existing: bool = False,
+                        patch_size: Union[Tuple[int, ...], List[int]] = None, remove_npz: bool = False) -> None:
+    try:
+        a = np.load(npz_file)
+        if overwrite_existing or not isfile(npz_file[:-4] + ".b2nd"):
+            save_chunked(a['data'], npz_file[:-4] + ".b2nd", patch_size)
+        if unpack_segmentation and (overwrite_existing or not isfile(npz_file[:-4] + "_seg.b2nd")):
+            save_chunked(a['seg'], npz_file[:-4] + "_seg.b2nd", patch_size)
+        if remove_npz:
+            # only once the .b2nd files are known to hold the same arrays
+            if np.array_equal(load_chunked(npz_file[:-4] + ".b2nd")[:], a['data']) and \
+                    np.array_equal(load_chunked(npz_file[:-4] + "_seg.b2nd")[:], a['seg']):
+                a.close()
+                os.remove(npz_file)
+            else:
+                print(f'WARNING: {npz_file[:-4]}.b2nd does not match {npz_file}, the npz file is kept')
+    except KeyboardInterrupt:
+        if isfile(npz_file[:-4] + ".b2nd"):
+            os.remove(npz_file[:-4] + ".b2nd")
+        if isfile(npz_file[:-4] + "_seg.b2nd"):
+            os.remove(npz_file[:-4] + "_seg.b2nd")
+        raise KeyboardInterrupt
 
 
 def _convert_to_npy(npz_file: str, unpack_segmentation: bool = True, overwrite_existing: bool = False) -> None:
@@ -24,23 +84,43 @@ def _convert_to_npy(npz_file: str, unpack_segmentation: bool = True, overwrite_e
 
 
 def unpack_dataset(folder: str, unpack_segmentation: bool = True, overwrite_existing: bool = False,
-                   num_processes: int = default_num_processes):
+                   num_processes: int = default_num_processes, chunked: bool = False,
+                   patch_size: Union[Tuple[int, ...], List[int]] = None, remove_npz: bool = False):
     """
     all npz files in this folder belong to the dataset, unpack them all
+    chunked: write chunked, compressed .b2nd files (chunk shape from patch_size, see get_chunk_shape) instead of npy
+    remove_npz: (chunked only) delete each npz file once its .b2nd files have been read back and match it. Otherwise
+    the npz files stay next to the .b2nd files and take up disk space. The .b2nd files are the only copy afterwards,
+    unpacking to npy (chunked=False) is not possible anymore
     """
+    assert not remove_npz or (chunked and unpack_segmentation), \
+        'remove_npz requires chunked=True and unpack_segmentation=True'
     with multiprocessing.get_context("spawn").Pool(num_processes) as p:
         npz_files = subfiles(folder, True, None, ".npz", True)
-        p.starmap(_convert_to_npy, zip(npz_files,
-                                       [unpack_segmentation] * len(npz_files),
-                                       [overwrite_existing] * len(npz_files))
-                  )
+        if chunked:
+            p.starmap(_convert_to_chunked, zip(npz_files,
+                                               [unpack_segmentation] * len(npz_files),
+                                               [overwrite_existing] * len(npz_files),
+                                               [patch_size] * len(npz_files),
+                                               [remove_npz] * len(npz_files))
+                      )
+        else:
+            p.starmap(_convert_to_npy, zip(npz_files,
+                                           [unpack_segmentation] * len(npz_files),
+                                           [overwrite_existing] * len(npz_files))
+                      )
 
 
 def get_case_identifiers(folder: str) -> List[str]:
     """
-    finds all npz files in the given folder and reconstructs the training case names from them
+    finds all npz files (or .b2nd files if the dataset was preprocessed with chunked storage) in the given folder and
+    reconstructs the training case names from them
     """
-    case_identifiers = [i[:-4] for i in os.listdir(folder) if i.endswith("npz") and (i.find("segFromPrevStage") == -1)]
+    files = os.listdir(folder)
+    case_identifiers = [i[:-4] for i in files if i.endswith("npz") and (i.find("segFromPrevStage") == -1)]
+    if len(case_identifiers) == 0:
+        case_identifiers = [i[:-5] for i in files if i.endswith(".b2nd") and not i.endswith("_seg.b2nd") and
+                            (i.find("segFromPrevStage") == -1)]
     return case_identifiers
 
 
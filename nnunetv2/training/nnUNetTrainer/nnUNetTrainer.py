@@ -22,17 +22,22 @@ from batchgenerators.transforms.utility_transforms import RemoveLabelTransform,
 from batchgenerators.utilities.file_and_folder_operations import join, load_json, isfile, save_json, maybe_mkdir_p
 from torch._dynamo import OptimizedModule
 
-from nnunetv2.configuration import ANISO_THRESHOLD, default_num_processes
+from nnunetv2.configuration import ANISO_THRESHOLD, default_num_processes, use_chunked_storage, \
+    remove_npz_after_chunking, \
+    data_augmentation_backend, use_batched_spatial_DA
 from nnunetv2.evaluation.evaluate_predictions import compute_metrics_on_folder
 from nnunetv2.inference.export_prediction import export_prediction_from_logits, resample_and_save
 from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
 from nnunetv2.inference.sliding_window_prediction import compute_gaussian
 from nnunetv2.paths import nnUNet_preprocessed, nnUNet_results
 from nnunetv2.training.data_augmentation.compute_initial_patch_size import get_patch_size
+from nnunetv2.training.data_augmentation.custom_transforms.batched_spatial_transform import \
+    BatchedSpatialTransform, replace_spatial_transforms
 from nnunetv2.training.data_augmentation.custom_transforms.cascade_transforms import MoveSegAsOneHotToData, \
     ApplyRandomBinaryOperatorTransform, RemoveRandomConnectedComponentFromOneHotEncodingTransform
 from nnunetv2.training.data_augmentation.custom_transforms.deep_supervision_donwsampling import \
     DownsampleSegForDSTransform2
+from nnunetv2.training.data_augmentation.custom_transforms.shared_memory_augmenter import SharedMemoryRingAugmenter
 from nnunetv2.training.data_augmentation.custom_transforms.limited_length_multithreaded_augmenter import \
     LimitedLenWrapper
 from nnunetv2.training.data_augmentation.custom_transforms.masking import MaskTransform
@@ -43,6 +48,7 @@ from nnunetv2.training.data_augmentation.custom_transforms.transforms_for_dummy_
 from nnunetv2.training.dataloading.data_loader_2d import nnUNetDataLoader2D
 from nnunetv2.training.dataloading.data_loader_3d import nnUNetDataLoader3D
 from nnunetv2.training.dataloading.nnunet_dataset import nnUNetDataset
+from nnunetv2.training.dataloading.class_locations_index import maybe_build_class_locations_index
 from nnunetv2.training.dataloading.utils import get_case_identifiers, unpack_dataset
 from nnunetv2.training.logging.nnunet_logger import nnUNetLogger
 from nnunetv2.training.loss.compound_losses import DC_and_CE_loss, DC_and_BCE_loss
@@ -626,12 +632,31 @@ class nnUNetTrainer(object):
                                                         self.label_manager.has_regions else None,
                                                         ignore_label=self.label_manager.ignore_label)
 
+        allowed_num_processes = get_allowed_n_proc_DA()
+        if use_batched_spatial_DA and isinstance(tr_transforms, Compose):
+            # CUDA cannot be used in the forked worker processes
+            in_main_process = allowed_num_processes == 0 or data_augmentation_backend == 'threads'
+            tr_transforms = replace_spatial_transforms(tr_transforms, self.device if in_main_process else 'cpu')
+
         dl_tr, dl_val = self.get_plain_dataloaders(initial_patch_size, dim)
+        # the spatial transforms always write into new arrays, so the training loader can reuse its batch arrays
+        dl_tr.reuse_batch_buffers = any(isinstance(t, (SpatialTransform, BatchedSpatialTransform)) for t in
+                                       getattr(tr_transforms, 'transforms', []))
 
-        allowed_num_processes = get_allowed_n_proc_DA()
         if allowed_num_processes == 0:
             mt_gen_train = SingleThreadedAugmenter(dl_tr, tr_transforms)
             mt_gen_val = SingleThreadedAugmenter(dl_val, val_transforms)
+        elif data_augmentation_backend in ('shared_memory', 'threads'):
+            use_threads = data_augmentation_backend == 'threads'
+            mt_gen_train = SharedMemoryRingAugmenter(self.num_iterations_per_epoch, data_loader=dl_tr,
+                                                     transform=tr_transforms, num_processes=allowed_num_processes,
+                                                     num_cached=6, seeds=None,
+                                                     pin_memory=self.device.type == 'cuda', use_threads=use_threads)
+            mt_gen_val = SharedMemoryRingAugmenter(self.num_val_iterations_per_epoch, data_loader=dl_val,
+                                                   transform=val_transforms,
+                                                   num_processes=max(1, allowed_num_processes // 2), num_cached=3,
+                                                   seeds=None, pin_memory=self.device.type == 'cuda',
+                                                   use_threads=use_threads)
         else:
             mt_gen_train = LimitedLenWrapper(self.num_iterations_per_epoch, data_loader=dl_tr, transform=tr_transforms,
                                              num_processes=allowed_num_processes, num_cached=6, seeds=None,
@@ -818,8 +843,14 @@ class nnUNetTrainer(object):
         if self.unpack_dataset and self.local_rank == 0:
             self.print_to_log_file('unpacking dataset...')
             unpack_dataset(self.preprocessed_dataset_folder, unpack_segmentation=True, overwrite_existing=False,
-                           num_processes=max(1, round(get_allowed_n_proc_DA() // 2)))
+                           num_processes=max(1, round(get_allowed_n_proc_DA() // 2)), chunked=use_chunked_storage,
+                           patch_size=self.configuration_manager.patch_size,
+                           remove_npz=use_chunked_storage and remove_npz_after_chunking)
             self.print_to_log_file('unpacking done...')
+        if self.local_rank == 0:
+            # datasets preprocessed before the class locations index existed get it here
+            maybe_build_class_locations_index(self.preprocessed_dataset_folder,
+                                              num_processes=max(1, round(get_allowed_n_proc_DA() // 2)))
 
         if self.is_ddp:
             dist.barrier()
@@ -1034,6 +1065,10 @@ class nnUNetTrainer(object):
                                                self.logger.my_fantastic_logging['dice_per_class_or_region'][-1]])
         self.print_to_log_file(
             f"Epoch time: {np.round(self.logger.my_fantastic_logging['epoch_end_timestamps'][-1] - self.logger.my_fantastic_logging['epoch_start_timestamps'][-1], decimals=2)} s")
+        if isinstance(self.dataloader_train, SharedMemoryRingAugmenter):
+            # per worker throughput and queue depth, shows whether data augmentation is the bottleneck
+            self.print_to_log_file('Data augmentation (train):', self.dataloader_train.format_stats())
+            self.dataloader_train.reset_stats()
 
         # handling periodic checkpointing
         current_epoch = self.current_epoch
@@ -1159,12 +1194,12 @@ class nnUNetTrainer(object):
                 data, seg, properties = dataset_val.load_case(k)
 
                 if self.is_cascaded:
-                    data = np.vstack((data, convert_labelmap_to_one_hot(seg[-1], self.label_manager.foreground_labels,
+                    data = np.vstack((data[:], convert_labelmap_to_one_hot(seg[-1], self.label_manager.foreground_labels,
                                                                         output_dtype=data.dtype)))
                 with warnings.catch_warnings():
                     # ignore 'The given NumPy array is not writable' warning
                     warnings.simplefilter("ignore")
-                    data = torch.from_numpy(data)
+                    data = torch.from_numpy(data[:])
 
                 output_filename_truncated = join(validation_output_folder, k)
 
@@ -1,5 +1,5 @@
 import torch
 
-from .acsconv import ACSConv
+from .acsconv import ACSConv, set_acsconv_fused, set_acsconv_memory_efficient, build_fused_acs_weight
 from .soft_acsconv import SoftACSConv
 from .conv2_5d import Conv2_5d
\ No newline at end of file
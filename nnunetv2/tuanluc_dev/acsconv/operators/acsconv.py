@@ -1,9 +1,28 @@
 # from .functional import acs_conv_f
 
 from .base_acsconv import _ACSConv
+from .functional import acs_conv_f_memory_efficient
 import math
 import torch.nn.functional as F
 import torch
+from torch.utils.checkpoint import checkpoint
+
+
+def build_fused_acs_weight(weight, kernel_size, acs_kernel_split):
+    """
+    Embed the 2D kernels (C_out, C_in/groups, k, k) of an ACSConv into a 3D kernel (C_out, C_in/groups, k, k, k) that
+    is zero everywhere but in the central plane orthogonal to the respective direction. Differentiable.
+    """
+    k = kernel_size[0]
+    center = k // 2
+    split_a, split_c, _ = acs_kernel_split
+    weight_a = weight[0:split_a].unsqueeze(2)
+    weight_c = weight[split_a:(split_a+split_c)].unsqueeze(3)
+    weight_s = weight[(split_a+split_c):].unsqueeze(4)
+    return torch.cat([F.pad(weight_a, (0, 0, 0, 0, center, k-1-center)),
+                      F.pad(weight_c, (0, 0, center, k-1-center)),
+                      F.pad(weight_s, (center, k-1-center))], dim=0)
+
 
 class ACSConv(_ACSConv):
     """
@@ -11,6 +30,14 @@ class ACSConv(_ACSConv):
     
     Args:
         acs_kernel_split: optional, equally spit if not specified.
+        fused: optional, the default value is False. If True, the axial, coronal and sagittal 2D kernels are embedded
+            into one zero padded 3D kernel and a single conv3d is run instead of three convs and a cat. The embedded
+            kernel is cached (see fused_weight) and falls back to the three convs if the result would differ.
+        memory_efficient: optional, the default value is False. If True, the three convs read views of the input
+            instead of zero padded copies (see acs_conv_f_memory_efficient). Same result, less activation memory when
+            the output shape is neither the input shape nor half of it (e.g. odd shapes with stride 2).
+        checkpoint: optional, the default value is False. If True, the forward pass is recomputed during backward
+            (torch.utils.checkpoint) so that only the input is kept in memory in between.
 
         Other arguments are the same as torch.nn.Conv3d.
     Examples:
@@ -24,7 +51,7 @@ class ACSConv(_ACSConv):
     """
     def __init__(self, in_channels, out_channels, kernel_size, stride=1,
                  padding=0, dilation=1, groups=1, acs_kernel_split=None, 
-                 bias=True, padding_mode='zeros'):
+                 bias=True, padding_mode='zeros', fused=False, memory_efficient=False, checkpoint=False):
         super().__init__(
             in_channels, out_channels, kernel_size, stride, padding, dilation,
             False, 0, groups, bias, padding_mode)
@@ -37,6 +64,10 @@ class ACSConv(_ACSConv):
                 self.acs_kernel_split = (self.out_channels//3+1,self.out_channels//3+1,self.out_channels//3)
         else:
             self.acs_kernel_split = acs_kernel_split
+        self.fused = fused
+        self._fused_weight_cache = None
+        self.memory_efficient = memory_efficient
+        self.checkpoint = checkpoint
 
 
     def forward(self, x):
@@ -45,13 +76,89 @@ class ACSConv(_ACSConv):
         Divide the kernel into three parts on output channels based on acs_kernel_split, 
         and conduct convolution on three directions seperately. Bias is added at last.
         """
+        if self.checkpoint and torch.is_grad_enabled() and (x.requires_grad or self.weight.requires_grad):
+            return checkpoint(self._forward, x, use_reentrant=False)
+        return self._forward(x)
+
+    def _forward(self, x):
+        if self.fused and self.fused_is_equivalent(x.shape[2:]):
+            return F.conv3d(x, self.fused_weight(), self.bias, self.stride, self.padding, self.dilation, self.groups)
+        if self.memory_efficient:
+            return acs_conv_f_memory_efficient(x, self.weight, self.bias, self.kernel_size, self.dilation,
+                                               self.padding, self.stride, self.groups, self.out_channels,
+                                               self.acs_kernel_split)
         return self.acs_conv_f(x, self.weight, self.bias, self.kernel_size, self.dilation, self.padding, self.stride, 
                             self.groups, self.out_channels, self.acs_kernel_split)
 
 
     def extra_repr(self):
         s = super().extra_repr() + ', acs_kernel_split={acs_kernel_split}'
+        if self.fused:
+            s += ', fused=True'
+        if self.memory_efficient:
+            s += ', memory_efficient=True'
+        if self.checkpoint:
+            s += ', checkpoint=True'
         return s.format(**self.__dict__)
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        if not hasattr(self, 'fused'):
+            self.fused = False
+            self._fused_weight_cache = None
+        if not hasattr(self, 'memory_efficient'):
+            self.memory_efficient = False
+            self.checkpoint = False
+
+    def build_fused_weight(self):
+        return build_fused_acs_weight(self.weight, self.kernel_size, self.acs_kernel_split)
+
+    def fused_weight(self):
+        """
+        Returns build_fused_weight(). Without gradients the result is cached until the weight is modified (in-place
+        updates such as optimizer steps or load_state_dict bump the tensor version) or moved.
+        """
+        if torch.is_grad_enabled() and self.weight.requires_grad:
+            # a cached tensor would keep the autograd graph of a previous iteration
+            return self.build_fused_weight()
+        key = (self.weight._version, self.weight.data_ptr(), self.weight.device, self.weight.dtype)
+        if self._fused_weight_cache is None or self._fused_weight_cache[0] != key:
+            with torch.no_grad():
+                self._fused_weight_cache = (key, self.build_fused_weight())
+        return self._fused_weight_cache[1]
+
+    def fused_is_equivalent(self, input_shape):
+        """
+        The fused conv3d samples the input at (kernel_size//2)*dilation - padding relative to the strided output
+        position along the direction orthogonal to each 2D kernel. acs_conv_f uses an offset of 0 if the output has
+        the same or half the input size along that direction and kernel_size//2 - padding otherwise. The results are
+        only identical if these agree for all directions that have kernels.
+        """
+        conv3D_output_shape = [self.conv3D_output_shape_f(i, input_shape, self.kernel_size, self.dilation,
+                                                          self.padding, self.stride) for i in range(3)]
+        for i in range(3):
+            if self.acs_kernel_split[i] == 0:
+                continue
+            fused_offset = (self.kernel_size[i]//2)*self.dilation[i] - self.padding[i]
+            if conv3D_output_shape[i]==input_shape[i] or 2*conv3D_output_shape[i]==input_shape[i]:
+                if fused_offset != 0 or (input_shape[i]-1)//self.stride[i]+1 != conv3D_output_shape[i]:
+                    return False
+            elif fused_offset != self.kernel_size[i]//2 - self.padding[i]:
+                return False
+        return True
+
+    def fused_is_always_equivalent(self):
+        """
+        True if fused_is_equivalent holds for every input shape, which is the case for 'same' padding
+        (padding == kernel_size//2, odd kernel size, no dilation) in all directions that have kernels.
+        Such an ACSConv can be replaced by an nn.Conv3d with build_fused_weight()
+        """
+        for i in range(3):
+            if self.acs_kernel_split[i] == 0 or self.kernel_size[i] == 1 and self.padding[i] == 0:
+                continue
+            if self.kernel_size[i] % 2 != 1 or self.padding[i] != self.kernel_size[i]//2 or self.dilation[i] != 1:
+                return False
+        return True
     
     def conv3D_output_shape_f(self, i, input_shape, kernel_size, dilation, padding, stride):
         """
@@ -127,3 +234,23 @@ class ACSConv(_ACSConv):
 
         return f
 
+
+def set_acsconv_fused(model, fused=True):
+    """
+    Switch all ACSConv modules in model to the fused (single conv3d) or the original execution mode
+    """
+    for module in model.modules():
+        if isinstance(module, ACSConv):
+            module.fused = fused
+    return model
+
+
+def set_acsconv_memory_efficient(model, memory_efficient=True, checkpoint=False):
+    """
+    Switch all ACSConv modules in model to the pad free implementation and optionally to checkpointing
+    """
+    for module in model.modules():
+        if isinstance(module, ACSConv):
+            module.memory_efficient = memory_efficient
+            module.checkpoint = checkpoint
+    return model
@@ -76,3 +76,55 @@ def acs_conv_f(x, weight, bias, kernel_size, dilation, padding, stride, groups,
         f += bias.view(1,out_channels,1,1,1)
 
     return f
+
+
+def acs_conv_f_memory_efficient(x, weight, bias, kernel_size, dilation, padding, stride, groups, out_channels,
+                                acs_kernel_split):
+    """
+    Same result as acs_conv_f without F.pad copies of x. Along the direction orthogonal to a 2D kernel the conv has a
+    single tap, so output plane j only reads input plane offset + j*stride. Instead of padding x and slicing it we
+    narrow x (a view) to the planes that are inside the input and zero pad the (much smaller) branch output for the
+    planes that fall into the padding. The convs therefore only keep views of x for backward.
+    """
+    B, C_in, *input_shape = x.shape
+    C_out = weight.shape[0]
+    assert groups==1 or groups==C_in==C_out, "only support standard or depthwise conv"
+    depthwise = groups==C_in==C_out
+
+    conv3D_output_shape = [conv3D_output_shape_f(i, input_shape, kernel_size, dilation, padding, stride)
+                           for i in range(3)]
+
+    f_out = []
+    start = 0
+    for i, split in enumerate(acs_kernel_split):
+        if split == 0:
+            continue
+        w = weight[start:start+split].unsqueeze(2+i)
+        x_i = x[:, start:start+split] if depthwise else x
+        if conv3D_output_shape[i]==input_shape[i] or 2*conv3D_output_shape[i]==input_shape[i]:
+            # acs_conv_f uses x as is, reading every stride-th plane from 0
+            offset, first, last = 0, 0, (input_shape[i] - 1) // stride[i] + 1
+            num_planes = last
+        else:
+            # acs_conv_f reads the planes from kernel_size//2 in the padded input
+            offset = kernel_size[i]//2 - padding[i]
+            first = max(0, -(offset // stride[i]))
+            num_planes = conv3D_output_shape[i]
+            last = min(num_planes, (input_shape[i] - 1 - offset) // stride[i] + 1)
+        conv_padding = list(padding)
+        conv_padding[i] = 0
+        out = F.conv3d(x_i.narrow(2+i, offset + first*stride[i], (last-first-1)*stride[i]+1), weight=w, bias=None,
+                       stride=stride, padding=conv_padding, dilation=dilation, groups=split if depthwise else 1)
+        if first > 0 or last < num_planes:
+            pad = [0] * 6
+            pad[2*(2-i)] = first
+            pad[2*(2-i)+1] = num_planes - last
+            out = F.pad(out, pad, 'constant', 0)
+        f_out.append(out)
+        start += split
+    f = torch.cat(f_out, dim=1)
+
+    if bias is not None:
+        f += bias.view(1,out_channels,1,1,1)
+
+    return f
@@ -0,0 +1,155 @@
+import random
+from typing import Tuple
+
+import numpy as np
+import torch
+from torch.utils.data import default_collate
+
+
+def _sample_contrast_factors(shape, contrast_range, generator, device):
+    # same two sided sampling as batchgenerators' augment_contrast: half of the time below 1, otherwise above 1
+    low = contrast_range[0] + torch.rand(shape, device=device, generator=generator) * (1 - contrast_range[0])
+    high_start = max(contrast_range[0], 1)
+    high = high_start + torch.rand(shape, device=device, generator=generator) * (contrast_range[1] - high_start)
+    below_one = torch.rand(shape, device=device, generator=generator) < 0.5
+    if contrast_range[0] >= 1:
+        below_one[:] = False
+    return torch.where(below_one, low, high)
+
+
+def batched_augment_contrast(data: torch.Tensor, contrast_range: Tuple[float, float] = (0.75, 1.25),
+                             preserve_range: bool = True, per_channel: bool = True, p_per_channel: float = 1,
+                             generator: torch.Generator = None) -> torch.Tensor:
+    """
+    augment_contrast (batchgenerators) for a whole batch (b, c, *spatial) at once. Each channel of each sample is
+    augmented with probability p_per_channel
+    """
+    b, c = data.shape[:2]
+    spatial_dims = tuple(range(2, data.ndim))
+    view_shape = (b, c) + (1,) * len(spatial_dims)
+    factor = _sample_contrast_factors((b, c) if per_channel else (b, 1), contrast_range, generator, data.device)
+    apply = torch.rand((b, c), device=data.device, generator=generator) < p_per_channel
+    factor = factor.expand(b, c).reshape(view_shape).to(data.dtype)
+
+    mn = data.mean(spatial_dims, keepdim=True)
+    augmented = (data - mn) * factor + mn
+    if preserve_range:
+        augmented = torch.clamp(augmented, data.amin(spatial_dims, keepdim=True), data.amax(spatial_dims, keepdim=True))
+    # channels that are not augmented stay bitwise unchanged
+    return torch.where(apply.view(view_shape), augmented, data)
+
+
+def batched_augment_brightness_multiplicative(data: torch.Tensor,
+                                              multiplier_range: Tuple[float, float] = (0.75, 1.25),
+                                              per_channel: bool = True, p_per_sample: float = 1,
+                                              generator: torch.Generator = None) -> torch.Tensor:
+    """multiplies each sample (or each channel of each sample) with a factor drawn from multiplier_range"""
+    b, c = data.shape[:2]
+    view_shape = (b, c) + (1,) * (data.ndim - 2)
+    multiplier = torch.empty((b, c) if per_channel else (b, 1), device=data.device).uniform_(
+        *multiplier_range, generator=generator).expand(b, c)
+    apply = torch.rand((b, 1), device=data.device, generator=generator) < p_per_sample
+    multiplier = torch.where(apply, multiplier, torch.ones_like(multiplier))
+    return data * multiplier.view(view_shape).to(data.dtype)
+
+
+def batched_mirror(data: torch.Tensor, axes: Tuple[int, ...] = (0, 1, 2), p_per_axis: float = 0.5,
+                   generator: torch.Generator = None) -> torch.Tensor:
+    """
+    mirrors each sample along each of the given spatial axes (0 is the first spatial axis) with probability
+    p_per_axis. One flip of the whole batch per axis, the samples that are not mirrored are taken from the input
+    """
+    b = data.shape[0]
+    view_shape = (b,) + (1,) * (data.ndim - 1)
+    for axis in axes:
+        if axis + 2 >= data.ndim:
+            continue
+        mirror = torch.rand(b, device=data.device, generator=generator) < p_per_axis
+        data = torch.where(mirror.view(view_shape), torch.flip(data, (axis + 2,)), data)
+    return data
+
+
+class BatchedAugmenter(object):
+    """
+    Contrast (batchgenerators' augment_contrast), multiplicative brightness and mirroring for whole batches
+    (b, c, *spatial), vectorised on whatever device the batch lives on. Randomness comes from an own torch.Generator
+    per device: seed it for reproducible runs, otherwise it is seeded from torch's global RNG (see set_seed) on first
+    use. The defaults reproduce the contrast augmentation train() used to apply sample by sample.
+    Probabilities of 0 disable a transform.
+    """
+    def __init__(self,
+                 contrast_range: Tuple[float, float] = (0.75, 1.25),
+                 p_per_channel_contrast: float = 0.15,
+                 preserve_range: bool = True,
+                 multiplier_range: Tuple[float, float] = (0.75, 1.25),
+                 p_per_sample_brightness: float = 0,
+                 mirror_axes: Tuple[int, ...] = (0, 1, 2),
+                 p_mirror_per_axis: float = 0,
+                 seed: int = None):
+        self.contrast_range = contrast_range
+        self.p_per_channel_contrast = p_per_channel_contrast
+        self.preserve_range = preserve_range
+        self.multiplier_range = multiplier_range
+        self.p_per_sample_brightness = p_per_sample_brightness
+        self.mirror_axes = mirror_axes
+        self.p_mirror_per_axis = p_mirror_per_axis
+        self.seed = seed
+        self._generators = {}
+
+    def reseed(self, seed: int):
+        self.seed = seed
+        self._generators = {}
+
+    def _get_generator(self, device: torch.device) -> torch.Generator:
+        if device not in self._generators:
+            if self.seed is None:
+                self.seed = int(torch.randint(0, 2 ** 62, (1,)).item())
+            self._generators[device] = torch.Generator(device=device).manual_seed(self.seed)
+        return self._generators[device]
+
+    def __getstate__(self):
+        # generators are not picklable, workers create their own
+        state = self.__dict__.copy()
+        state['_generators'] = {}
+        return state
+
+    @torch.no_grad()
+    def __call__(self, data: torch.Tensor) -> torch.Tensor:
+        generator = self._get_generator(data.device)
+        if not torch.is_floating_point(data):
+            data = data.float()
+        if self.p_per_channel_contrast > 0:
+            data = batched_augment_contrast(data, self.contrast_range, self.preserve_range, True,
+                                            self.p_per_channel_contrast, generator)
+        if self.p_per_sample_brightness > 0:
+            data = batched_augment_brightness_multiplicative(data, self.multiplier_range, True,
+                                                             self.p_per_sample_brightness, generator)
+        if self.p_mirror_per_axis > 0:
+            data = batched_mirror(data, self.mirror_axes, self.p_mirror_per_axis, generator)
+        return data
+
+
+class BatchedAugmentCollate(object):
+    """
+    collate_fn that runs a BatchedAugmenter on each collated batch inside the DataLoader workers. Every worker reseeds
+    the augmenter with the seed torch gives it (DataLoader base seed + worker id), so the augmentation is
+    reproducible per worker for a fixed global seed
+    """
+    def __init__(self, augmenter: BatchedAugmenter):
+        self.augmenter = augmenter
+        self._worker_seed = None
+
+    def __call__(self, batch):
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None and self._worker_seed != worker_info.seed:
+            self._worker_seed = worker_info.seed
+            self.augmenter.reseed(worker_info.seed % 2 ** 62)
+        data, target = default_collate(batch)
+        return self.augmenter(data), target
+
+
+def seed_worker(worker_id: int):
+    """worker_init_fn that seeds numpy and random from the per worker torch seed"""
+    worker_seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
@@ -0,0 +1,291 @@
+"""
+CPU benchmark of the convolution flavours in tuanluc_dev/acsconv/operators (ACSConv, SoftACSConv, Conv2_5d) against
+nn.Conv3d, and of the full networks built by get_network_from_plans with different custom network configs.
+
+For every entry we report the median forward (inference, no grad), training forward and backward latency, the peak
+memory allocated by torch during inference and during a training step, and the FLOPs (forward and forward + backward)
+counted by torch.utils.flop_counter. Results are written to a json file with sorted keys and a deterministic entry
+order so that the files of two commits can be diffed.
+
+Examples:
+    python -m nnunetv2.tuanluc_dev.benchmark_convs -o ops.json
+    python -m nnunetv2.tuanluc_dev.benchmark_convs -o ops.json -channels 32 -patch_sizes 64 128 -dtypes float32
+    python -m nnunetv2.tuanluc_dev.benchmark_convs -o nets.json --skip_operators -plans nnUNetPlans.json \
+        -dataset_json dataset.json -c 3d_fullres -cfg configs/base.yaml configs/acs_random.yaml
+
+All pretrained ACS variants (acs_resnet18*.yaml, ...) replace every Conv3d with ACSConv and only differ in the weights
+they load, so acs_random.yaml is representative of their cost and does not need to download anything.
+"""
+import argparse
+import itertools
+import platform
+from copy import deepcopy
+from time import perf_counter
+from typing import Callable, List, Tuple, Union
+
+import numpy as np
+import torch
+from batchgenerators.utilities.file_and_folder_operations import join, load_json, save_json
+from torch import nn
+from torch.utils.flop_counter import FlopCounterMode
+
+import nnunetv2
+from nnunetv2.tuanluc_dev.acsconv.operators import ACSConv, SoftACSConv, Conv2_5d, set_acsconv_fused
+
+DTYPES = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}
+
+# name -> constructor(in_channels, out_channels, kernel_size, stride). All operators use 'same' padding
+OPERATORS = {
+    'conv3d': lambda c_in, c_out, k, s: nn.Conv3d(c_in, c_out, k, s, k // 2),
+    'acsconv': lambda c_in, c_out, k, s: ACSConv(c_in, c_out, k, s, k // 2),
+    'acsconv_fused': lambda c_in, c_out, k, s: ACSConv(c_in, c_out, k, s, k // 2, fused=True),
+    'acsconv_memory_efficient': lambda c_in, c_out, k, s: ACSConv(c_in, c_out, k, s, k // 2, memory_efficient=True),
+    'acsconv_checkpoint': lambda c_in, c_out, k, s: ACSConv(c_in, c_out, k, s, k // 2, checkpoint=True),
+    'soft_acsconv': lambda c_in, c_out, k, s: SoftACSConv(c_in, c_out, k, s, k // 2),
+    'mean_acsconv': lambda c_in, c_out, k, s: SoftACSConv(c_in, c_out, k, s, k // 2, mean=True),
+    'conv2_5d': lambda c_in, c_out, k, s: Conv2_5d(c_in, c_out, k, s, k // 2),
+}
+
+DEFAULT_CHANNELS = (32, 64)
+# 128 is the BraTS 3d_fullres patch size
+DEFAULT_PATCH_SIZES = (32, 64, 128)
+DEFAULT_STRIDES = (1, 2)
+DEFAULT_DTYPES = ('float32', 'bfloat16')
+
+
+def _sum_outputs(output: Union[torch.Tensor, List[torch.Tensor], Tuple[torch.Tensor, ...]]) -> torch.Tensor:
+    # networks with deep supervision return a list
+    if isinstance(output, (list, tuple)):
+        return sum([o.float().sum() for o in output])
+    return output.float().sum()
+
+
+def measure_peak_memory(func: Callable) -> Union[int, None]:
+    """
+    Peak number of bytes allocated by torch on the CPU while func runs (relative to the allocations that already
+    existed before). Uses the allocation events of the torch profiler. Returns None if they are not available
+    """
+    from torch.profiler import profile, ProfilerActivity
+    try:
+        with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+            func()
+        events = [e for e in prof.profiler.kineto_results.events() if e.name() == '[memory]']
+    except Exception as e:
+        print(f'Could not measure peak memory: {repr(e)}')
+        return None
+    events.sort(key=lambda e: e.start_ns())
+    current, peak = 0, 0
+    for e in events:
+        current += e.nbytes()
+        peak = max(peak, current)
+    return int(peak)
+
+
+def measure_flops(func: Callable) -> int:
+    with FlopCounterMode(display=False) as counter:
+        func()
+    return int(counter.get_total_flops())
+
+
+def benchmark_module(module: nn.Module, input_shape: Tuple[int, ...], dtype: torch.dtype, num_warmup: int = 2,
+                     num_repeats: int = 5, train: bool = True) -> dict:
+    """
+    Measures latency (median over num_repeats after num_warmup runs), peak memory and FLOPs of module for a random
+    input of input_shape. With train=False only inference is measured
+    """
+    module = module.to(dtype=dtype)
+    x = torch.randn(input_shape, dtype=dtype)
+
+    def inference():
+        with torch.no_grad():
+            module(x)
+
+    def train_step():
+        module.zero_grad(set_to_none=True)
+        loss = _sum_outputs(module(x))
+        loss.backward()
+
+    result = {}
+    module.eval()
+    for _ in range(num_warmup):
+        inference()
+    times = []
+    for _ in range(num_repeats):
+        start = perf_counter()
+        inference()
+        times.append(perf_counter() - start)
+    result['forward_inference_ms'] = float(np.median(times) * 1000)
+    result['peak_memory_inference_bytes'] = measure_peak_memory(inference)
+    result['flops_forward'] = measure_flops(inference)
+
+    if train:
+        module.train()
+        for _ in range(num_warmup):
+            train_step()
+        forward_times, backward_times = [], []
+        for _ in range(num_repeats):
+            module.zero_grad(set_to_none=True)
+            start = perf_counter()
+            loss = _sum_outputs(module(x))
+            middle = perf_counter()
+            loss.backward()
+            forward_times.append(middle - start)
+            backward_times.append(perf_counter() - middle)
+            del loss
+        result['forward_train_ms'] = float(np.median(forward_times) * 1000)
+        result['backward_ms'] = float(np.median(backward_times) * 1000)
+        result['peak_memory_train_bytes'] = measure_peak_memory(train_step)
+        result['flops_forward_backward'] = measure_flops(train_step)
+        module.zero_grad(set_to_none=True)
+    return result
+
+
+def _run_entry(name: str, benchmark: Callable) -> dict:
+    print(name)
+    try:
+        result = benchmark()
+    except Exception as e:
+        # some operators/dtypes are not supported on every CPU (e.g. float16 convolutions)
+        print(f'    failed: {repr(e)}')
+        return {'error': repr(e)}
+    print('    ' + ', '.join([f'{k}: {v:.1f}' if isinstance(v, float) else f'{k}: {v}' for k, v in result.items()]))
+    return result
+
+
+def benchmark_operators(operators: List[str], channels: List[int], patch_sizes: List[int], strides: List[int],
+                        dtypes: List[str], kernel_size: int = 3, batch_size: int = 1, num_warmup: int = 2,
+                        num_repeats: int = 5, train: bool = True) -> dict:
+    results = {}
+    for op, c, p, s, dtype in itertools.product(operators, channels, patch_sizes, strides, dtypes):
+        key = f'{op}__c{c}_p{p}_s{s}_{dtype}'
+        torch.manual_seed(12345)
+        results[key] = {
+            'operator': op, 'channels': c, 'patch_size': p, 'stride': s, 'dtype': dtype, 'kernel_size': kernel_size,
+            'batch_size': batch_size,
+            **_run_entry(key, lambda: benchmark_module(OPERATORS[op](c, c, kernel_size, s), (batch_size, c, p, p, p),
+                                                       DTYPES[dtype], num_warmup, num_repeats, train))
+        }
+    return results
+
+
+def build_network_variants(plans_file: str, dataset_json_file: str, configuration: str,
+                           custom_network_config_paths: List[Union[str, None]]) -> Tuple[dict, int, List[int]]:
+    """
+    Builds one network per custom network config with get_network_from_plans (None is the default nnU-Net). For
+    networks that contain ACSConv two more variants are added: '+fused' (ACSConv in fused mode) and '+conv3d'
+    (converted to nn.Conv3d for deployment). Returns (variants, num_input_channels, patch_size)
+    """
+    from nnunetv2.tuanluc_dev.get_network_from_plans import get_network_from_plans
+    from nnunetv2.tuanluc_dev.network_initialization import replace_acsconv_with_conv3d
+    from nnunetv2.utilities.plans_handling.plans_handler import PlansManager
+
+    plans_manager = PlansManager(plans_file)
+    dataset_json = load_json(dataset_json_file)
+    configuration_manager = plans_manager.get_configuration(configuration)
+    num_input_channels = len(dataset_json['channel_names'].keys() if 'channel_names' in dataset_json.keys()
+                             else dataset_json['modality'].keys())
+
+    variants = {}
+    for cfg in custom_network_config_paths:
+        name = 'default' if cfg is None else cfg.replace('\\', '/').split('/')[-1].replace('.yaml', '')
+        torch.manual_seed(12345)
+        network = get_network_from_plans(plans_manager, dataset_json, configuration_manager, num_input_channels,
+                                         deep_supervision=True, custom_network_config_path=cfg)
+        variants[name] = network
+        if any([isinstance(m, ACSConv) for m in network.modules()]):
+            variants[name + '+fused'] = set_acsconv_fused(deepcopy(network), True)
+            conv3d_network = deepcopy(network)
+            replace_acsconv_with_conv3d(conv3d_network)
+            variants[name + '+conv3d'] = conv3d_network
+    return variants, num_input_channels, list(configuration_manager.patch_size)
+
+
+def benchmark_networks(plans_file: str, dataset_json_file: str, configuration: str,
+                       custom_network_config_paths: List[Union[str, None]], dtypes: List[str], batch_size: int = 2,
+                       patch_size: List[int] = None, num_warmup: int = 1, num_repeats: int = 3,
+                       train: bool = True) -> dict:
+    variants, num_input_channels, plans_patch_size = build_network_variants(plans_file, dataset_json_file,
+                                                                            configuration,
+                                                                            custom_network_config_paths)
+    patch_size = plans_patch_size if patch_size is None else list(patch_size)
+    input_shape = (batch_size, num_input_channels, *patch_size)
+    results = {}
+    for (name, network), dtype in itertools.product(variants.items(), dtypes):
+        key = f'{name}__{configuration}_{dtype}'
+        torch.manual_seed(12345)
+        results[key] = {
+            'variant': name, 'configuration': configuration, 'dtype': dtype, 'input_shape': list(input_shape),
+            'num_parameters': int(sum([p.numel() for p in network.parameters()])),
+            **_run_entry(key, lambda: benchmark_module(network, input_shape, DTYPES[dtype], num_warmup, num_repeats,
+                                                       train))
+        }
+    return results
+
+
+def benchmark_entry_point():
+    parser = argparse.ArgumentParser(description='CPU benchmark of ACSConv, SoftACSConv, Conv2_5d and Conv3d and of '
+                                                 'the networks built by get_network_from_plans with different custom '
+                                                 'network configs. Writes a json file that can be diffed across '
+                                                 'commits.')
+    parser.add_argument('-o', type=str, required=True, help='Output json file')
+    parser.add_argument('-operators', nargs='+', type=str, default=list(OPERATORS.keys()),
+                        help=f'Operators to benchmark. Default: all ({", ".join(OPERATORS.keys())})')
+    parser.add_argument('-channels', nargs='+', type=int, default=DEFAULT_CHANNELS,
+                        help=f'Number of input (= output) channels. Default: {DEFAULT_CHANNELS}')
+    parser.add_argument('-patch_sizes', nargs='+', type=int, default=DEFAULT_PATCH_SIZES,
+                        help=f'Edge lengths of the (cubic) input. Default: {DEFAULT_PATCH_SIZES}')
+    parser.add_argument('-strides', nargs='+', type=int, default=DEFAULT_STRIDES,
+                        help=f'Default: {DEFAULT_STRIDES}')
+    parser.add_argument('-dtypes', nargs='+', type=str, default=DEFAULT_DTYPES, choices=list(DTYPES.keys()),
+                        help=f'Default: {DEFAULT_DTYPES}')
+    parser.add_argument('-kernel_size', type=int, default=3, help='Default: 3')
+    parser.add_argument('-batch_size', type=int, default=1, help='Batch size for the operators. Default: 1')
+    parser.add_argument('-num_warmup', type=int, default=2, help='Default: 2')
+    parser.add_argument('-num_repeats', type=int, default=5, help='Default: 5')
+    parser.add_argument('-num_threads', type=int, default=None,
+                        help='torch.set_num_threads. Default: torch default')
+    parser.add_argument('--inference_only', action='store_true', help='Do not measure backward')
+    parser.add_argument('--skip_operators', action='store_true', help='Only benchmark networks')
+    parser.add_argument('-plans', type=str, default=None,
+                        help='[OPTIONAL] plans json file. Networks are only benchmarked if this is given')
+    parser.add_argument('-dataset_json', type=str, default=None, help='dataset.json belonging to -plans')
+    parser.add_argument('-c', type=str, default='3d_fullres', help='Configuration. Default: 3d_fullres')
+    parser.add_argument('-cfg', nargs='+', type=str, default=None,
+                        help='Custom network config yaml files to compare. "none" is the default nnU-Net. '
+                             'Default: none and tuanluc_dev/configs/acs_random.yaml')
+    parser.add_argument('-network_patch_size', nargs='+', type=int, default=None,
+                        help='Patch size for the networks. Default: patch size of the configuration')
+    parser.add_argument('-network_batch_size', type=int, default=2, help='Default: 2')
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    train = not args.inference_only
+
+    results = {
+        'meta': {
+            'torch_version': torch.__version__,
+            'num_threads': torch.get_num_threads(),
+            'processor': platform.processor(),
+            'machine': platform.machine(),
+            'num_warmup': args.num_warmup,
+            'num_repeats': args.num_repeats,
+        }
+    }
+    if not args.skip_operators:
+        results['operators'] = benchmark_operators(args.operators, args.channels, args.patch_sizes, args.strides,
+                                                   args.dtypes, args.kernel_size, args.batch_size, args.num_warmup,
+                                                   args.num_repeats, train)
+    if args.plans is not None:
+        assert args.dataset_json is not None, '-dataset_json is required to benchmark networks'
+        cfgs = args.cfg if args.cfg is not None else \
+            [None, join(nnunetv2.__path__[0], 'tuanluc_dev', 'configs', 'acs_random.yaml')]
+        cfgs = [None if i is None or i.lower() == 'none' else i for i in cfgs]
+        results['networks'] = benchmark_networks(args.plans, args.dataset_json, args.c, cfgs, args.dtypes,
+                                                 args.network_batch_size, args.network_patch_size,
+                                                 max(1, args.num_warmup // 2), args.num_repeats, train)
+    save_json(results, args.o, sort_keys=True)
+
+
+if __name__ == '__main__':
+    benchmark_entry_point()
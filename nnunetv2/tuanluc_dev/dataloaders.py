@@ -17,6 +17,7 @@ from batchgenerators.augmentations.color_augmentations import augment_contrast
 from nnunetv2.training.data_augmentation.compute_initial_patch_size import get_patch_size
 from nnunetv2.configuration import ANISO_THRESHOLD, default_num_processes
 from nnunetv2.tuanluc_dev.utils import *
+from nnunetv2.tuanluc_dev.batched_augmentation import BatchedAugmentCollate, seed_worker
 import monai.transforms as mt
 import SimpleITK as sitk
 import cv2
@@ -31,7 +32,11 @@ import nibabel as nib
 The default BraTS dataloader is for BraTS2018
 """
     
-def get_BRATSDataset_dataloader(root_dir, batch_size, num_workers):
+def get_BRATSDataset_dataloader(root_dir, batch_size, num_workers, cache_dir=None):
+    """
+    cache_dir: optional. If given, the resized volumes are read from memory mapped float16 caches in this folder
+    (built on first use, see build_resized_cache) instead of resizing every case in every epoch
+    """
     
     train_transform = mt.Compose(
         [
@@ -46,6 +51,9 @@ def get_BRATSDataset_dataloader(root_dir, batch_size, num_workers):
     
     train_dataset = BRATSDataset(root_dir, train=True, train_transform=train_transform, fold=0)
     val_dataset = BRATSDataset(root_dir, train=False, val_transform=val_transform, fold=0)
+    if cache_dir is not None:
+        train_dataset = ResizedCacheDataset(train_dataset, os.path.join(cache_dir, "BraTS2018_train_128.npy"))
+        val_dataset = ResizedCacheDataset(val_dataset, os.path.join(cache_dir, "BraTS2018_val_128.npy"))
     
     # train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
     sampler = StratifiedBatchSampler(train_dataset.labels, batch_size)
@@ -239,6 +247,76 @@ class BRATSDataset(Dataset):
         return data.as_tensor(), torch.tensor(float(label))
 
 
+def _load_and_resize(path, shape):
+    resize_transform = mt.Resize(shape, size_mode='all', mode="trilinear")
+    return resize_transform(np.load(path)).numpy().astype(np.float16)
+
+
+def build_resized_cache(paths, cache_file, shape=(128, 128, 128), num_processes=default_num_processes):
+    """
+    Resizes every preprocessed case in paths (trilinear, like the Resize transform of the BraTS dataloaders) once and
+    writes them into a single float16 array (len(paths), c, *shape) at cache_file (npy, memory mappable).
+    cache_file + '.json' records the paths, the size and modification time of each file and the shape. An existing
+    cache with the same content is reused, it is rebuilt if any of the files was rewritten.
+    """
+    if len(paths) == 0:
+        raise ValueError(f"Cannot build the resized cache {cache_file}: the dataset has no cases")
+    info_file = cache_file + '.json'
+    paths = [str(i) for i in paths]
+    info = {'paths': paths, 'sources': [[os.stat(i).st_size, os.stat(i).st_mtime_ns] for i in paths],
+            'shape': list(shape)}
+    if os.path.isfile(cache_file) and os.path.isfile(info_file):
+        with open(info_file, 'r') as f:
+            if json.load(f) == info:
+                return cache_file
+    if os.path.isfile(info_file):
+        os.remove(info_file)
+    os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+
+    data = None
+    with multiprocessing.get_context("spawn").Pool(num_processes) as pool:
+        for i, resized in enumerate(tqdm(pool.imap(partial(_load_and_resize, shape=tuple(shape)), info['paths']),
+                                         total=len(paths), desc="Building resized cache")):
+            if data is None:
+                data = np.lib.format.open_memmap(cache_file, mode='w+', dtype=np.float16,
+                                                 shape=(len(paths), *resized.shape))
+            data[i] = resized
+    data.flush()
+    del data
+    # written last, an interrupted build is detected by the missing info file
+    with open(info_file, 'w') as f:
+        json.dump(info, f)
+    return cache_file
+
+
+class ResizedCacheDataset(Dataset):
+    """
+    Reads the volumes of a BRATSDataset/BRATS2020Dataset from the memory mapped array written by build_resized_cache
+    (built on first use) instead of loading and resizing the full resolution npy files in every epoch.
+    Returns the same (data, label) as the wrapped dataset, data is float32 (stored as float16).
+    """
+    def __init__(self, dataset, cache_file, shape=(128, 128, 128), num_processes=default_num_processes):
+        self.paths = dataset.paths
+        self.labels = dataset.labels
+        self.cache_file = build_resized_cache(self.paths, cache_file, shape, num_processes)
+        self._data = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getstate__(self):
+        # DataLoader workers open the memmap themselves
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def __getitem__(self, idx):
+        if self._data is None:
+            self._data = np.load(self.cache_file, mmap_mode='r')
+        data = torch.from_numpy(self._data[idx].astype(np.float32))
+        return data, torch.tensor(float(self.labels[idx]))
+
+
 class BRATS2020Dataset(BRATSDataset):
     def __init__(self, root_dir, train, train_transform=None, val_transform=None, fold=0):
         self.root_dir = root_dir
@@ -277,7 +355,11 @@ class BRATS2020Dataset(BRATSDataset):
         # print(self.paths[0], self.labels[0])
 
 
-def get_BRATS2020Dataset_dataloader(root_dir, batch_size, num_workers):
+def get_BRATS2020Dataset_dataloader(root_dir, batch_size, num_workers, cache_dir=None):
+    """
+    cache_dir: optional. If given, the resized volumes are read from memory mapped float16 caches in this folder
+    (built on first use, see build_resized_cache) instead of resizing every case in every epoch
+    """
     
     train_transform = mt.Compose(
         [
@@ -292,6 +374,9 @@ def get_BRATS2020Dataset_dataloader(root_dir, batch_size, num_workers):
     
     train_dataset = BRATS2020Dataset(root_dir, train=True, train_transform=train_transform, fold=0)
     val_dataset = BRATS2020Dataset(root_dir, train=False, val_transform=val_transform, fold=0)
+    if cache_dir is not None:
+        train_dataset = ResizedCacheDataset(train_dataset, os.path.join(cache_dir, "BraTS2020_train_128.npy"))
+        val_dataset = ResizedCacheDataset(val_dataset, os.path.join(cache_dir, "BraTS2020_val_128.npy"))
     
     # train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
     sampler = StratifiedBatchSampler(train_dataset.labels, batch_size)
@@ -358,7 +443,11 @@ class ImageNetBRATSDataset(Dataset):
         return img, label
 
 
-def get_ImageNetBRATSDataset_dataloader(batch_size, num_workers):
+def get_ImageNetBRATSDataset_dataloader(batch_size, num_workers, augmenter=None):
+    """
+    augmenter: optional BatchedAugmenter that is applied to the collated training batches inside the workers
+    (seeded per worker). train() must then be called with augmenter=False
+    """
     
     # _, model_transform = get_model_and_transform("resnet18")
     import torch
@@ -382,7 +471,11 @@ def get_ImageNetBRATSDataset_dataloader(batch_size, num_workers):
     val_dataset = ImageNetBRATSDataset(imagenet_json_path=imagenet_json_path, brats_dir=brats_folder, train=False, val_transform=val_transform)
     
     sampler = StratifiedBatchSampler(train_dataset.labels, batch_size)
-    train_loader = DataLoader(train_dataset, batch_sampler=sampler, num_workers=num_workers)
+    if augmenter is not None:
+        train_loader = DataLoader(train_dataset, batch_sampler=sampler, num_workers=num_workers,
+                                  collate_fn=BatchedAugmentCollate(augmenter), worker_init_fn=seed_worker)
+    else:
+        train_loader = DataLoader(train_dataset, batch_sampler=sampler, num_workers=num_workers)
     val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
     
     return train_loader, val_loader
@@ -8,6 +8,7 @@ from nnunetv2.models.unet_encoder import CBAMPlainConvUNet
 from nnunetv2.utilities.plans_handling.plans_handler import ConfigurationManager, PlansManager
 from nnunetv2.tuanluc_dev.network_initialization import *
 from nnunetv2.tuanluc_dev.utils import *
+from nnunetv2.tuanluc_dev.acsconv.operators import set_acsconv_memory_efficient
 
 
 def customize_network(model, custom_network_config_path):
@@ -44,11 +45,9 @@ def customize_network(model, custom_network_config_path):
         # First, we will load the acs_conv pretrained weights as a dict
         # Then, we will replace the conv3d with acsconv
         
-        # ------------------ Load ACSConv pretrained weights as a dict ------------------
-        acsconv_dict = load_acsconv_dict(custom_network_config)
-        
         # ------------------ Replace Conv3D with ACSConv with pretrained weight/random weight ------------------
-        replace_conv3d_and_load_weight_from_acsconv(model, custom_network_config, acsconv_dict)
+        # The converted pretrained weights are cached on disk, see replace_conv3d_and_load_weight_from_acsconv_cached
+        replace_conv3d_and_load_weight_from_acsconv_cached(model, custom_network_config)
         
         # Always init with nnUNet init for non-pretrained layers after replacing conv3d with ACSConv
         # Otherwise, these layers are already init with ACSConv default init
@@ -57,6 +56,14 @@ def customize_network(model, custom_network_config_path):
             print("Successfully init with nnUNet init")
         else:
             print("Successfully init with ACSConv default init")
+
+        # Pad free ACSConv (same result, less activation memory) and/or recompute ACSConv during backward
+        if custom_network_config.get("acs_memory_efficient", False) or custom_network_config.get("acs_checkpoint", False):
+            set_acsconv_memory_efficient(model,
+                                         memory_efficient=custom_network_config.get("acs_memory_efficient", False),
+                                         checkpoint=custom_network_config.get("acs_checkpoint", False))
+            print("ACSConv memory_efficient:", custom_network_config.get("acs_memory_efficient", False),
+                  "checkpoint:", custom_network_config.get("acs_checkpoint", False))
     else:
         print("---------- DEFAULT CONV3D NNUNET ----------")
         print("Do nothing")
@@ -235,6 +242,8 @@ def get_network_from_plans_jcs(plans_manager: PlansManager,
     conv_op = convert_dim_to_conv_op(dim)
 
     label_manager = plans_manager.get_label_manager(dataset_json)
+    custom_network_config = read_custom_network_config(custom_network_config_path) \
+        if custom_network_config_path is not None else {}
 
     segmentation_network_class_name = configuration_manager.UNet_class_name
     mapping = {
@@ -248,6 +257,8 @@ def get_network_from_plans_jcs(plans_manager: PlansManager,
             'norm_op_kwargs': {'eps': 1e-5, 'affine': True},
             'dropout_op': None, 'dropout_op_kwargs': None,
             'nonlin': nn.LeakyReLU, 'nonlin_kwargs': {'inplace': True},
+            # run the pretrained classifier encoder without training it (no autograd, not in the optimizer)
+            'frozen_classifier': custom_network_config.get('jcs_frozen_classifier', False),
         },
         'ResidualEncoderUNet': {
             'conv_bias': True,
@@ -1,17 +1,22 @@
 import torch
 from torch import nn
-import torch.nn.functional as F
 import timm
 
+import hashlib
+import json
+import os
 from collections import defaultdict
+from copy import deepcopy
 from natsort import natsorted
 from pathlib import Path
 from pprint import pprint
 
 import nnunetv2
 from nnunetv2.tuanluc_dev.utils import *
-from nnunetv2.tuanluc_dev.acsconv.operators import ACSConv
+from nnunetv2.tuanluc_dev.acsconv.operators import ACSConv, build_fused_acs_weight
 from nnunetv2.tuanluc_dev.jcs_combiner import JCSCombiner
+from nnunetv2.models.cbam import CBAM
+from nnunetv2.paths import nnUNet_acs_weights_cache
 from nnunetv2.utilities.find_class_by_name import recursive_find_python_class
 from batchgenerators.utilities.file_and_folder_operations import join, isfile, load_json
 
@@ -56,8 +61,7 @@ class HGGLGGClassifier(nn.Module):
             
             # Replace the conv3d with acsconv and load the weights if needed
             if custom_network_config["acsconv"]:
-                acsconv_dict = load_acsconv_dict(custom_network_config)
-                replace_conv3d_and_load_weight_from_acsconv(self.encoder, custom_network_config, acsconv_dict)
+                replace_conv3d_and_load_weight_from_acsconv_cached(self.encoder, custom_network_config)
         
         # Add a classifier head
         self.classifier = nn.Sequential(
@@ -105,8 +109,7 @@ class ImageNetBratsClassifier(nn.Module):
             
             # Replace the conv3d with acsconv and load the weights if needed
             if custom_network_config["acsconv"]:
-                acsconv_dict = load_acsconv_dict(custom_network_config)
-                replace_conv3d_and_load_weight_from_acsconv(self.encoder, custom_network_config, acsconv_dict)
+                replace_conv3d_and_load_weight_from_acsconv_cached(self.encoder, custom_network_config)
         
         self.encoder, _ = get_model_and_transform("resnet18", pretrained=True)
         self.encoder.fc = nn.Identity()
@@ -145,8 +148,16 @@ class JCSConvUnet(PlainConvUNet):
                  nonlin: Union[None, Type[torch.nn.Module]] = None,
                  nonlin_kwargs: dict = None,
                  deep_supervision: bool = False,
-                 nonlin_first: bool = False
+                 nonlin_first: bool = False,
+                 frozen_classifier: bool = False
                  ):
+        """
+        frozen_classifier: if True the pretrained classifier encoder is not trained. It is then kept out of the module
+            tree (not in parameters(), state_dict(), model.apply(...) and customize_network do not touch it, so the
+            pretrained weights stay as loaded) but follows .to()/.cuda()/.half() of the network (see _apply). It
+            runs without autograd, channels_last_3d and, on GPU, under autocast.
+            If False (default) the classifier encoder is a regular submodule and is trained jointly.
+        """
         super().__init__(
             input_channels, n_stages, features_per_stage, conv_op, kernel_sizes, strides, n_conv_per_stage,
             num_classes, n_conv_per_stage_decoder, conv_bias, norm_op, norm_op_kwargs, dropout_op, 
@@ -154,16 +165,39 @@ class JCSConvUnet(PlainConvUNet):
         )
         classifier = HGGLGGClassifier(4, 2, return_skips=True, custom_network_config_path="/home/dtpthao/workspace/nnUNet/nnunetv2/tuanluc_dev/configs/base.yaml")
         # classifier.load_state_dict(torch.load("/home/dtpthao/workspace/nnUNet/nnunetv2/tuanluc_dev/results/hgg_lgg_brats2020/checkpoints/model_45.pt"), strict=False)
-        classifier.load_state_dict(torch.load("/home/dtpthao/workspace/nnUNet/nnunetv2/tuanluc_dev/results/hgg_lgg/checkpoints/model_55.pt"), strict=False)
-        self.classifier = classifier.encoder
-        self.classifier.to("cuda")
-        self.classifier.eval()
+        classifier.load_state_dict(torch.load("/home/dtpthao/workspace/nnUNet/nnunetv2/tuanluc_dev/results/hgg_lgg/checkpoints/model_55.pt", map_location=torch.device('cpu')), strict=False)
+        self.frozen_classifier = frozen_classifier
+        if frozen_classifier:
+            classifier.encoder.requires_grad_(False)
+            classifier.encoder.eval()
+            # bypass nn.Module.__setattr__ so that it is not registered as a submodule
+            self.__dict__['_frozen_classifier'] = classifier.encoder.to(memory_format=torch.channels_last_3d)
+        else:
+            self.classifier = classifier.encoder
+            self.classifier.eval()
         self.fuse_module_list = nn.ModuleList()
         for x in [32, 64, 128, 256, 320, 320]:
             self.fuse_module_list.append(JCSCombiner(x))
-    
+
+    def _apply(self, fn, *args, **kwargs):
+        # device and dtype changes (.to(), .cuda(), .half(), ...) go through _apply, pass them on to the frozen
+        # classifier encoder, which is not a registered submodule
+        super()._apply(fn, *args, **kwargs)
+        if self.frozen_classifier:
+            self.__dict__['_frozen_classifier']._apply(fn, *args, **kwargs)
+        return self
+
+    def frozen_classifier_forward(self, x):
+        classifier = self.__dict__['_frozen_classifier']
+        with torch.no_grad(), torch.autocast(x.device.type, enabled=x.device.type == 'cuda'):
+            classifier_out = classifier(x.contiguous(memory_format=torch.channels_last_3d))
+        return [i.to(x.dtype) for i in classifier_out]
+
     def forward(self, x):
-        classifier_out = self.classifier(x)
+        if self.frozen_classifier:
+            classifier_out = self.frozen_classifier_forward(x)
+        else:
+            classifier_out = self.classifier(x)
         skips = self.encoder(x)
         combine = list(zip(classifier_out, skips))
         skips = [self.fuse_module_list[i](cls, seg) for i, (cls, seg) in enumerate(combine)]
@@ -214,111 +248,6 @@ class T1T2ConvUnet(PlainConvUNet):
 
 
 ###### CBAM ######
-class BasicConv(nn.Module):
-    def __init__(self, in_planes, out_planes, kernel_size, stride=1, padding=0, dilation=1, groups=1, relu=True, bn=True, bias=False):
-        super(BasicConv, self).__init__()
-        self.out_channels = out_planes
-        self.conv = nn.Conv3d(in_planes, out_planes, kernel_size=kernel_size, stride=stride, padding=padding, dilation=dilation, groups=groups, bias=bias)
-        self.bn = nn.BatchNorm3d(out_planes, eps=1e-5, momentum=0.01, affine=True) if bn else None
-        self.relu = nn.ReLU() if relu else None
-
-    def forward(self, x):
-        x = self.conv(x)
-        if self.bn is not None:
-            x = self.bn(x)
-        if self.relu is not None:
-            x = self.relu(x)
-        return x
-
-
-class Flatten(nn.Module):
-    def forward(self, x):
-        return x.view(x.size(0), -1)
-
-
-class ChannelGate(nn.Module):
-    def __init__(self, gate_channels, reduction_ratio=2, pool_types=['avg', 'max']):
-        super(ChannelGate, self).__init__()
-        latten = 16
-        self.gate_channels = gate_channels
-        self.mlp = nn.Sequential(
-            nn.Flatten(),
-            nn.Linear(gate_channels, latten),
-            nn.ReLU(),
-            nn.Linear(latten, gate_channels)
-        )
-
-        self.pool_types = pool_types
-
-    def forward(self, x):
-        channel_att_sum = None
-        for pool_type in self.pool_types:
-            if pool_type == 'avg':
-                # avg_pool = F.avg_pool3d(x, (x.size(2), x.size(3), x.size(4)), stride=(x.size(2), x.size(3), x.size(4)))
-                avg_pool = F.adaptive_avg_pool3d(x, (1, 1, 1))
-                channel_att_raw = self.mlp(avg_pool)
-            elif pool_type == 'max':
-                max_pool = F.max_pool3d(x, (x.size(2), x.size(3), x.size(4)), stride=(x.size(2), x.size(3), x.size(4)))
-                channel_att_raw = self.mlp(max_pool)
-            elif pool_type == 'lp':
-                lp_pool = F.lp_pool3d(x, 2, (x.size(2), x.size(3), x.size(4)), stride=(x.size(2), x.size(3), x.size(4)))
-                channel_att_raw = self.mlp(lp_pool)
-            elif pool_type == 'lse':
-                # LSE pool only
-                lse_pool = logsumexp_3d(x)
-                channel_att_raw = self.mlp(lse_pool)
-
-            if channel_att_sum is None:
-                channel_att_sum = channel_att_raw
-            else:
-                channel_att_sum = channel_att_sum + channel_att_raw
-
-        scale = F.sigmoid(channel_att_sum)
-        scale = scale.unsqueeze(-1).unsqueeze(-1).unsqueeze(-1).expand_as(x)
-        return x * scale
-
-
-def logsumexp_3d(tensor):
-    tensor_flatten = tensor.view(tensor.size(0), tensor.size(1), -1)
-    s, _ = torch.max(tensor_flatten, dim=2, keepdim=True)
-    outputs = s + (tensor_flatten - s).exp().sum(dim=2, keepdim=True).log()
-    return outputs
-
-
-class ChannelPool(nn.Module):
-    def forward(self, x):
-        return torch.cat((torch.max(x, 1)[0].unsqueeze(1), torch.mean(x, 1).unsqueeze(1)), dim=1)
-
-
-class SpatialGate(nn.Module):
-    def __init__(self):
-        super(SpatialGate, self).__init__()
-        kernel_size = 7
-        self.compress = ChannelPool()
-        self.spatial = BasicConv(2, 1, kernel_size, stride=1, padding=(kernel_size-1) // 2, relu=False)
-
-    def forward(self, x):
-        x_compress = self.compress(x)
-        x_out = self.spatial(x_compress)
-        scale = F.sigmoid(x_out)  # broadcasting
-        return x * scale
-
-
-class CBAM(nn.Module):
-    def __init__(self, gate_channels, reduction_ratio=16, pool_types=['avg', 'max'], no_spatial=False):
-        super(CBAM, self).__init__()
-        self.ChannelGate = ChannelGate(gate_channels, reduction_ratio, pool_types)
-        self.no_spatial = no_spatial
-        if not no_spatial:
-            self.SpatialGate = SpatialGate()
-
-    def forward(self, x):
-        x_out = self.ChannelGate(x)
-        if not self.no_spatial:
-            x_out = self.SpatialGate(x_out)
-        return x_out
-
-
 class CBAMPlainConvEncoder(nn.Module):
     def __init__(self,
                  input_channels: int,
@@ -625,7 +554,6 @@ def init_weights_from_pretrained_proxy_task_encoder(nnunet_model, custom_network
     del loaded
     pretrained_encoder = pretrained_model.encoder
     nnunet_model.encoder = pretrained_encoder
-    nnunet_model.to(torch.device('cuda'))
     return nnunet_model, proxy_encoder_pretrained_path
 
 
@@ -639,6 +567,98 @@ def replace_nnunet_conv3d_with_acsconv_random(model, target_layer):
             setattr(model, n, ACSConv(module.in_channels, module.out_channels, module.kernel_size, module.stride, module.padding, module.dilation, module.groups))
 
 
+def replace_acsconv_with_conv3d(model):
+    """
+    Replace (in place) every ACSConv that is exactly equivalent to a 3D convolution for all input shapes
+    (see ACSConv.fused_is_always_equivalent) with an nn.Conv3d carrying the embedded 3D kernel. Modules that are
+    registered under several names (nnU-Net's ConvDropoutNormReLU keeps conv and all_modules) are replaced everywhere.
+    Returns {name: (kernel_size, acs_kernel_split)} of all replaced names, needed to convert state dicts with
+    convert_acsconv_state_dict_to_conv3d. ACSConvs that would change the result are kept and reported.
+    """
+    # collect all (parent, attribute) pairs first, replacing while traversing would hide the aliases
+    occurrences = [(parent, n, parent_name + '.' + n if parent_name else n, module)
+                   for parent_name, parent in model.named_modules(remove_duplicate=False)
+                   for n, module in parent._modules.items() if isinstance(module, ACSConv)]
+    replacements = {}
+    kept = set()
+    converted = {}
+    for parent, n, name, module in occurrences:
+        if id(module) in kept:
+            continue
+        if id(module) not in replacements:
+            if not module.fused_is_always_equivalent():
+                print(f"Keeping ACSConv {name}: not equivalent to a Conv3d for all input shapes")
+                kept.add(id(module))
+                continue
+            conv = nn.Conv3d(module.in_channels, module.out_channels, module.kernel_size, module.stride,
+                             module.padding, module.dilation, module.groups, module.bias is not None)
+            with torch.no_grad():
+                conv.weight.copy_(module.build_fused_weight())
+                if module.bias is not None:
+                    conv.bias.copy_(module.bias)
+            replacements[id(module)] = conv.to(module.weight.device)
+        setattr(parent, n, replacements[id(module)])
+        converted[name] = (module.kernel_size, module.acs_kernel_split)
+    return converted
+
+
+def convert_acsconv_state_dict_to_conv3d(state_dict, converted):
+    """
+    Convert a state dict of the ACSConv network to the network returned by replace_acsconv_with_conv3d
+    """
+    state_dict = dict(state_dict)
+    for name, (kernel_size, acs_kernel_split) in converted.items():
+        state_dict[name + '.weight'] = build_fused_acs_weight(state_dict[name + '.weight'], kernel_size,
+                                                              acs_kernel_split)
+    return state_dict
+
+
+def check_acsconv_to_conv3d_equivalence(acs_model, conv3d_model, input_size, tolerance=1e-4):
+    """
+    Run the same random input through both networks (in eval mode) and raise if the outputs differ by more than
+    tolerance (relative to the largest output magnitude). Returns the largest absolute difference
+    """
+    device = next(acs_model.parameters()).device
+    x = torch.randn(1, *input_size, device=device)
+    acs_training, conv3d_training = acs_model.training, conv3d_model.training
+    acs_model.eval()
+    conv3d_model.eval()
+    with torch.no_grad():
+        out_acs, out_conv3d = acs_model(x), conv3d_model(x)
+    acs_model.train(acs_training)
+    conv3d_model.train(conv3d_training)
+    if not isinstance(out_acs, (list, tuple)):
+        out_acs, out_conv3d = [out_acs], [out_conv3d]
+    max_diff = max([(a - b).abs().max().item() for a, b in zip(out_acs, out_conv3d)])
+    scale = max(1., max([a.abs().max().item() for a in out_acs]))
+    if max_diff > tolerance * scale:
+        raise RuntimeError(f"ACSConv to Conv3d conversion changed the network output (max abs difference {max_diff})")
+    return max_diff
+
+
+def convert_acsconv_network_to_conv3d(network, list_of_parameters, check_input_size=None, tolerance=1e-4):
+    """
+    Deployment helper: returns (network with nn.Conv3d instead of ACSConv, converted list_of_parameters).
+    If check_input_size (c, x, y, z) is given, the converted network is checked against the original one with the
+    first set of parameters. network itself is not modified
+    """
+    converted_network = deepcopy(network)
+    converted = replace_acsconv_with_conv3d(converted_network)
+    print(f"Replaced ACSConv with Conv3d under {len(converted)} module names")
+    if len(converted) == 0:
+        return network, list_of_parameters
+    converted_parameters = [convert_acsconv_state_dict_to_conv3d(p, converted) for p in list_of_parameters]
+    if check_input_size is not None:
+        reference_network = deepcopy(network)
+        reference_network.load_state_dict(list_of_parameters[0])
+        converted_network.load_state_dict(converted_parameters[0])
+        max_diff = check_acsconv_to_conv3d_equivalence(reference_network, converted_network, check_input_size,
+                                                       tolerance)
+        print(f"Conv3d network matches the ACSConv network (max abs difference {max_diff:.2e})")
+        del reference_network
+    return converted_network, converted_parameters
+
+
 def load_acsconv_dict(custom_network_config):
     acs_pretrained = custom_network_config["acs_pretrained"]
     acsconv_dict = None
@@ -703,6 +723,136 @@ def replace_conv3d_and_load_weight_from_acsconv(model, custom_network_config, ac
         raise e
 
 
+ACS_WEIGHT_CACHE_VERSION = 1
+
+
+def _hash_file(path, chunk_size=2 ** 20):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def get_acs_weight_cache_key(model, custom_network_config):
+    """
+    Content address of the pretrained ACSConv weights that replace_conv3d_and_load_weight_from_acsconv loads into
+    model: the source checkpoint (sha256 of the file for custom encoders, model name and timm version for timm
+    models), replace_all and the conv topology of model (names, shapes, strides, ...) before replacement.
+    Returns None if nothing is loaded (acs_pretrained is None)
+    """
+    acs_pretrained = custom_network_config["acs_pretrained"]
+    if acs_pretrained is None:
+        return None
+    if Path(acs_pretrained).is_file():
+        source = f"file:{_hash_file(acs_pretrained)}"
+    else:
+        source = f"timm:{acs_pretrained}:{timm.__version__}"
+    topology = [(name, type(m).__name__, list(m.weight.shape), list(m.stride), list(m.padding), list(m.dilation),
+                 m.groups) for name, m in model.named_modules(remove_duplicate=False)
+                if isinstance(m, (_ConvNd, ACSConv))]
+    description = json.dumps({'version': ACS_WEIGHT_CACHE_VERSION, 'source': source,
+                              'replace_all': bool(custom_network_config["replace_all"]), 'topology': topology})
+    return hashlib.sha256(description.encode()).hexdigest()[:32]
+
+
+def _acsconv_occurrences(model):
+    # (parent, attribute, name, module) of all ACSConv, including aliases (ConvDropoutNormReLU keeps conv and
+    # all_modules.0)
+    return [(parent, n, parent_name + '.' + n if parent_name else n, module)
+            for parent_name, parent in model.named_modules(remove_duplicate=False)
+            for n, module in parent._modules.items() if isinstance(module, ACSConv)]
+
+
+def save_acs_weight_cache(model, random_acsconvs, cache_file):
+    """
+    Stores all ACSConv of model that are not in random_acsconvs (= the ones that were loaded from the pretrained
+    weights) together with the names under which they are registered. A module that is used under several names
+    (shared pretrained layer) is stored once
+    """
+    # random_acsconvs must hold the modules themselves, ids of modules that were garbage collected get reused
+    random_acsconv_ids = set([id(m) for m in random_acsconvs])
+    modules = {}
+    for _, _, name, module in _acsconv_occurrences(model):
+        if id(module) in random_acsconv_ids:
+            continue
+        if id(module) not in modules:
+            modules[id(module)] = {
+                'module': module,
+                'names': [],
+                'kwargs': {'in_channels': module.in_channels, 'out_channels': module.out_channels,
+                           'kernel_size': module.kernel_size[0], 'stride': module.stride, 'padding': module.padding,
+                           'dilation': module.dilation, 'groups': module.groups,
+                           'acs_kernel_split': module.acs_kernel_split, 'bias': module.bias is not None}
+            }
+        modules[id(module)]['names'].append(name)
+    modules = list(modules.values())
+    content = {
+        'modules': [{'names': m['names'], 'kwargs': m['kwargs']} for m in modules],
+        'state_dicts': [{k: v.detach().cpu().contiguous() for k, v in m['module'].state_dict().items()}
+                        for m in modules]
+    }
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    # write to a temporary file first so that concurrent builds never see a partial file
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    torch.save(content, tmp_file)
+    os.replace(tmp_file, cache_file)
+
+
+def load_acs_weight_cache(model, cache_file):
+    """
+    Counterpart to save_acs_weight_cache. The tensors are memory mapped (torch>=2.1) and used as parameters directly
+    """
+    try:
+        content = torch.load(cache_file, map_location='cpu', mmap=True, weights_only=True)
+    except TypeError:
+        # torch < 2.1 has no mmap
+        content = torch.load(cache_file, map_location='cpu')
+    occurrences = {name: (parent, n) for parent, n, name, _ in _acsconv_occurrences(model)}
+    for m, state_dict in zip(content['modules'], content['state_dicts']):
+        acsconv = ACSConv(**m['kwargs'])
+        for k, v in state_dict.items():
+            setattr(acsconv, k, nn.Parameter(v))
+        for name in m['names']:
+            parent, n = occurrences[name]
+            setattr(parent, n, acsconv)
+    print(f"Loaded {len(content['modules'])} pretrained ACSConv from cache {cache_file}")
+    return model
+
+
+def replace_conv3d_and_load_weight_from_acsconv_cached(model, custom_network_config):
+    """
+    load_acsconv_dict + replace_conv3d_and_load_weight_from_acsconv with an on disk cache of the pretrained ACSConv
+    weights that end up in model (see get_acs_weight_cache_key). With a cache hit neither timm nor the source
+    checkpoint is touched. Set acs_weight_cache: False in the custom network config to disable the cache. The cache
+    folder is nnUNet_acs_weights_cache (environment variable, default ~/.cache/nnunetv2/acs_weights)
+    """
+    cache_key = get_acs_weight_cache_key(model, custom_network_config) \
+        if custom_network_config.get("acs_weight_cache", True) else None
+    if cache_key is None:
+        acsconv_dict = load_acsconv_dict(custom_network_config)
+        return replace_conv3d_and_load_weight_from_acsconv(model, custom_network_config, acsconv_dict)
+
+    cache_file = join(nnUNet_acs_weights_cache, cache_key + '.pt')
+    if isfile(cache_file):
+        try:
+            # same random replacement and init as replace_conv3d_and_load_weight_from_acsconv, then the cached layers
+            replace_conv3d_and_load_weight_from_acsconv(model, custom_network_config, None)
+            return load_acs_weight_cache(model, cache_file)
+        except Exception as e:
+            print(f"Could not use ACSConv weight cache {cache_file}, rebuilding it. Error: {e}")
+    acsconv_dict = load_acsconv_dict(custom_network_config)
+    replace_nnunet_conv3d_with_acsconv_random(model, nn.Conv3d)
+    random_acsconvs = [m for m in model.modules() if isinstance(m, ACSConv)]
+    replace_conv3d_and_load_weight_from_acsconv(model, custom_network_config, acsconv_dict)
+    try:
+        save_acs_weight_cache(model, random_acsconvs, cache_file)
+        print(f"Saved pretrained ACSConv weights to cache {cache_file}")
+    except OSError as e:
+        print(f"Could not write ACSConv weight cache {cache_file}. Error: {e}")
+    return model
+
+
 def load_resnet18_custom_encoder(pretrained_model_path):
     model = ImageNetBratsClassifier(num_classes=2)
     model.load_state_dict(torch.load(pretrained_model_path, map_location=torch.device('cpu')), strict=False)
@@ -5,10 +5,7 @@ os.environ["CUDA_VISIBLE_DEVICES"]= "1"
 
 from pathlib import Path
 from tqdm import tqdm
-from functools import partial
-from batchgenerators.augmentations.color_augmentations import augment_contrast
 
-import cv2
 import torch
 import torch.optim as optim
 import torch.nn as nn
@@ -21,6 +18,7 @@ from nnunetv2.tuanluc_dev.dataloaders import (
     get_BRATS2020Dataset_dataloader,
     get_ImageNetBRATSDataset_dataloader
 )
+from nnunetv2.tuanluc_dev.batched_augmentation import BatchedAugmenter
 from nnunetv2.tuanluc_dev.network_initialization import HGGLGGClassifier, ImageNetBratsClassifier
 from nnunetv2.tuanluc_dev.utils import *
 from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score, roc_auc_score
@@ -66,8 +64,12 @@ def plot_loss(train_losses, val_losses, output_folder):
 
 def train(model, train_loader, val_loader, 
           output_folder="/home/dtpthao/workspace/nnUNet/nnunetv2/tuanluc_dev/checkpoints",
-          num_epochs=100, learning_rate=0.001):
-    
+          num_epochs=100, learning_rate=0.001, augmenter=None):
+    """
+    augmenter: called on every training batch after it has been moved to the device, defaults to a BatchedAugmenter
+    with the contrast augmentation (0.75-1.25, p_per_channel=0.15) that used to be applied sample by sample. Pass
+    False if the batches are already augmented in the DataLoader workers (see BatchedAugmentCollate)
+    """
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     optimizer = optim.SGD(model.parameters(), lr=learning_rate, momentum=0.99, nesterov=True)
     # optimizer = optim.Adam(model.parameters(), lr=learning_rate)
@@ -83,10 +85,8 @@ def train(model, train_loader, val_loader,
     Path(os.path.join(output_folder, 'checkpoints')).mkdir(parents=True, exist_ok=True)
     train_losses = []
     val_losses = []
-    my_augment_contrast = partial(
-        augment_contrast, 
-        contrast_range=(0.75, 1.25), preserve_range=True, per_channel=True, p_per_channel=0.15
-    )
+    if augmenter is None:
+        augmenter = BatchedAugmenter(contrast_range=(0.75, 1.25), p_per_channel_contrast=0.15, preserve_range=True)
     pbar = tqdm(range(1, num_epochs+1))
     for epoch in pbar:
         
@@ -99,15 +99,10 @@ def train(model, train_loader, val_loader,
         # Train
         for batch_idx, (data, target) in enumerate(train_loader):
             pbar.set_description(f"Epoch {epoch} Batch {batch_idx}")
-            temp = []
-            for d in data:
-                d = my_augment_contrast(d.float())
-                d = torch.cat([d] * 3, dim=0)
-                cv2.imwrite('/home/dtpthao/workspace/nnUNet/nnunetv2/tuanluc_dev/test.jpg', d.numpy().transpose(1, 2, 0))
-                exit(0)
-                temp.append(d)
-            data = torch.stack(temp)
-            data, target = data.to(device), target.float().to(device)
+            data, target = data.to(device, non_blocking=True).float(), target.float().to(device)
+            if augmenter:
+                data = augmenter(data)
+            data = torch.cat([data] * 3, dim=1)
             optimizer.zero_grad()
             output = model(data)
             loss = criterion(output.squeeze(1), target)
@@ -130,12 +125,8 @@ def train(model, train_loader, val_loader,
             true_labels = []
             with torch.no_grad():
                 for data, target in val_loader:
-                    temp = []
-                    for d in data:
-                        d = torch.cat([d] * 3, dim=0)
-                        temp.append(d)
-                    data = torch.stack(temp)
-                    data, target = data.float().to(device), target.float().to(device)
+                    data, target = data.to(device, non_blocking=True).float(), target.float().to(device)
+                    data = torch.cat([data] * 3, dim=1)
                     output = model(data)
                     val_loss += F.binary_cross_entropy_with_logits(output.squeeze(1), target, reduction='sum').item()
                     pred = torch.sigmoid(output).round().squeeze(1)
@@ -182,10 +173,13 @@ def log_metrics(output_folder, epoch, loss, predictions, true_labels, train=Fals
         f.write('{:<10} ROC AUC Score: {:.4f}\n'.format(train_val, roc_auc))
 
 
-def train_hgg_lgg_classifier(output_folder, custom_network_config_path):
+def train_hgg_lgg_classifier(output_folder, custom_network_config_path, cache_dir=None):
+    """
+    cache_dir: optional folder for the memory mapped resized volume caches (see build_resized_cache)
+    """
     train_loader, val_loader = get_BRATS2020Dataset_dataloader(
         root_dir='/home/dtpthao/workspace/brats_projects/datasets/BraTS_2018/train',
-        batch_size=5, num_workers=16
+        batch_size=5, num_workers=16, cache_dir=cache_dir
     )
     
     model = HGGLGGClassifier(5, 2, custom_network_config_path=custom_network_config_path).to(torch.device('cuda'))
@@ -215,8 +209,15 @@ def train_imagenet_brats_resnet18_encoder():
 
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cache_dir', type=str, required=False, default=None,
+                        help='[OPTIONAL] Folder for memory mapped float16 caches of the resized volumes (built on '
+                             'first use). Default: resize every case in every epoch')
+    args = parser.parse_args()
     set_seed(42)
     train_hgg_lgg_classifier(
         output_folder="/home/dtpthao/workspace/nnUNet/nnunetv2/tuanluc_dev/results/test",
-        custom_network_config_path="/home/dtpthao/workspace/nnUNet/nnunetv2/tuanluc_dev/configs/jcs_acs_resnet18_encoder.yaml"
+        custom_network_config_path="/home/dtpthao/workspace/nnUNet/nnunetv2/tuanluc_dev/configs/jcs_acs_resnet18_encoder.yaml",
+        cache_dir=args.cache_dir
     )
\ No newline at end of file
@@ -2,6 +2,8 @@
 export CUDA_DEVICE_ORDER=PCI_BUS_ID # Change according to GPU availability
 export CUDA_VISIBLE_DEVICES=1 # Change according to GPU availability
 export nnUNet_n_proc_DA=8 # Change according to CPU availability, default is 12
+# export nnUNet_DA_backend=shared_memory # logs data augmentation throughput and queue depth after every epoch
+# export nnUNet_batched_spatial_DA=true # rotation/scaling with torch grid_sample on whole batches, on the GPU with nnUNet_DA_backend=threads
 
 eval "$(conda shell.bash hook)"
 conda activate nnunet